@@ -1,25 +1,67 @@
 # -*- coding: utf-8 -*-
 # Copyright 2019, Sprout Development Team
 # Distributed under the terms of the Apache License 2.0
+"""Importing sprout is cheap: yaml is imported and
+logging configured the first time they are needed,
+and init_db, db_pool and Runner (which pull in asyncpg
+and tortoise) are imported the first time they are
+accessed."""
 
 import os
-import yaml
-import logging
-import logging.config
+import copy
+import threading
+import importlib
 
 
+# path to (mtime, size, parsed yml)
 _cfg = {}
+_cfg_lock = threading.Lock()
 _root = os.path.dirname(os.path.abspath(__file__))
-with open(os.path.join(_root, 'conf', 'log.yml'), 'r') as f:
-    logging.config.dictConfig(yaml.safe_load(f.read()))
-_log = logging.getLogger(__name__)
-_log.setLevel(logging.DEBUG)
+_logging_ready = False
+_logging_lock = threading.Lock()
+
+_lazy = {
+    'init_db': 'sprout.cli.init_db',
+    'db_pool': 'sprout.cli.init_db',
+    'Runner': 'sprout.runner',
+}
+
+
+def _yaml_load(text):
+    """Parse yml with libyaml's CSafeLoader when available."""
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(text, Loader=loader)
+
+
+def _logger(name=__name__):
+    """Get a logger, configuring logging from
+    conf/log.yml on first use."""
+    import logging
+    global _logging_ready
+    if not _logging_ready:
+        with _logging_lock:
+            if not _logging_ready:
+                from logging.config import dictConfig
+                with open(os.path.join(_root, 'conf', 'log.yml'), 'r') as f:
+                    dictConfig(_yaml_load(f.read()))
+                logging.getLogger(__name__).setLevel(logging.DEBUG)
+                _logging_ready = True
+    return logging.getLogger(name)
+
+
+def __getattr__(name):
+    if name in _lazy:
+        value = getattr(importlib.import_module(_lazy[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class Log:
     @property
     def log(self):
-        return logging.getLogger(
+        return _logger(
             '.'.join([
                 self.__module__,
                 self.__class__.__name__
@@ -29,7 +71,10 @@ class Log:
 
 def load_yml(abspath, cache=False):
     """Load a yml file and optionally cache
-    it into a package level cache.
+    it into a package level cache. Cached files
+    are only parsed again once their mtime or
+    size changes, and every call gets its own
+    copy to modify.
 
     Args:
         abspath (str): path to yml file
@@ -37,24 +82,26 @@ def load_yml(abspath, cache=False):
                       if called again
     """
     r = {}
-    if cache:
-        r = _cfg.get(abspath, {})
-        if r:
-            return r
     try:
         with open(abspath, 'r') as f:
-            r = yaml.safe_load(f.read())
+            if cache:
+                st = os.fstat(f.fileno())
+                stamp = (st.st_mtime_ns, st.st_size)
+                with _cfg_lock:
+                    hit = _cfg.get(abspath)
+                if hit is not None and hit[:2] == stamp:
+                    return copy.deepcopy(hit[2])
+            r = _yaml_load(f.read())
     except FileNotFoundError as e:
-        _log.error(f"file not found: {abspath}")
+        _logger().error(f"file not found: {abspath}")
+        return r
     if cache:
-        _cfg[abspath] = r
+        with _cfg_lock:
+            _cfg[abspath] = stamp + (r,)
+        r = copy.deepcopy(r)
     return r
 
 
 class cfg(Log):
     pass
 cfg = cfg()
-
-
-from sprout.cli.init_db import init_db, db_pool
-from sprout.runner import Runner
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 # Copyright 2019, Sprout Development Team
 # Distributed under the terms of the Apache License 2.0
+"""Command line utilities, imported on first access."""
 
-from sprout.cli import init_db
-from sprout.cli import load_db
-from sprout.cli import update_db
-from sprout.cli import dump_db
+import importlib
+
+_modules = ('init_db', 'load_db', 'update_db', 'dump_db', 'bench')
+
+
+def __getattr__(name):
+    if name in _modules:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Benchmark sprout and write the results to json.
+
+Synthetic ORM models of a given width are written to
+a temporary application package and brought up in a
+throwaway database on a local server, which is dropped
+afterwards. Against it the suite times schema bring-up
+(init_db), catalog introspection and migration planning
+over all tables, and dump_table / load_table in every
+mode at each row count (the columnar modes only when
+pyarrow is installed). PassHash throughput needs no
+database and always runs.
+
+Results carry the parameters they were measured with,
+so two runs can be compared::
+
+    python -m sprout.cli.bench --dsn postgresql://postgres@localhost/postgres \\
+        --rows 10000,100000 --out new.json --compare old.json
+
+The comparison exits non-zero when a benchmark got
+slower than the tolerance allows."""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import urllib.parse
+
+import sprout
+from sprout.core import pool as registry
+from sprout.core import columnar
+from sprout.core.auth import PassHash
+
+
+_appname = 'sproutbench'
+_schema = 'bench'
+
+# tortoise field, postgres expression of the row number g
+_columns = [
+    ("fields.IntField()", "g"),
+    ("fields.CharField(max_length=32)", "'v' || g"),
+    ("fields.DecimalField(max_digits=12, decimal_places=2)", "g * 1.5"),
+    ("fields.BooleanField()", "g % 2 = 0"),
+    ("fields.DatetimeField()", "now()"),
+    ("fields.TextField(null=True)", "md5(g::text)"),
+]
+
+
+def result(name, seconds, count=None, unit=None, **params):
+    """A benchmark result.
+
+    Args:
+        name (str): benchmark name
+        seconds (float): best wall time
+        count (int): things done in that time
+        unit (str): what count counts
+        params (dict): parameters of the run
+
+    Returns:
+        result (dict): json serializable result
+    """
+    rate = count / seconds if count and seconds else None
+    return {'name': name, 'params': params, 'seconds': seconds,
+            'count': count, 'rate': rate, 'unit': unit}
+
+
+def compare(old, new, tolerance=0.1):
+    """Find benchmarks that got slower between two runs.
+
+    Args:
+        old (dict): earlier results as written by main
+        new (dict): later results
+        tolerance (float): allowed relative slowdown
+
+    Returns:
+        slower (list): (name, params, old seconds, new seconds)
+    """
+    def key(res):
+        return res['name'], json.dumps(res['params'], sort_keys=True)
+    before = {key(res): res for res in old['results']}
+    slower = []
+    for res in new['results']:
+        was = before.get(key(res))
+        if was is None:
+            continue
+        if res['seconds'] > was['seconds'] * (1 + tolerance):
+            slower.append((res['name'], res['params'],
+                           was['seconds'], res['seconds']))
+    return slower
+
+
+def write_models(root, tables, width):
+    """Write an application package of synthetic models.
+
+    Args:
+        root (str): directory to put the package in
+        tables (int): number of tables
+        width (int): data columns per table
+    """
+    pkg = os.path.join(root, _appname, 'orm', _schema)
+    os.makedirs(pkg)
+    for path in [os.path.join(root, _appname), os.path.dirname(pkg)]:
+        open(os.path.join(path, '__init__.py'), 'w').close()
+    imports = []
+    for i in range(tables):
+        lines = ["from tortoise import fields",
+                 "from tortoise.models import Model", "", "",
+                 f"class T{i}(Model):",
+                 "    id = fields.IntField(primary_key=True)"]
+        for j in range(width):
+            field = _columns[j % len(_columns)][0]
+            lines.append(f"    c{j} = {field}")
+        with open(os.path.join(pkg, f"t{i}.py"), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        imports.append(f"from .t{i} import T{i}")
+    with open(os.path.join(pkg, '__init__.py'), 'w') as f:
+        f.write('\n'.join(imports) + '\n')
+
+
+def _dsn(dsn, database, schema=None, scheme=None):
+    """Point a connection string at another database."""
+    url = urllib.parse.urlsplit(dsn)
+    query = urllib.parse.parse_qsl(url.query)
+    if schema is not None:
+        query.append(('schema', schema))
+    return urllib.parse.urlunsplit((
+        scheme or url.scheme, url.netloc, f"/{database}",
+        urllib.parse.urlencode(query), ''))
+
+
+async def _best(repeat, fn):
+    """Best wall time of repeat awaits of fn()."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+async def bench_passhash(count=64, iterations=20000, repeat=3):
+    """Time PassHash serially, on the executor and in batch."""
+    ph = PassHash()
+    pairs = [(f"password{i}", f"salt{i}") for i in range(count)]
+    params = {'iterations': iterations}
+
+    async def serial():
+        for pw, salt in pairs:
+            ph.encode(pw, salt, iterations)
+
+    async def threaded():
+        await asyncio.gather(*(ph.aencode(pw, salt, iterations)
+                               for pw, salt in pairs))
+
+    async def batch():
+        list(ph.encode_many(pairs, iterations=iterations, chunksize=8))
+
+    return [result('passhash_encode', await _best(repeat, serial),
+                   count, 'hashes', **params),
+            result('passhash_aencode', await _best(repeat, threaded),
+                   count, 'hashes', **params),
+            result('passhash_encode_many', await _best(repeat, batch),
+                   count, 'hashes', **params)]
+
+
+async def bench_schema(dsn, database, tables, width):
+    """Time bring-up, introspection and planning."""
+    from tortoise import Tortoise
+    from sprout.cli.init_db import bring_up
+    from sprout.core.catalog import introspect
+    from sprout.core.plan import model_catalog, plan
+    base = _dsn(dsn, database)
+    params = {'tables': tables, 'width': width}
+    start = time.perf_counter()
+    await bring_up(_appname, [_schema], base,
+                   lambda schema: _dsn(dsn, database, schema, 'postgres'))
+    results = [result('init_db', time.perf_counter() - start,
+                      tables, 'tables', **params)]
+    await Tortoise.close_connections()
+    async with registry.acquire(base) as con:
+        state = {}
+
+        async def look():
+            state['db'] = await introspect(con, _schema)
+
+        async def diff():
+            state['steps'] = plan(state['db'],
+                                  model_catalog(_appname, _schema))
+
+        results.append(result('introspect', await _best(3, look),
+                              tables, 'tables', **params))
+        results.append(result('plan', await _best(3, diff),
+                              tables, 'tables', **params))
+    if state['steps']:
+        raise Exception(f"models and db differ: {state['steps'][:3]}")
+    return results
+
+
+async def bench_copy(dsn, database, rows, width, workdir):
+    """Time dumps and loads of a table in every mode."""
+    from sprout.cli.dump_db import dump_table
+    from sprout.cli.load_db import load_table
+    base = _dsn(dsn, database)
+    name = f"{_schema}.t0"
+    cols = ', '.join(f"c{j}" for j in range(width))
+    vals = ', '.join(_columns[j % len(_columns)][1] for j in range(width))
+    params = {'rows': rows, 'width': width}
+    async with registry.acquire(base) as con:
+        await con.execute(f"truncate {name};")
+        await con.execute(f"insert into {name} (id, {cols}) select g, {vals}"
+                          f" from generate_series(1, {int(rows)}) g;")
+        await con.execute(f"vacuum analyze {name};")
+    modes = [('copy', 'csv'), ('binary', 'binary'), ('chunked', 'chunked')]
+    if columnar.available():
+        modes += [('parquet', 'parquet'), ('arrow', 'arrow')]
+    results = []
+    for dump_mode, load_mode in modes:
+        out = os.path.join(workdir, f"{dump_mode}.{rows}")
+        os.makedirs(out)
+        cwd = os.getcwd()
+        os.chdir(out)
+        try:
+            start = time.perf_counter()
+            async with registry.acquire(base) as con:
+                await dump_table(_appname, _schema, 't0', mode=dump_mode,
+                                 con=con)
+            results.append(result(f"dump_table_{dump_mode}",
+                                  time.perf_counter() - start,
+                                  rows, 'rows', **params))
+            async with registry.acquire(base) as con:
+                await con.execute(f"truncate {name};")
+            start = time.perf_counter()
+            await load_table(_appname, _schema, 't0', mode=load_mode,
+                             dsn=base)
+            results.append(result(f"load_table_{load_mode}",
+                                  time.perf_counter() - start,
+                                  rows, 'rows', **params))
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+async def run(dsn=None, rows=(10000,), width=6, tables=20,
+              hashes=64, iterations=20000):
+    """Run the benchmarks.
+
+    Args:
+        dsn (str): connection string of a local server to create a
+                   throwaway database on (None for PassHash only)
+        rows (list): row counts for dump and load
+        width (int): data columns per synthetic table
+        tables (int): synthetic tables
+        hashes (int): hashes per PassHash benchmark
+        iterations (int): pbkdf2 iterations
+
+    Returns:
+        results (list): result dicts
+    """
+    results = await bench_passhash(hashes, iterations)
+    if dsn is None:
+        return results
+    workdir = tempfile.mkdtemp(prefix='sproutbench')
+    database = f"{_appname}_{os.getpid()}"
+    write_models(workdir, tables, width)
+    sys.path.insert(0, workdir)
+    async with registry.acquire(dsn) as con:
+        await con.execute(f"create database {database};")
+    try:
+        results += await bench_schema(dsn, database, tables, width)
+        for count in rows:
+            results += await bench_copy(dsn, database, count, width, workdir)
+    finally:
+        await registry.close_pool(_dsn(dsn, database))
+        async with registry.acquire(dsn) as con:
+            await con.execute(f"drop database if exists {database};")
+        sys.path.remove(workdir)
+        shutil.rmtree(workdir)
+    return results
+
+
+def _commit():
+    """Current git commit of the sprout checkout, if any."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], check=True,
+                              capture_output=True, text=True,
+                              cwd=sprout._root).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# command line utility
+parser = argparse.ArgumentParser(description="Benchmark sprout")
+parser.add_argument('--dsn', required=False, help="connection string of a"
+                    " local server (PassHash only if omitted)")
+parser.add_argument('--rows', required=False, default='10000',
+                    help="comma separated row counts")
+parser.add_argument('--width', required=False, default=6, type=int,
+                    help="data columns per table")
+parser.add_argument('--tables', required=False, default=20, type=int,
+                    help="synthetic tables")
+parser.add_argument('--hashes', required=False, default=64, type=int,
+                    help="hashes per PassHash benchmark")
+parser.add_argument('--iterations', required=False, default=20000, type=int,
+                    help="pbkdf2 iterations")
+parser.add_argument('--out', required=False, default='bench.json',
+                    help="file to write results to")
+parser.add_argument('--compare', required=False,
+                    help="earlier results to check for regressions")
+parser.add_argument('--tolerance', required=False, default=0.1, type=float,
+                    help="allowed relative slowdown")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    results = asyncio.run(registry.closing(
+        run(dsn=args.dsn,
+            rows=[int(n) for n in args.rows.split(',')],
+            width=args.width,
+            tables=args.tables,
+            hashes=args.hashes,
+            iterations=args.iterations)
+    ))
+    report = {'commit': _commit(), 'python': platform.python_version(),
+              'machine': platform.machine(), 'cpus': os.cpu_count(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    for res in results:
+        rate = f"{res['rate']:.0f} {res['unit']}/s" if res['rate'] else ''
+        print(f"{res['name']:24} {res['seconds']:10.4f}s {rate}")
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            slower = compare(json.load(f), report, args.tolerance)
+        for name, params, was, now in slower:
+            print(f"slower: {name} {params} {was:.4f}s -> {now:.4f}s")
+        sys.exit(1 if slower else 0)
@@ -2,76 +2,568 @@
 # Copyright 2019, Sprout Development Team
 # Distributed under the terms of the Apache License 2.0
 """Dump the state of a DB schema to files.
-This is not implemented to scale."""
 
-import sys
+These modes are supported:
+
+  - 'orm': fetch every row through the Tortoise model
+    and write it out with pandas (does not scale)
+  - 'copy': stream the table through a server-side
+    ``COPY ... TO STDOUT`` straight into the file, in
+    constant memory
+  - 'binary': as 'copy' but in the PostgreSQL binary
+    format, optionally compressed, with a manifest of
+    the column types (see sprout.core.archive)
+  - 'chunked': as 'copy' but keyset paginated on the
+    primary key and checkpointed after every chunk so
+    an interrupted dump resumes where it stopped (see
+    sprout.core.checkpoint)
+  - 'parquet' / 'arrow': fetch the rows through a
+    server-side cursor a chunk at a time and write each
+    chunk as a Parquet row group or an Arrow IPC record
+    batch, optionally pruned to some columns and
+    filtered by a predicate (see sprout.core.columnar)
+
+A whole schema is dumped with dump_db, which copies
+all tables concurrently over a connection pool from
+a single exported snapshot.
+"""
+
+import io
+import os
+import csv
 import asyncio
+import hashlib
 import argparse
-import importlib
-
-import asyncpg
-import pandas as pd
-from tortoise import fields
 
 import sprout
+from sprout.core.models import discover_models, get_model
+from sprout.core import pool as registry
+from sprout.core import metrics
+from sprout.core.archive import (archive_path, manifest_path, open_archive,
+                                 write_manifest, table_columns, file_sink,
+                                 quote_ident, primary_key)
+from sprout.core.columnar import columnar_path, arrow_schema, open_writer
+from sprout.core.columnar import write_batch as write_columnar
+from sprout.core.checkpoint import (dump_checkpoint_path, read_checkpoint,
+                                    write_checkpoint)
 
 _BLACKLIST = ['id']
+# modes dump_db can run from one snapshot
+_schema_modes = ('copy', 'binary', 'parquet', 'arrow')
 
 # command line utility
 parser = argparse.ArgumentParser(description="Dump application DB schema")
 parser.add_argument('--appname', required=True, help="name of application")
 parser.add_argument('--schema', required=True, help="schema where table resides")
-parser.add_argument('--table', required=True, help="name of the table")
+parser.add_argument('--table', required=False, help="name of the table"
+                    " (dump the whole schema if omitted)")
+parser.add_argument('--mode', required=False, default='orm',
+                    choices=['orm', 'copy', 'binary', 'chunked',
+                             'parquet', 'arrow'],
+                    help="dump strategy")
+parser.add_argument('--chunk-size', required=False, default=100000, type=int,
+                    help="rows per checkpointed chunk, row group or batch")
+parser.add_argument('--compression', required=False, default=None,
+                    choices=['gzip', 'zstd'],
+                    help="compress binary and columnar dumps")
+parser.add_argument('--columns', required=False, default=None,
+                    help="comma separated columns to dump"
+                         " (columnar table dumps only)")
+parser.add_argument('--where', required=False, default=None,
+                    help="sql predicate rows must match"
+                         " (columnar table dumps only)")
+parser.add_argument('--concurrency', required=False, default=4, type=int,
+                    help="tables dumped at once (whole schema only)")
+parser.add_argument('--dsn', required=False, default=None,
+                    help="app db connection string (default from db.yml)")
+
+
+async def _table_columns(con, schema, table, keys=False):
+    """Get the ordered columns of a table,
+    less those in the _BLACKLIST.
+
+    Args:
+        con (asyncpg.Connection): db connection
+        schema (str): schema name
+        table (str): table name
+        keys (bool): keep the _BLACKLIST columns too
+
+    Returns:
+        cols (dict): column name to type
+    """
+    cols = await table_columns(con, schema, table)
+    return {name: typ for name, typ in cols.items()
+            if keys or name not in _BLACKLIST}
+
+
+async def copy_table(con, appname, schema, table, path=None, keys=False):
+    """Stream the data in a table to csv with a
+    server-side COPY, ignoring the _BLACKLIST fields.
+    Rows are written to the file as they arrive so
+    memory use does not depend on the table size.
+
+    Args:
+        con (asyncpg.Connection): db connection
+        appname (str): application name
+        schema (str): schema name
+        table (str): table name
+        path (str): output file (default f"{appname}.orm.{schema}.{table}.csv")
+        keys (bool): keep the _BLACKLIST columns too
+
+    Returns:
+        path (str): the file written
+    """
+    path = path or f"{appname}.orm.{schema}.{table}.csv"
+    cols = await _table_columns(con, schema, table, keys)
+    status = await con.copy_from_table(
+        table, schema_name=schema, columns=list(cols),
+        output=path, format='csv', header=True
+    )
+    metrics.copied('dump', schema, table, int(status.split()[-1]),
+                   os.path.getsize(path))
+    sprout.cfg.log.info(f"{schema}.{table}: {status} -> {path}")
+    return path
 
 
-async def dump_table(appname, schema, table):
-    """Dump the data in a table to csv,
-    ignoring the 'id' field.
+async def copy_table_binary(con, appname, schema, table, compression=None,
+                            keys=False):
+    """Stream the data in a table to a binary COPY archive,
+    ignoring the _BLACKLIST fields, and write its manifest.
 
     Args:
+        con (asyncpg.Connection): db connection
         appname (str): application name
         schema (str): schema name
+        table (str): table name
+        compression (str): None, 'gzip' or 'zstd'
+        keys (bool): keep the _BLACKLIST columns too
+
+    Returns:
+        path (str): the data file written
+    """
+    path = archive_path(appname, schema, table, compression)
+    cols = await _table_columns(con, schema, table, keys)
+    with open_archive(path, 'wb', compression) as f:
+        status = await con.copy_from_table(
+            table, schema_name=schema, columns=list(cols),
+            output=file_sink(f, compression), format='binary'
+        )
+    write_manifest(manifest_path(appname, schema, table), schema, table,
+                   cols, compression, int(status.split()[-1]))
+    metrics.copied('dump', schema, table, int(status.split()[-1]),
+                   os.path.getsize(path))
+    sprout.cfg.log.info(f"{schema}.{table}: {status} -> {path}")
+    return path
+
+
+async def pk_ranges(con, schema, table, parts):
+    """Split a table into primary key ranges of about
+    equal row counts, e.g. to dump it with several
+    workers through copy_table_chunked.
+
+    Args:
+        con (asyncpg.Connection): db connection
+        schema (str): schema name
+        table (str): table name
+        parts (int): number of ranges
+
+    Returns:
+        ranges (list): inclusive (lo, hi) key pairs
     """
-    #base = sprout.cfg.db_str(appname)
-    #con = await asyncpg.connect(base)
-
-    # TODO : lifted from update_db.model_state
-    await sprout.init_db(appname, [schema])
-    modkey = f"{appname}.orm.{schema}.{table}"
-    importlib.import_module(modkey)
-    mod = sys.modules[modkey]
-    obj = vars(mod)[table.title()]
-    dat = await obj.filter()
-    keys = [key for key in vars(dat[0]).keys()
-            if not key.startswith('_') and key
-            not in _BLACKLIST]
+    key = quote_ident(await primary_key(con, schema, table))
+    name = f"{quote_ident(schema)}.{quote_ident(table)}"
+    q = f"""select min(k) as lo, max(k) as hi from (
+select {key} as k, ntile($1) over (order by {key}) as part from {name}
+) s group by part order by part;"""
+    return [(r['lo'], r['hi']) for r in await con.fetch(q, parts)]
+
+
+def _csv_header(cols):
+    """The csv header line COPY would write for cols."""
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator='\n').writerow(cols)
+    return buf.getvalue().encode('utf-8')
+
+
+def _jsonable(value):
+    """Keep primary key values storable in a checkpoint."""
+    if value is None or isinstance(value, (int, str)):
+        return value
+    return str(value)
+
+
+async def copy_table_chunked(con, appname, schema, table, chunk_size=100000,
+                             lo=None, hi=None, part=None):
+    """Stream the data in a table to csv in primary key
+    order, one chunk of at most chunk_size rows at a time,
+    ignoring the _BLACKLIST fields. Every chunk is flushed
+    to disk and recorded in a checkpoint before the next
+    one starts; if a checkpoint exists already the file is
+    truncated to the last recorded chunk and the dump goes
+    on from there.
+
+    Args:
+        con (asyncpg.Connection): db connection
+        appname (str): application name
+        schema (str): schema name
+        table (str): table name
+        chunk_size (int): rows per chunk
+        lo (object): smallest primary key to dump (default no bound)
+        hi (object): largest primary key to dump (default no bound)
+        part (str): tag added to the file name when splitting
+                    a table by key range (see pk_ranges)
+
+    Returns:
+        path (str): the file written
+    """
+    path = f"{appname}.orm.{schema}.{table}.csv"
+    if part is not None:
+        path = f"{appname}.orm.{schema}.{table}.{part}.csv"
+    ckpt_path = dump_checkpoint_path(path)
+    ckpt = read_checkpoint(ckpt_path)
+    if ckpt is None or not os.path.exists(path):
+        key = await primary_key(con, schema, table)
+        cols = await _table_columns(con, schema, table)
+        ckpt = {'schema': schema, 'table': table, 'key': key,
+                'columns': list(cols), 'lo': _jsonable(lo),
+                'hi': _jsonable(hi), 'complete': False, 'chunks': []}
+        with open(path, 'wb') as f:
+            f.write(_csv_header(ckpt['columns']))
+        write_checkpoint(ckpt_path, ckpt)
+    if ckpt['complete']:
+        return path
+    # bounds come back from the checkpoint as json, so they are
+    # sent as text and cast to the key type (dates, uuids, ...)
+    cast = (await table_columns(con, schema, table))[ckpt['key']]
+    key = quote_ident(ckpt['key'])
+    cols = ', '.join(quote_ident(col) for col in ckpt['columns'])
+    name = f"{quote_ident(schema)}.{quote_ident(table)}"
+    with open(path, 'r+b') as f:
+        f.readline()
+        header = f.tell()
+        while True:
+            chunks = ckpt['chunks']
+            cond, args = [], []
+
+            def bound(op, value):
+                args.append(str(value))
+                cond.append(f"{key} {op} (${len(args)}::text)::{cast}")
+
+            if chunks:
+                bound('>', chunks[-1]['stop'])
+            elif ckpt['lo'] is not None:
+                bound('>=', ckpt['lo'])
+            if ckpt['hi'] is not None:
+                bound('<=', ckpt['hi'])
+            where = f"where {' and '.join(cond)}" if cond else ''
+            begin = chunks[-1]['end'] if chunks else header
+            f.seek(begin)
+            f.truncate()
+            digest = hashlib.sha256()
+            async def sink(data):
+                digest.update(data)
+                f.write(data)
+            async with con.transaction(isolation='repeatable_read',
+                                       readonly=True):
+                bounds = await con.fetchrow(
+                    f"""select count(*) as rows, min(k) as start,
+max(k) as stop from (select {key} as k from {name} {where}
+order by {key} limit {int(chunk_size)}) s;""", *args)
+                if not bounds['rows']:
+                    break
+                bound('<=', bounds['stop'])
+                status = await con.copy_from_query(
+                    f"select {cols} from {name} "
+                    f"where {' and '.join(cond)} order by {key}",
+                    *args, output=sink, format='csv'
+                )
+            rows = int(status.split()[-1])
+            if rows != bounds['rows']:
+                raise Exception(f"{schema}.{table}: copied {rows} rows"
+                                f" of {bounds['rows']}")
+            f.flush()
+            os.fsync(f.fileno())
+            chunks.append({'start': _jsonable(bounds['start']),
+                           'stop': _jsonable(bounds['stop']),
+                           'rows': rows, 'begin': begin, 'end': f.tell(),
+                           'sha256': digest.hexdigest()})
+            write_checkpoint(ckpt_path, ckpt)
+            metrics.copied('dump', schema, table, rows,
+                           chunks[-1]['end'] - begin)
+            sprout.cfg.log.info(f"{schema}.{table}: chunk {len(chunks)}"
+                                f" ({rows} rows) -> {path}")
+    ckpt['complete'] = True
+    write_checkpoint(ckpt_path, ckpt)
+    return path
+
+
+async def copy_table_columnar(con, appname, schema, table, fmt='parquet',
+                              compression=None, columns=None, where=None,
+                              params=(), chunk_size=100000, keys=False):
+    """Stream the data in a table to a Parquet or Arrow
+    IPC file through a server-side cursor, ignoring the
+    _BLACKLIST fields. Every chunk_size rows fetched are
+    written as one row group or record batch while the
+    next chunk is fetched, so memory use is bounded by
+    about two chunks whatever the size of the table.
+
+    Args:
+        con (asyncpg.Connection): db connection
+        appname (str): application name
+        schema (str): schema name
+        table (str): table name
+        fmt (str): 'parquet' or 'arrow'
+        compression (str): None, 'gzip' ('parquet' only) or 'zstd'
+        columns (list): columns to dump (default all)
+        where (str): sql predicate rows must match, e.g.
+                     "created > $1" (default all rows)
+        params (tuple): arguments of the predicate
+        chunk_size (int): rows per row group or record batch
+        keys (bool): keep the _BLACKLIST columns too
+
+    Returns:
+        path (str): the file written
+    """
+    path = columnar_path(appname, schema, table, fmt)
+    cols = await _table_columns(con, schema, table, keys)
+    if columns is not None:
+        unknown = [col for col in columns if col not in cols]
+        if unknown:
+            raise Exception(f"{schema}.{table} has no columns {unknown}")
+        cols = {col: cols[col] for col in columns}
+    query = (f"select {', '.join(quote_ident(col) for col in cols)} "
+             f"from {quote_ident(schema)}.{quote_ident(table)}")
+    if where:
+        query += f" where {where}"
+    aschema = arrow_schema(schema, table, cols)
+    loop = asyncio.get_running_loop()
+    rows = 0
+
+    async def stream(writer):
+        nonlocal rows
+        cur = await con.cursor(query, *params)
+        pending = None
+        try:
+            while True:
+                batch = await cur.fetch(chunk_size)
+                if pending is not None:
+                    await pending
+                    pending = None
+                if not batch:
+                    break
+                # encode and write off the loop while the next chunk arrives
+                pending = loop.run_in_executor(None, write_columnar,
+                                               writer, aschema, batch)
+                rows += len(batch)
+        finally:
+            # a failed fetch must not close the writer under a write
+            if pending is not None:
+                await asyncio.wait([pending])
+
+    writer = open_writer(path, aschema, fmt, compression)
+    try:
+        if con.is_in_transaction():
+            await stream(writer)
+        else:
+            async with con.transaction(isolation='repeatable_read',
+                                       readonly=True):
+                await stream(writer)
+    finally:
+        writer.close()
+    metrics.copied('dump', schema, table, rows, os.path.getsize(path))
+    sprout.cfg.log.info(f"{schema}.{table}: {rows} rows -> {path}")
+    return path
+
+
+async def _copy(con, appname, schema, table, mode, compression,
+                chunk_size=100000, columns=None, where=None, params=(),
+                keys=False):
+    """Dispatch to the COPY based dump for a mode."""
+    if mode == 'chunked':
+        return await copy_table_chunked(con, appname, schema, table,
+                                        chunk_size=chunk_size)
+    if mode == 'binary':
+        return await copy_table_binary(con, appname, schema, table,
+                                       compression=compression, keys=keys)
+    if mode in ('parquet', 'arrow'):
+        return await copy_table_columnar(con, appname, schema, table,
+                                         fmt=mode, compression=compression,
+                                         columns=columns, where=where,
+                                         params=params,
+                                         chunk_size=chunk_size, keys=keys)
+    return await copy_table(con, appname, schema, table, keys=keys)
+
+
+async def dump_table(appname, schema, table, mode='orm',
+                     compression=None, chunk_size=100000, con=None,
+                     columns=None, where=None, params=(), dsn=None):
+    """Dump the data in a table to a file in one of the
+    modes of the module docstring. The _BLACKLIST columns
+    are left out, unlike in dump_db which keeps the keys.
+
+    Args:
+        appname (str): application name
+        schema (str): schema name
+        table (str): table name
+        mode (str): 'orm', 'copy', 'binary', 'chunked', 'parquet'
+                    or 'arrow' (see module docstring)
+        compression (str): None, 'gzip' or 'zstd'
+                           ('binary', 'parquet' and 'arrow' only)
+        chunk_size (int): rows per chunk ('chunked') or per row
+                          group or batch ('parquet', 'arrow')
+        con (asyncpg.Connection): db connection (not for 'orm')
+        columns (list): columns to dump ('parquet', 'arrow' only)
+        where (str): sql predicate rows must match with $n
+                     placeholders ('parquet', 'arrow' only)
+        params (tuple): arguments of the predicate
+        dsn (str): app db connection string when con is None
+                   (default from the db config, see pool.app_dsn)
+
+    Returns:
+        path (str): the file written
+    """
+    if mode in ('copy', 'binary', 'chunked', 'parquet', 'arrow'):
+        if con is not None:
+            return await _copy(con, appname, schema, table, mode,
+                               compression, chunk_size, columns,
+                               where, params)
+        async with registry.acquire(dsn or registry.app_dsn(appname)) as con:
+            return await _copy(con, appname, schema, table, mode,
+                               compression, chunk_size, columns,
+                               where, params)
+    if mode != 'orm':
+        raise Exception(f"dump mode not understood: {mode}")
+    import pandas as pd
+    await sprout.init_db(appname, [schema], dsn or registry.app_dsn(appname))
+    info = get_model(appname, schema, table)
+    keys = [fld.column if fld.references else fld.name
+            for fld in info.fields if fld.name not in _BLACKLIST]
+    dat = await info.model.filter()
+    path = f'{info.module}.csv'
     pd.DataFrame.from_dict(
         ({k: getattr(row, k) for k in keys} for row in dat)
-    ).to_csv(f'{modkey}.csv', index=False)
-#    names = [key for key in vars(obj).keys()
-#             if not key.startswith('_')]
-#    fields = [getattr(obj, fld) for fld in names]
-#    print(names)
-#    print(fields)
+    ).to_csv(path, index=False)
+    return path
+
+
+async def _table_sizes(con, schema, tables):
+    """Get the on-disk size of the tables in a schema.
+
+    Args:
+        con (asyncpg.Connection): db connection
+        schema (str): schema name
+        tables (list): table names
+
+    Returns:
+        sizes (dict): table name to size in bytes
+    """
+    q = """select c.relname, pg_catalog.pg_total_relation_size(c.oid) as size
+from pg_catalog.pg_class c
+join pg_catalog.pg_namespace n on n.oid = c.relnamespace
+where n.nspname = $1 and c.relname = any($2::text[])
+and c.relkind in ('r', 'p');"""
+    ret = await con.fetch(q, schema, list(tables))
+    return {r['relname']: r['size'] for r in ret}
+
+
+async def _copy_in_snapshot(dsn, sem, snapshot, appname, schema, table,
+                            mode, compression):
+    """Copy a table on a pooled connection that has
+    imported an exported transaction snapshot."""
+    async with sem, registry.acquire(dsn) as con:
+        async with con.transaction(isolation='repeatable_read',
+                                   readonly=True):
+            await con.execute(f"set transaction snapshot '{snapshot}';")
+            return await _copy(con, appname, schema, table,
+                               mode, compression, keys=True)
 
 
-async def dump_db(appname, schema):
+async def dump_db(appname, schema, concurrency=4,
+                  mode='copy', compression=None, dsn=None):
     """Dump the data in an application database
     to csv files for intra-database migration.
 
+    Every table with an ORM model in the schema is
+    copied concurrently, largest first, over at most
+    concurrency pooled connections. A coordinating
+    REPEATABLE READ transaction exports its snapshot
+    with pg_export_snapshot and each copy imports it,
+    so all files reflect the same point in time. Primary
+    keys are kept, unlike in table dumps, so that
+    load_schema can restore the foreign keys between
+    the tables as they were.
+
     Args:
         appname (str): application name
         schema (str): schema name
-    """
-    base = sprout.cfg.db_str(appname)
-    con = await asyncpg.connect(base)
+        concurrency (int): max tables dumped at once (capped
+                           below the size of an existing pool)
+        mode (str): 'copy', 'binary', 'parquet' or 'arrow'
+                    (see module docstring)
+        compression (str): None, 'gzip' or 'zstd' (not for 'copy')
+        dsn (str): app db connection string
+                   (default from the db config, see pool.app_dsn)
 
+    Returns:
+        paths (list): the files written
+    """
+    if mode not in _schema_modes:
+        raise Exception(f"dump mode not understood: {mode}")
+    tables = list(discover_models(appname, schema))
+    base = dsn or registry.app_dsn(appname)
+    pool = await registry.get_pool(base, min_size=concurrency + 1,
+                                   max_size=concurrency + 1)
+    # sizes only apply to a new pool and the
+    # coordinating transaction holds a connection
+    size = pool.get_max_size()
+    if size < 2:
+        raise Exception(f"dump_db needs a pool of 2 or more, not {size}")
+    if concurrency >= size:
+        sprout.cfg.log.warning(f"pool of {size} connections, dumping "
+                               f"{size - 1} tables at once, not {concurrency}")
+        concurrency = size - 1
+    sem = asyncio.Semaphore(concurrency)
+    async with registry.acquire(base) as con:
+        async with con.transaction(isolation='repeatable_read',
+                                   readonly=True):
+            snapshot = await con.fetchval("select pg_export_snapshot();")
+            sizes = await _table_sizes(con, schema, tables)
+            for table in tables:
+                if table not in sizes:
+                    sprout.cfg.log.warning(f"{schema}.{table} not in db")
+            # waiters are served first come first served
+            # so scheduling in this order starts large tables first
+            order = sorted(sizes, key=sizes.get, reverse=True)
+            return await asyncio.gather(*(
+                _copy_in_snapshot(base, sem, snapshot, appname, schema,
+                                  table, mode, compression)
+                for table in order
+            ))
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    asyncio.run(
-        dump_table(args.appname,
-                   args.schema,
-                   args.table)
-    )
+    if args.table is None:
+        if args.mode not in _schema_modes:
+            parser.error(f"--mode {args.mode} needs --table")
+        asyncio.run(registry.closing(
+            dump_db(args.appname,
+                    args.schema,
+                    concurrency=args.concurrency,
+                    mode=args.mode,
+                    compression=args.compression,
+                    dsn=args.dsn)
+        ))
+    else:
+        asyncio.run(registry.closing(
+            dump_table(args.appname,
+                       args.schema,
+                       args.table,
+                       mode=args.mode,
+                       compression=args.compression,
+                       chunk_size=args.chunk_size,
+                       columns=(args.columns.split(',')
+                                if args.columns else None),
+                       where=args.where,
+                       dsn=args.dsn)
+        ))
@@ -3,16 +3,30 @@
 # Distributed under the terms of the Apache License 2.0
 """Establish databases, schemas and tables for
 an application that conforms to the expectation
-of the sprout library."""
+of the sprout library.
+
+Databases can also be created as a copy of a "golden"
+template database that holds the fully initialized
+schemas of an application. The template is named after
+a fingerprint of the model modules and is built on first
+use; once the models change a new template is built and
+the stale one dropped. Cloning a template is a file level
+copy on the server, far faster than replaying the DDL."""
 
 import asyncio
+import hashlib
 import argparse
 
 import asyncpg
 from tortoise import fields
 from tortoise import Tortoise
+from tortoise.utils import generate_schema_for_client
 
 import sprout
+from sprout.core import pool
+from sprout.core.models import schema_models
+from sprout.core.archive import quote_ident
+from sprout.core.snapshot import model_fingerprint
 
 
 async def _create_database(root, name):
@@ -23,13 +37,11 @@ async def _create_database(root, name):
         root (str): a root db connection string
         name (str): name of the application db
     """
-    con = await asyncpg.connect(root)
-    try:
-        await con.execute(f"create database {name};")
-    except asyncpg.exceptions.DuplicateDatabaseError:
-        sprout.cfg.log.info(f"database {name} exists")
-    finally:
-        await con.close()
+    async with pool.acquire(root) as con:
+        try:
+            await con.execute(f"create database {name};")
+        except asyncpg.exceptions.DuplicateDatabaseError:
+            sprout.cfg.log.info(f"database {name} exists")
 
 
 async def _create_schema(base, name):
@@ -40,13 +52,105 @@ async def _create_schema(base, name):
         base (str): a db schema connection string
         name (str): name of the application db
     """
-    con = await asyncpg.connect(base)
-    try:
-        await con.execute(f"create schema {name};")
-    except asyncpg.exceptions.DuplicateSchemaError:
-        sprout.cfg.log.info(f"schema {name} exists")
-    finally:
-        await con.close()
+    async with pool.acquire(base) as con:
+        await con.execute(f"create schema if not exists {quote_ident(name)};")
+
+
+def _model_modules(appname, schema):
+    """The table modules of a schema, since Tortoise only
+    finds models in the modules it is given."""
+    tables = schema_models(appname, schema)
+    if not tables:
+        return [f'{appname}.orm.{schema}']
+    return [info.module for info in tables.values()]
+
+
+def _check_labels(appname, labels):
+    """Make sure Tortoise can register the models of every
+    schema under its label and resolve their relations.
+    Nothing about the models is changed.
+
+    Args:
+        appname (str): application name
+        labels (dict): schema name to app label
+    """
+    for schema, label in labels.items():
+        for info in schema_models(appname, schema).values():
+            meta = info.model._meta
+            where = f"{appname}.orm.{schema}.{info.table}"
+            if meta.app not in (None, label):
+                # Tortoise skips a model registered under another label
+                raise Exception(f"{where} is registered as '{meta.app}',"
+                                f" it can't be '{label}' in this process")
+            for name in meta.fk_fields | meta.o2o_fields | meta.m2m_fields:
+                ref = meta.fields_map[name].model_name
+                if not isinstance(ref, str):
+                    continue
+                app, model = ref.split('.', 1)
+                if app == label:
+                    continue
+                if app in labels.values():
+                    raise Exception(
+                        f"{where}.{name} references {ref} in another schema;"
+                        f" each schema's tables are generated on its own"
+                        f" connection, so relations can't cross schemas")
+                raise Exception(f"{where}.{name} references {ref}, with the"
+                                f" schemas {sorted(labels)} it must be"
+                                f" '{label}.{model}'")
+
+
+def tortoise_config(appname, schemas, url):
+    """Build a Tortoise config registering the models
+    of every schema at once, each schema with its own
+    connection. A lone schema keeps the 'models' app
+    label; with several schemas each app is labelled
+    by its schema and relations name it, e.g.
+    fields.ForeignKeyField('menu.Kind') in menu. A
+    relation to another schema raises, as does one
+    that doesn't use the label.
+
+    Args:
+        appname (str): application name
+        schemas (list): list of schemas
+        url (callable): schema name to connection string
+
+    Returns:
+        config (dict): config for Tortoise.init
+    """
+    single = len(schemas) == 1
+    labels = {schema: 'models' if single else schema for schema in schemas}
+    _check_labels(appname, labels)
+    return {
+        'connections': {schema: url(schema) for schema in schemas},
+        'apps': {labels[schema]: {
+                    'models': _model_modules(appname, schema),
+                    'default_connection': schema}
+                 for schema in schemas},
+    }
+
+
+async def bring_up(appname, schemas, base, url):
+    """Create schemas and their tables. Schemas are created
+    concurrently, Tortoise is initialized once with all of
+    them and tables are generated concurrently with IF NOT
+    EXISTS DDL, each schema on its own connection. Tortoise
+    orders the tables of a schema by their foreign keys,
+    which therefore can't reference another schema.
+
+    Args:
+        appname (str): application name
+        schemas (list): list of schemas
+        base (str): application db connection string
+        url (callable): schema name to connection string
+    """
+    config = tortoise_config(appname, schemas, url)
+    await asyncio.gather(*(_create_schema(base, schema)
+                           for schema in schemas))
+    await Tortoise.init(config=config)
+    await asyncio.gather(*(
+        generate_schema_for_client(Tortoise.get_connection(schema), safe=True)
+        for schema in schemas))
+    sprout.cfg.log.info(f"{', '.join(schemas)} ready")
 
 
 async def init_db(appname, schemas, db_str):
@@ -61,18 +165,119 @@ async def init_db(appname, schemas, db_str):
     # root = db_str # or sprout.cfg.db_str()
     # await _create_database(root, appname)
     # base = sprout.cfg.db_str(appname)
-    for schema in schemas:
-        await _create_schema(db_str, schema)
-        await Tortoise.init(
-            db_url=db_str, #sprout.cfg.db_str(appname, schema),
-            modules={'models': [f'{appname}.orm.{schema}']}
-        )
-        await Tortoise.generate_schemas()
-        sprout.cfg.log.info(f"{schema} ready")
+    sep = '&' if '?' in db_str else '?'
+    await bring_up(appname, schemas, db_str,
+                   lambda schema: f"{db_str}{sep}schema={schema}")
+
+
+def template_name(appname, schemas):
+    """Name the template database of an application at
+    the current state of its models.
+
+    Args:
+        appname (str): application name
+        schemas (list): list of schemas
+
+    Returns:
+        name (str): e.g. golden_0123456789abcdef
+    """
+    fp = model_fingerprint(appname, schemas, content=True)
+    key = f"{appname}:{','.join(schemas)}:{fp}"
+    return f"golden_{hashlib.md5(key.encode()).hexdigest()[:16]}"
+
+
+async def _drop_stale_templates(con, appname, keep):
+    """Drop the templates of an application built
+    from earlier models."""
+    stale = await con.fetch("""
+        select d.datname from pg_catalog.pg_database d
+        join pg_catalog.pg_shdescription s on s.objoid = d.oid
+         and s.classoid = 'pg_catalog.pg_database'::regclass
+        where s.description = $1 and d.datname <> $2;""",
+        f"sprout template {appname}", keep)
+    for rec in stale:
+        name = rec['datname']
+        try:
+            await con.execute(f"alter database {name} is_template false;")
+            await con.execute(f"drop database {name};")
+            sprout.cfg.log.info(f"dropped stale template {name}")
+        except asyncpg.exceptions.ObjectInUseError:
+            sprout.cfg.log.info(f"stale template {name} in use")
+
+
+async def build_template(root, appname, schemas, url):
+    """Build the template database of an application
+    unless it is already there. Concurrent builders wait
+    on an advisory lock; a database left half built by an
+    interrupted builder is dropped and built again.
+
+    Args:
+        root (str): a root db connection string
+        appname (str): application name
+        schemas (list): list of schemas
+        url (callable): database and schema name (or None)
+                        to connection string
+
+    Returns:
+        name (str): name of the template database
+    """
+    name = template_name(appname, schemas)
+    async with pool.acquire(root) as con:
+        await con.execute("select pg_advisory_lock(hashtext($1));", name)
+        try:
+            ready = await con.fetchval(
+                "select datistemplate from pg_catalog.pg_database "
+                "where datname = $1;", name)
+            if ready:
+                return name
+            if ready is not None:
+                await con.execute(f"drop database {name};")
+            sprout.cfg.log.info(f"building template {name}")
+            await con.execute(f"create database {name};")
+            try:
+                await bring_up(appname, schemas, url(name, None),
+                               lambda schema: url(name, schema))
+            finally:
+                # a template can't be copied while connected to
+                await Tortoise.close_connections()
+                await pool.close_pool(url(name, None))
+            await con.execute(f"comment on database {name} is "
+                              f"'sprout template {appname}';")
+            await con.execute(f"alter database {name} is_template true;")
+            await _drop_stale_templates(con, appname, name)
+            return name
+        finally:
+            await con.execute("select pg_advisory_unlock(hashtext($1));",
+                              name)
+
+
+async def create_from_template(root, appname, schemas, url, name=None):
+    """Create an application database as a copy of its
+    template, building the template first if the models
+    changed since it was built, and point Tortoise at it.
+
+    Args:
+        root (str): a root db connection string
+        appname (str): application name
+        schemas (list): list of schemas
+        url (callable): database and schema name (or None)
+                        to connection string
+        name (str): database to create (default appname)
+    """
+    name = name or appname
+    template = await build_template(root, appname, schemas, url)
+    async with pool.acquire(root) as con:
+        try:
+            await con.execute(f"create database {name} template {template};")
+        except asyncpg.exceptions.DuplicateDatabaseError:
+            sprout.cfg.log.info(f"database {name} exists")
+    await Tortoise.init(config=tortoise_config(
+        appname, schemas, lambda schema: url(name, schema)))
 
 
 async def db_pool(appname, db_opts):
-    """Create an application database connection pool.
+    """Get the application database connection pool
+    from the pool registry.
 
     Args:
         appname (str): application name
@@ -81,16 +286,13 @@ async def db_pool(appname, db_opts):
     Returns:
         pool: asyncpg connection pool
     """
-    opts = db_opts # or sprout.cfg.db_opts.copy()
+    opts = db_opts.copy() # or sprout.cfg.db_opts.copy()
     opts['database'] = appname
-    opts['user'] = opts.pop('username')
-    opts.pop('driver')
-    pw = opts.pop('password')
     sprout.cfg.log.debug('asyncpg pool init')
-    sprout.cfg.log.debug(opts)
-    opts['password'] = pw
-    pool = await asyncpg.create_pool(**opts)
-    return pool
+    sprout.cfg.log.debug({key: val for key, val in opts.items()
+                          if key != 'password'})
+    return await pool.get_pool(pool.dsn_from_opts(opts),
+                               **pool.pool_opts(opts))
 
 
 # command line utility
@@ -102,8 +304,8 @@ parser.add_argument('--config', required=False, help="path to db config file")
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    asyncio.run(
+    asyncio.run(pool.closing(
         init_db(appname=args.appname,
                 schemas=args.schemas.split(','),
                 config=args.config)
-    )
+    ))
@@ -2,55 +2,519 @@
 # Copyright 2019, Sprout Development Team
 # Distributed under the terms of the Apache License 2.0
 """Load the dumped data from dump_db.py
-into a different database."""
+into a different database.
 
-import sys
+Files are streamed to the server through a single
+``COPY ... FROM STDIN`` in batches of whole records,
+so memory use is bounded by the batch size rather
+than the size of the file. Binary archives written
+by dump_db's 'binary' mode are streamed back as is,
+after checking their manifest against the table.
+Chunked dumps are loaded one checksummed chunk per
+transaction, resuming after the last committed one.
+Parquet and Arrow dumps are read back a row group or
+record batch at a time into a single binary COPY.
+
+A whole schema is loaded with load_schema, which
+follows the foreign keys between ORM models so that
+tables are loaded concurrently as soon as the tables
+they reference are done."""
+
+import io
+import os
+import csv
+import time
 import asyncio
 import argparse
-import importlib
-
-import asyncpg
-import pandas as pd
-from tortoise import fields
 
 import sprout
+from sprout.core import pool as registry
+from sprout.core import metrics
+from sprout.core.models import schema_models, dependency_order
+from sprout.core.archive import (manifest_path, read_manifest, open_archive,
+                                 archive_path, table_columns, file_source,
+                                 quote_ident)
+from sprout.core.columnar import (columnar_path, read_metadata,
+                                  iter_batches, batch_records)
+from sprout.core.checkpoint import (dump_checkpoint_path, load_checkpoint_path,
+                                    read_checkpoint, write_checkpoint,
+                                    read_chunk)
+
+# modes dump_db writes with primary keys, see load_schema
+_schema_modes = ('csv', 'binary', 'parquet', 'arrow')
+
+
+def _iter_csv_batches(path, batch_size):
+    """Read a csv file in batches of whole records.
+    The header line is yielded on its own first.
+    Quoted fields may span lines so a record only
+    ends on a line that leaves no quote open.
+
+    Args:
+        path (str): csv file
+        batch_size (int): records per batch
+
+    Yields:
+        chunk, nrows (bytes, int): raw csv and its record count
+    """
+    with open(path, 'rb') as f:
+        yield f.readline(), 0
+        buf, nrows, quoted = [], 0, False
+        for line in f:
+            buf.append(line)
+            if line.count(b'"') % 2:
+                quoted = not quoted
+            if quoted:
+                continue
+            nrows += 1
+            if nrows == batch_size:
+                yield b''.join(buf), nrows
+                buf, nrows = [], 0
+        if buf:
+            yield b''.join(buf), nrows
 
-async def load_table(appname, schema, table):
-    """Load the data from a csv to the table.
+
+async def _with_progress(batches, name):
+    """Pass batches on to COPY one at a time, logging
+    throughput. The COPY protocol only asks for the
+    next batch once the previous one was written, so
+    reading never runs ahead of the server."""
+    start = time.perf_counter()
+    total = 0
+    for chunk, nrows in batches:
+        yield chunk
+        if not nrows:
+            continue
+        total += nrows
+        rate = total / max(time.perf_counter() - start, 1e-9)
+        sprout.cfg.log.info(f"{name}: {total} rows ({rate:.0f} rows/s)")
+
+
+async def copy_file(con, schema, table, path,
+                    batch_size=10000, timeout=None):
+    """Stream a csv file with a header into a table.
 
     Args:
+        con (asyncpg.Connection): db connection
+        schema (str): schema name
+        table (str): table name
+        path (str): csv file
+        batch_size (int): records sent per batch
+        timeout (float): seconds for the whole COPY (default no limit)
+
+    Returns:
+        status (str): status of the COPY command
+    """
+    with open(path, 'r', newline='') as f:
+        columns = next(csv.reader(f))
+    batches = _iter_csv_batches(path, batch_size)
+    status = await con.copy_to_table(
+        table, schema_name=schema, columns=columns,
+        source=_with_progress(batches, f"{schema}.{table}"),
+        format='csv', header=True, timeout=timeout
+    )
+    metrics.copied('load', schema, table, int(status.split()[-1]),
+                   os.path.getsize(path))
+    return status
+
+
+async def copy_archive(con, appname, schema, table, timeout=None):
+    """Stream a binary COPY archive into a table. The
+    column types in the manifest must match the table
+    exactly since binary values are not re-parsed.
+
+    Args:
+        con (asyncpg.Connection): db connection
         appname (str): application name
         schema (str): schema name
         table (str): table name
+        timeout (float): seconds for the whole COPY (default no limit)
+
+    Returns:
+        status (str): status of the COPY command
     """
-    await sprout.init_db(appname, [schema])
-    pool = await sprout.db_pool(appname)
-    csv = f"{appname}.orm.{schema}.{table}.csv"
-    df = pd.read_csv(csv, keep_default_na=False)
-    async with pool.acquire() as con:
-        thing = await con.fetch("select * from information_schema.columns"
-        " where table_schema='food' and table_name='ingredient';")
-        print(thing)
-    async with pool.acquire() as con:
-        await con.copy_records_to_table(
+    manifest = read_manifest(manifest_path(appname, schema, table))
+    have = await table_columns(con, schema, table)
+    for col in manifest['columns']:
+        if have.get(col['name']) != col['type']:
+            raise Exception(f"{schema}.{table}.{col['name']} is "
+                            f"{have.get(col['name'])} not {col['type']}")
+    compression = manifest['compression']
+    path = archive_path(appname, schema, table, compression)
+    with open_archive(path, 'rb', compression) as f:
+        status = await con.copy_to_table(
             table, schema_name=schema,
-            records=(tuple(x) for x in df.values),
-            columns=list(df.columns),
-            timeout=10
+            columns=[col['name'] for col in manifest['columns']],
+            source=file_source(f), format='binary', timeout=timeout
         )
+    metrics.copied('load', schema, table, int(status.split()[-1]),
+                   os.path.getsize(path))
+    return status
+
+
+async def copy_chunks(con, schema, table, path, timeout=None):
+    """Load a chunked dump one chunk per transaction,
+    checking each chunk's checksum and row count. The
+    load checkpoint records the transaction id before
+    each commit so that a resumed load can ask the
+    server whether the last chunk made it in.
+
+    Args:
+        con (asyncpg.Connection): db connection
+        schema (str): schema name
+        table (str): table name
+        path (str): data file of a chunked dump
+        timeout (float): seconds per chunk COPY (default no limit)
+
+    Returns:
+        rows (int): rows loaded by this call
+    """
+    dump = read_checkpoint(dump_checkpoint_path(path))
+    if dump is None:
+        raise Exception(f"no checkpoint for {path}")
+    if not dump['complete']:
+        sprout.cfg.log.warning(f"{path}: dump is incomplete")
+    ckpt_path = load_checkpoint_path(path)
+    ckpt = read_checkpoint(ckpt_path) or {'next': 0, 'pending': None}
+    if ckpt['pending'] is not None:
+        status = await con.fetchval("select txid_status($1::bigint);",
+                                    int(ckpt['pending']))
+        if status == 'committed':
+            ckpt['next'] += 1
+        ckpt['pending'] = None
+        write_checkpoint(ckpt_path, ckpt)
+    rows = 0
+    with open(path, 'rb') as f:
+        for chunk in dump['chunks'][ckpt['next']:]:
+            data = read_chunk(f, chunk)
+            async with con.transaction():
+                ckpt['pending'] = await con.fetchval(
+                    "select txid_current()::text;")
+                write_checkpoint(ckpt_path, ckpt)
+                status = await con.copy_to_table(
+                    table, schema_name=schema, columns=dump['columns'],
+                    source=io.BytesIO(data), format='csv', timeout=timeout
+                )
+                if int(status.split()[-1]) != chunk['rows']:
+                    raise Exception(f"{schema}.{table}: {status} but chunk"
+                                    f" has {chunk['rows']} rows")
+            ckpt['next'] += 1
+            ckpt['pending'] = None
+            write_checkpoint(ckpt_path, ckpt)
+            rows += chunk['rows']
+            metrics.copied('load', schema, table, chunk['rows'], len(data))
+            sprout.cfg.log.info(f"{schema}.{table}: chunk {ckpt['next']}"
+                                f" of {len(dump['chunks'])}")
+    return rows
+
+
+async def copy_columnar(con, appname, schema, table, fmt='parquet',
+                        timeout=None):
+    """Stream a Parquet or Arrow IPC dump into a table
+    with asyncpg's copy_records_to_table. Row groups or
+    record batches are read one at a time, off the loop,
+    as the COPY asks for more rows.
+
+    Args:
+        con (asyncpg.Connection): db connection
+        appname (str): application name
+        schema (str): schema name
+        table (str): table name
+        fmt (str): 'parquet' or 'arrow'
+        timeout (float): seconds for the whole COPY (default no limit)
+
+    Returns:
+        status (str): status of the COPY command
+    """
+    path = columnar_path(appname, schema, table, fmt)
+    columns = [col['name'] for col in read_metadata(path)['columns']]
+    have = await table_columns(con, schema, table)
+    missing = [col for col in columns if col not in have]
+    if missing:
+        raise Exception(f"{schema}.{table} has no columns {missing}")
+    loop = asyncio.get_running_loop()
+    rows = 0
+
+    async def records():
+        nonlocal rows
+        batches = iter_batches(path)
+        while True:
+            batch = await loop.run_in_executor(None, next, batches, None)
+            if batch is None:
+                break
+            recs = batch_records(batch)
+            rows += len(recs)
+            for rec in recs:
+                yield rec
+
+    status = await con.copy_records_to_table(
+        table, schema_name=schema, columns=columns,
+        records=records(), timeout=timeout
+    )
+    metrics.copied('load', schema, table, rows, os.path.getsize(path))
+    return status
+
+
+def _source_path(appname, schema, table, mode):
+    """The file whose presence means a table was dumped."""
+    if mode == 'binary':
+        return manifest_path(appname, schema, table)
+    if mode == 'chunked':
+        return dump_checkpoint_path(f"{appname}.orm.{schema}.{table}.csv")
+    if mode == 'csv':
+        return f"{appname}.orm.{schema}.{table}.csv"
+    if mode in ('parquet', 'arrow'):
+        return columnar_path(appname, schema, table, mode)
+    raise Exception(f"load mode not understood: {mode}")
+
+
+async def _load(con, appname, schema, table, mode, batch_size, timeout):
+    """Dispatch to the COPY based load for a mode."""
+    if mode == 'binary':
+        return await copy_archive(con, appname, schema, table,
+                                  timeout=timeout)
+    if mode in ('parquet', 'arrow'):
+        return await copy_columnar(con, appname, schema, table,
+                                   fmt=mode, timeout=timeout)
+    if mode == 'chunked':
+        return await copy_chunks(con, schema, table,
+                                 f"{appname}.orm.{schema}.{table}.csv",
+                                 timeout=timeout)
+    return await copy_file(con, schema, table,
+                           _source_path(appname, schema, table, mode),
+                           batch_size=batch_size, timeout=timeout)
+
+
+def _acquire(pool, dsn):
+    """Borrow a connection from pool if one was given,
+    otherwise from the registered pool of dsn."""
+    if pool is not None:
+        return pool.acquire()
+    return registry.acquire(dsn)
+
+
+async def load_table(appname, schema, table, pool=None, mode='csv',
+                     batch_size=10000, timeout=None, dsn=None):
+    """Load the data from a csv to the table.
+
+    Args:
+        appname (str): application name
+        schema (str): schema name
+        table (str): table name
+        pool (asyncpg.pool.Pool): db connection pool not in the
+                                  registry (default the registered
+                                  pool of dsn)
+        mode (str): 'csv', 'binary' archive, 'chunked' dump,
+                    or 'parquet' / 'arrow' columnar dump
+        batch_size (int): records sent per batch ('csv' only)
+        timeout (float): seconds for the whole COPY (default no limit)
+        dsn (str): app db connection string when pool is None, its
+                   tables already created (default from the db config,
+                   brought up with init_db)
+    """
+    path = _source_path(appname, schema, table, mode)
+    if pool is None and dsn is None:
+        dsn = registry.app_dsn(appname)
+        await sprout.init_db(appname, [schema], dsn)
+    async with _acquire(pool, dsn) as con:
+        status = await _load(con, appname, schema, table, mode,
+                             batch_size, timeout)
+    sprout.cfg.log.info(f"{schema}.{table}: {status} <- {path}")
+    return status
+
+
+async def _drop_secondary(con, schema):
+    """Drop the foreign keys and the indexes that don't
+    back a constraint in a schema.
+
+    Args:
+        con (asyncpg.Connection): db connection
+        schema (str): schema name
+
+    Returns:
+        ddl (tuple): (index, foreign key) statements that restore them
+    """
+    i = """select format('drop index %I.%I;', n.nspname, ic.relname) as drop,
+pg_catalog.pg_get_indexdef(i.indexrelid) || ';' as create
+from pg_catalog.pg_index i
+join pg_catalog.pg_class ic on ic.oid = i.indexrelid
+join pg_catalog.pg_namespace n on n.oid = ic.relnamespace
+where n.nspname = $1 and not exists (
+select 1 from pg_catalog.pg_constraint k where k.conindid = i.indexrelid);"""
+    k = """select format('alter table %I.%I drop constraint %I;',
+n.nspname, c.relname, k.conname) as drop,
+format('alter table %I.%I add constraint %I %s;', n.nspname, c.relname,
+k.conname, pg_catalog.pg_get_constraintdef(k.oid)) as create
+from pg_catalog.pg_constraint k
+join pg_catalog.pg_class c on c.oid = k.conrelid
+join pg_catalog.pg_namespace n on n.oid = c.relnamespace
+where n.nspname = $1 and k.contype = 'f';"""
+    idx = await con.fetch(i, schema)
+    fks = await con.fetch(k, schema)
+    async with con.transaction():
+        for row in fks + idx:
+            await con.execute(row['drop'])
+    sprout.cfg.log.info(f"{schema}: dropped {len(idx)} indexes"
+                        f" and {len(fks)} foreign keys")
+    return [r['create'] for r in idx], [r['create'] for r in fks]
+
+
+async def _restore_secondary(pool, dsn, sem, ddl):
+    """Rebuild the indexes concurrently, then the
+    foreign keys that may depend on them."""
+    async def run(sql):
+        async with sem, _acquire(pool, dsn) as con:
+            await con.execute(sql)
+    for stmts in ddl:
+        await asyncio.gather(*(run(sql) for sql in stmts))
+
+
+async def _reset_sequences(con, schema):
+    """Move the serial and identity sequences of a schema
+    past the largest value loaded into their columns.
+
+    Args:
+        con (asyncpg.Connection): db connection
+        schema (str): schema name
+    """
+    q = """select c.relname, a.attname, pg_catalog.pg_get_serial_sequence(
+pg_catalog.format('%I.%I', n.nspname, c.relname), a.attname) as seq
+from pg_catalog.pg_attribute a
+join pg_catalog.pg_class c on c.oid = a.attrelid
+join pg_catalog.pg_namespace n on n.oid = c.relnamespace
+where n.nspname = $1 and c.relkind in ('r', 'p')
+and a.attnum > 0 and not a.attisdropped;"""
+    for r in await con.fetch(q, schema):
+        if r['seq'] is None:
+            continue
+        await con.execute(
+            f"select pg_catalog.setval($1, coalesce(max("
+            f"{quote_ident(r['attname'])}), 0) + 1, false) from "
+            f"{quote_ident(schema)}.{quote_ident(r['relname'])};", r['seq'])
+
+
+async def load_schema(appname, schema, pool=None, concurrency=4,
+                      defer=None, mode='csv', batch_size=10000,
+                      timeout=None, dsn=None):
+    """Load the csv files of every ORM model in a schema.
+
+    Tables are loaded concurrently, at most concurrency
+    at a time, but only after all tables they reference
+    by foreign key have been loaded. Each table is loaded
+    in its own transaction. Tables without a file are
+    skipped. The dumps of dump_db carry primary keys, so
+    foreign keys still point at the same rows, and serial
+    sequences are moved past the loaded keys afterwards.
+    Chunked table dumps lack primary keys and can't be
+    loaded as a schema.
+
+    Args:
+        appname (str): application name
+        schema (str): schema name
+        pool (asyncpg.pool.Pool): db connection pool not in the
+                                  registry (default the registered
+                                  pool of dsn)
+        concurrency (int): max tables loaded at once
+        defer (str): None, or 'rebuild' to drop the foreign keys and
+                     secondary indexes and rebuild them after the load
+                     (tables are then loaded in any order)
+        mode (str): 'csv', 'binary' archives,
+                    or 'parquet' / 'arrow' columnar dumps
+        batch_size (int): records sent per batch ('csv' only)
+        timeout (float): seconds per table COPY (default no limit)
+        dsn (str): app db connection string when pool is None, its
+                   tables already created (default from the db config,
+                   brought up with init_db)
+    """
+    if defer not in (None, 'rebuild'):
+        raise Exception(f"defer not understood: {defer}")
+    if mode not in _schema_modes:
+        raise Exception(f"load mode not understood for a schema: {mode}")
+    if pool is None and dsn is None:
+        dsn = registry.app_dsn(appname)
+        await sprout.init_db(appname, [schema], dsn)
+    infos = schema_models(appname, schema)
+    # files and tables are named after the tables, not the modules
+    models = {info.db_table: info for info in infos.values()}
+    deps = {info.db_table: {infos[ref].db_table for ref in info.deps}
+            for info in infos.values()}
+    dependency_order(deps)
+    paths = {table: _source_path(appname, schema, table, mode)
+             for table in models}
+    done = {table: asyncio.Event() for table in models}
+    for table, path in paths.items():
+        if not os.path.exists(path):
+            sprout.cfg.log.warning(f"{schema}.{table}: no {path}")
+            done[table].set()
+    sem = asyncio.Semaphore(concurrency)
+
+    async def load(table):
+        try:
+            for ref in deps[table]:
+                await done[ref].wait()
+            async with sem, _acquire(pool, dsn) as con:
+                async with con.transaction():
+                    status = await _load(con, appname, schema, table,
+                                         mode, batch_size, timeout)
+            sprout.cfg.log.info(f"{schema}.{table}: {status}")
+        finally:
+            done[table].set()
+
+    ddl = None
+    if defer == 'rebuild':
+        async with _acquire(pool, dsn) as con:
+            ddl = await _drop_secondary(con, schema)
+        deps = {table: set() for table in deps}
+    try:
+        await asyncio.gather(*(load(table) for table in models
+                               if not done[table].is_set()))
+        async with _acquire(pool, dsn) as con:
+            await _reset_sequences(con, schema)
+    finally:
+        if ddl is not None:
+            await _restore_secondary(pool, dsn, sem, ddl)
 
 
 # command line utility
 parser = argparse.ArgumentParser(description="Dump application DB schema")
 parser.add_argument('--appname', required=True, help="name of application")
 parser.add_argument('--schema', required=True, help="schema where table resides")
-parser.add_argument('--table', required=True, help="name of the table")
+parser.add_argument('--table', required=False, help="name of the table"
+                    " (load the whole schema if omitted)")
+parser.add_argument('--mode', required=False, default='csv',
+                    choices=['csv', 'binary', 'chunked', 'parquet', 'arrow'],
+                    help="format of the dump")
+parser.add_argument('--batch-size', required=False, default=10000, type=int,
+                    help="records sent per batch")
+parser.add_argument('--timeout', required=False, default=None, type=float,
+                    help="seconds allowed for the load")
+parser.add_argument('--concurrency', required=False, default=4, type=int,
+                    help="tables loaded at once (whole schema only)")
+parser.add_argument('--defer', required=False, default=None,
+                    choices=['rebuild'],
+                    help="defer index and constraint work (whole schema only)")
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    asyncio.run(
-        load_table(args.appname,
-                   args.schema,
-                   args.table)
-    )
+    if args.table is None:
+        if args.mode not in _schema_modes:
+            parser.error(f"--mode {args.mode} needs --table")
+        asyncio.run(registry.closing(
+            load_schema(args.appname,
+                        args.schema,
+                        concurrency=args.concurrency,
+                        defer=args.defer,
+                        mode=args.mode,
+                        batch_size=args.batch_size,
+                        timeout=args.timeout)
+        ))
+    else:
+        asyncio.run(registry.closing(
+            load_table(args.appname,
+                       args.schema,
+                       args.table,
+                       mode=args.mode,
+                       batch_size=args.batch_size,
+                       timeout=args.timeout)
+        ))
@@ -8,67 +8,74 @@ it to the current ORM table definitions."""
 import sys
 import asyncio
 import argparse
-import importlib
-
-import asyncpg
-import pandas as pd
-from tortoise import fields
 
 import sprout
+from sprout.core.catalog import introspect
+from sprout.core.plan import model_catalog, plan
+from sprout.core.models import get_model
+from sprout.core.migrate import run_plan, sql_steps
+from sprout.core import snapshot
+from sprout.core import pool as registry
 
 
-_pg_type_map = {
-    fields.IntField: 'integer',
-    #fields.BigIntField: 'biginteger',
-    #fields.SmallIntField: 'smallinteger',
-    #fields.CharField: 'character',
-    fields.TextField: 'text',
-    fields.BooleanField: 'boolean',
-    fields.DecimalField: 'numeric',
-    #fields.DateTimeField: 'timestamp',
-    #fields.DateField: 'date',
-    #fields.TimeDeltaField: 'timedelta',
-    fields.FloatField: 'double precision',
-    #fields.JSONField: 'json',
-    #fields.UUIDField: 'uuid',
-    #fields.ForeignKeyField,
-    #fields.ManyToManyField,
-    #fields.BackwardFKRelation,
-}
-
-
-async def schema_info(appname, schema):
-    base = sprout.cfg.db_str(appname)
-    con = await asyncpg.connect(base)
-    cols = [
-        'table_catalog',
-        'table_schema',
-        'table_name',
-        'data_type',
-        'column_name',
-    ]
-    q = f"""select {', '.join(cols)} from information_schema.columns
-where table_catalog='{appname}' and table_schema='{schema}';"""
-    cols = cols[:-2] + ['constraint_name']
-    k = f"""select {', '.join(cols)} from information_schema.table_constraints
-where table_catalog='{appname}' and table_schema='{schema}'
-and constraint_type='FOREIGN KEY';"""
+async def _states(appname, schemas, pool, cache, dsn=None):
+    """Get the db catalog, and the model catalog if
+    cache is True, from the snapshot or from scratch."""
+    async def fetch(con):
+        if cache:
+            return await snapshot.states(con, appname, schemas)
+        return await introspect(con, schemas), None
+    if pool is not None:
+        return await fetch(pool)
+    async with registry.acquire(dsn or registry.app_dsn(appname)) as con:
+        return await fetch(con)
+
+
+async def catalog_state(appname, schemas, pool=None, cache=False, dsn=None):
+    """Get the current definition of every table in the
+    given schemas in a single catalog query.
+
+    Args:
+        appname (str): application (database) name
+        schemas (str,list): schema name(s)
+        pool (asyncpg.pool.Pool): db connection pool
+        cache (bool): answer from the local snapshot if still current
+        dsn (str): app db connection string when pool is None
+                   (default from the db config, see pool.app_dsn)
+
+    Returns:
+        catalog (dict): (schema, table) to sprout.core.catalog.Table
+    """
+    dbstate, _ = await _states(appname, schemas, pool, cache, dsn)
+    return dbstate
+
+
+async def schema_info(appname, schema, pool=None, cache=False, dsn=None):
+    import pandas as pd
     try:
-        ret = await con.fetch(q)
-        df = pd.DataFrame.from_records(ret, columns=ret[0].keys())
+        catalog = await catalog_state(appname, schema, pool=pool,
+                                      cache=cache, dsn=dsn)
+        cols = [(appname, tbl.schema, tbl.name, col.data_type, col.name)
+                for tbl in catalog.values()
+                for col in tbl.columns.values()]
+        df = pd.DataFrame.from_records(cols, columns=[
+            'table_catalog', 'table_schema', 'table_name',
+            'data_type', 'column_name'])
         print("Information Schema Summary")
         print(df)
-        ret = await con.fetch(k)
-        fk = pd.DataFrame.from_records(ret, columns=ret[0].keys())
+        fks = [(appname, tbl.schema, tbl.name, con.name)
+               for tbl in catalog.values()
+               for con in tbl.constraints.values() if con.kind == 'f']
+        fk = pd.DataFrame.from_records(fks, columns=[
+            'table_catalog', 'table_schema', 'table_name',
+            'constraint_name'])
         print("Foreign Key Summary")
         print(fk)
     except Exception as e:
         sprout.cfg.log.error(f"fetching current table state failed: {e}")
-    finally:
-        await con.close()
 
 
-async def schema_state(appname, schema, table):
+async def schema_state(appname, schema, table, pool=None, dsn=None):
     """Get the current table definition that exists
     in the database.
     
@@ -76,29 +83,26 @@ async def schema_state(appname, schema, table):
         appname (str): application (database) name
         schema (str): schema name
         table (str): table name
+        pool (asyncpg.pool.Pool): db connection pool
+        dsn (str): app db connection string when pool is None
+                   (default from the db config, see pool.app_dsn)
 
     Returns:
         df (pd.DataFrame): description of table schema
     """
-    base = sprout.cfg.db_str(appname)
-    con = await asyncpg.connect(base)
-    req = ', '.join([
-        'table_catalog',
-        'table_schema',
-        'table_name',
-        'column_name',
-        'data_type'
-    ])
-    q = f"""select {req} from information_schema.columns
-where table_schema='{schema}' and table_name='{table}';"""
+    import pandas as pd
     try:
-        ret = await con.fetch(q)
-        df = pd.DataFrame.from_records(ret, columns=ret[0].keys())
-        return df
+        catalog = await catalog_state(appname, schema, pool=pool, dsn=dsn)
+        tbl = catalog[(schema, table)]
+        return pd.DataFrame.from_dict({
+            'table_catalog': appname,
+            'table_schema': schema,
+            'table_name': table,
+            'column_name': list(tbl.columns),
+            'data_type': [col.data_type for col in tbl.columns.values()]
+        })
     except Exception as e:
         sprout.cfg.log.error(f"fetching current table state failed: {e}")
-    finally:
-        await con.close()
 
 
 def model_state(appname, schema, table):
@@ -108,7 +112,7 @@ def model_state(appname, schema, table):
     Args:
         appname (str): application name
         schema (str): schema name
-        table (str): table name
+        table (str): table module or database table name
 
     Returns:
         df (pd.DataFrame): description of table model
@@ -117,25 +121,15 @@ def model_state(appname, schema, table):
         Assumes appname has a module structure organized
         like: f"{appname}.orm.{schema}.{table}"
     """
-    modkey = f"{appname}.orm.{schema}.{table}"
-    importlib.import_module(modkey)
-    mod = sys.modules[modkey]
-    obj = vars(mod)[table.title()]
-    names = [key for key in vars(obj).keys()
-             if not key.startswith('_')]
-    fields = [getattr(obj, fld) for fld in names]
-    flds, typs = [], []
-    for name, field in zip(names, fields):
-        if not isinstance(field, property):
-            flds.append(name)
-            typs.append(field)
-    typs = [_pg_type_map[fld.__class__] for fld in typs]
+    import pandas as pd
+    table = get_model(appname, schema, table).db_table
+    tbl = model_catalog(appname, schema)[(schema, table)]
     return pd.DataFrame.from_dict({
         'table_catalog': appname,
         'table_schema': schema,
         'table_name': table,
-        'column_name': flds,
-        'data_type': typs
+        'column_name': list(tbl.columns),
+        'data_type': [col.data_type for col in tbl.columns.values()]
     })
 
 
@@ -144,6 +138,7 @@ def compare_state(appname, schema, table, dbstate, modstate):
     to upgrade the DB schema to match the ORM model and
     downgrade the DB schema to match the ORM model.
     """
+    import pandas as pd
     dbstate['id'] = range(len(dbstate.index))
     modstate['id'] = range(len(modstate.index))
     print("dbstate")
@@ -177,15 +172,60 @@ def compare_state(appname, schema, table, dbstate, modstate):
     return upg_sql, dng_sql
 
 
-async def set_state(appname, diff):
-    base = sprout.cfg.db_str(appname)
-    con = await asyncpg.connect(base)
+async def plan_state(appname, schemas, pool=None, drop=False, cache=False,
+                     dsn=None):
+    """Plan the migration of whole schemas from their
+    current state in the database to the state of the
+    ORM models.
+
+    Args:
+        appname (str): application name
+        schemas (str,list): schema name(s)
+        pool (asyncpg.pool.Pool): db connection pool
+        drop (bool): also drop what the models lack
+        cache (bool): use the local snapshot of both states if still current
+        dsn (str): app db connection string when pool is None
+                   (default from the db config, see pool.app_dsn)
+
+    Returns:
+        steps (list): ordered sprout.core.plan.Step tuples
+    """
+    dbstate, modstate = await _states(appname, schemas, pool, cache, dsn)
+    if modstate is None:
+        modstate = model_catalog(appname, schemas)
+    return plan(dbstate, modstate, drop=drop)
+
+
+async def set_state(appname, diff, pool=None, lock_timeout=5.0,
+                    statement_timeout=None, retries=5, dsn=None):
+    """Apply a migration, all or nothing, without waiting
+    on locks for longer than lock_timeout at a time.
+
+    Args:
+        appname (str): application name
+        diff (str,list): raw sql or sprout.core.plan.Step tuples
+        pool (asyncpg.pool.Pool): db connection pool
+        lock_timeout (float): seconds a statement may wait for a lock
+        statement_timeout (float): seconds a statement may run (no limit)
+        retries (int): retries after a lock timeout
+        dsn (str): app db connection string when pool is None
+                   (default from the db config, see pool.app_dsn)
+
+    Returns:
+        timings (list): sprout.core.migrate.Timing per step
+    """
+    steps = sql_steps(diff) if isinstance(diff, str) else diff
+    opts = {'lock_timeout': lock_timeout, 'retries': retries,
+            'statement_timeout': statement_timeout}
     try:
-        await con.execute(diff)
+        if pool is not None:
+            async with pool.acquire() as con:
+                return await run_plan(con, steps, **opts)
+        async with registry.acquire(dsn or registry.app_dsn(appname)) as con:
+            return await run_plan(con, steps, **opts)
     except Exception as e:
         sprout.cfg.log.error(f"failed setting state: {e}")
-    finally:
-        await con.close()
+        raise
 
 
 # command line utility
@@ -194,33 +234,67 @@ parser.add_argument('--appname', required=True, help="name of application")
 parser.add_argument('--schema', required=True, help="schema where table resides")
 parser.add_argument('--table', required=False, help="name of table to inspect")
 parser.add_argument('--action', required=False, help="upgrade or downgrade")
+parser.add_argument('--drop', required=False, action='store_true',
+                    help="let a whole schema upgrade drop what models lack")
+parser.add_argument('--cache', required=False, action='store_true',
+                    help="answer info and dry runs from the local snapshot")
+parser.add_argument('--lock-timeout', required=False, default=5.0, type=float,
+                    help="seconds a statement may wait for a lock")
+parser.add_argument('--dsn', required=False, default=None,
+                    help="app db connection string (default from db.yml)")
 
 
-async def update_db(appname, schema, table, action):
+async def update_db(appname, schema, table, action, drop=False,
+                    lock_timeout=5.0, cache=False, dsn=None):
     """Compare the state of a table in a database to
     its ORM model table definition. Optionally run
     statements to upgrade or downgrade the database
-    corresponding to the ORM model.
+    corresponding to the ORM model. Without a table
+    the whole schema is planned at once.
 
     Args:
         appname (str): application name
-        schema (str): schema name
-        table (str): table name (required if action != 'info')
+        schema (str): schema name (comma separated for several)
+        table (str): table module or database table name
+                     (whole schema if None)
         action (str): 'upgrade', 'downgrade' or 'info'
+        drop (bool): let a whole schema upgrade drop what models lack
+        lock_timeout (float): seconds a statement may wait for a lock
+        cache (bool): answer info and dry runs from the local snapshot
+        dsn (str): app db connection string
+                   (default from the db config, see pool.app_dsn)
     """
-    loop = asyncio.get_event_loop()
-    if args.action == 'info':
-        await schema_info(args.appname, args.schema)
+    dsn = dsn or registry.app_dsn(appname)
+    if action == 'info':
+        await schema_info(appname, schema, cache=cache, dsn=dsn)
         sys.exit()
 
-    dbstate = await schema_state(args.appname, args.schema, args.table)
-    modstate = model_state(args.appname, args.schema, args.table)
-    updiff, downdiff = compare_state(args.appname, args.schema, args.table,
+    if table is None:
+        if action == 'downgrade':
+            raise Exception("downgrade needs a table")
+        # never migrate off a snapshot, however fresh
+        cache = cache and action != 'upgrade'
+        steps = await plan_state(appname, schema.split(','), drop=drop,
+                                 cache=cache, dsn=dsn)
+        if action == 'upgrade':
+            await set_state(appname, steps, lock_timeout=lock_timeout,
+                            dsn=dsn)
+        else:
+            print("upgrade plan looks like")
+            print('\n'.join(step.sql for step in steps))
+        return
+
+    table = get_model(appname, schema, table).db_table
+    dbstate = await schema_state(appname, schema, table, dsn=dsn)
+    modstate = model_state(appname, schema, table)
+    updiff, downdiff = compare_state(appname, schema, table,
                                      dbstate, modstate)
-    if args.action == 'upgrade':
-        await set_state(args.appname, updiff)
-    elif args.action == 'downgrade':
-        await set_state(args.appname, downdiff)
+    if action == 'upgrade':
+        await set_state(appname, updiff, lock_timeout=lock_timeout,
+                        dsn=dsn)
+    elif action == 'downgrade':
+        await set_state(appname, downdiff, lock_timeout=lock_timeout,
+                        dsn=dsn)
     else:
         print("upgrade diff looks like")
         print(updiff)
@@ -230,9 +304,13 @@ async def update_db(appname, schema, table, action):
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    asyncio.run(
+    asyncio.run(registry.closing(
         update_db(args.appname,
                   args.schema,
                   args.table,
-                  args.action)
-    )
+                  args.action,
+                  drop=args.drop,
+                  lock_timeout=args.lock_timeout,
+                  cache=args.cache,
+                  dsn=args.dsn)
+    ))
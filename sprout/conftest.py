@@ -1,16 +1,125 @@
 # -*- coding: utf-8 -*-
 # Copyright 2019, Sprout Development Team
 # Distributed under the terms of the Apache License 2.0
-"""Provide a pytest fixture for an in-memory
-database against which test can be run."""
-
-#import pytest
-#import aiosqlite
-#
-#import sprout
-#
-#@pytest.fixture
-#def mockdb(event_loop):
-#    con = await aiosqlite.connect("test.db", loop=event_loop)
-#    cur = await con.cursor()
-#
+"""Provide pytest fixtures for a database against
+which tests can be run.
+
+The application schema is built once per session. On
+postgres ($SPROUT_TEST_DSN or --sprout-dsn, a root
+connection string; pytest only sees the option when
+given the sprout directory) it is built into the app's golden
+template database (see sprout.cli.init_db) and every
+pytest-xdist worker gets its own clone of it. Without
+a server the schema is generated in an in-memory
+aiosqlite database instead.
+
+Each test then runs in a transaction that is rolled
+back afterwards, so tests see an empty schema and
+never see each other's rows. Nested transactions in a
+test become savepoints. The fixtures share the session
+event loop, so tests using them are marked with::
+
+    @pytest.mark.asyncio(loop_scope='session')
+    async def test_users(sprout_orm):
+        await User.create(..., using_db=sprout_orm)
+
+Other projects can use the fixtures with --sprout-app
+and --sprout-schemas by adding to their conftest.py::
+
+    pytest_plugins = ['sprout.conftest']
+"""
+
+import os
+import urllib.parse
+from collections import namedtuple
+
+import pytest
+import pytest_asyncio
+from tortoise import Tortoise
+from tortoise.transactions import in_transaction
+
+from sprout.core import pool
+from sprout.cli.init_db import tortoise_config, create_from_template
+
+
+SproutDB = namedtuple('SproutDB', ['backend', 'name', 'dsn', 'schemas'])
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('sprout')
+    group.addoption('--sprout-dsn', default=os.environ.get('SPROUT_TEST_DSN'),
+                    help="root postgres connection string for test databases"
+                         " (aiosqlite in memory if not given)")
+    group.addoption('--sprout-app', default='sprout',
+                    help="application whose schemas the tests use")
+    group.addoption('--sprout-schemas', default='user',
+                    help="comma separated schemas to build")
+
+
+def _url(dsn, dbname, schema=None):
+    """Point a root connection string at a database and schema."""
+    url = urllib.parse.urlsplit(dsn)
+    query = urllib.parse.parse_qsl(url.query)
+    if schema is not None:
+        query.append(('schema', schema))
+    return urllib.parse.urlunsplit((
+        'postgres', url.netloc, f"/{dbname}",
+        urllib.parse.urlencode(query), ''))
+
+
+@pytest_asyncio.fixture(scope='session', loop_scope='session')
+async def sprout_db(request):
+    """The test database of this worker, built once per session."""
+    opt = request.config.getoption
+    appname = opt('--sprout-app')
+    schemas = opt('--sprout-schemas').split(',')
+    root = opt('--sprout-dsn')
+    if root is None:
+        await Tortoise.init(config=tortoise_config(
+            appname, schemas, lambda schema: 'sqlite://:memory:'))
+        await Tortoise.generate_schemas()
+        yield SproutDB('sqlite', None, None, schemas)
+        await Tortoise.close_connections()
+        return
+    worker = os.environ.get('PYTEST_XDIST_WORKER', 'main')
+    name = f"{appname}_test_{worker}"
+    async with pool.acquire(root) as con:
+        await con.execute(f"drop database if exists {name};")
+    await create_from_template(root, appname, schemas,
+                               lambda dbname, schema: _url(root, dbname,
+                                                           schema),
+                               name=name)
+    yield SproutDB('postgres', name, _url(root, name), schemas)
+    await Tortoise.close_connections()
+    await pool.close_pool(_url(root, name))
+    async with pool.acquire(root) as con:
+        await con.execute(f"drop database if exists {name};")
+    await pool.close_pools()
+
+
+@pytest_asyncio.fixture(loop_scope='session')
+async def sprout_con(sprout_db):
+    """An asyncpg connection to the test database inside
+    a transaction rolled back after the test."""
+    if sprout_db.backend != 'postgres':
+        pytest.skip("sprout_con needs --sprout-dsn")
+    async with pool.acquire(sprout_db.dsn) as con:
+        tx = con.transaction()
+        await tx.start()
+        try:
+            yield con
+        finally:
+            await tx.rollback()
+
+
+@pytest_asyncio.fixture(loop_scope='session')
+async def sprout_orm(sprout_db):
+    """A Tortoise transaction on the first schema's connection,
+    rolled back after the test. Pass it as using_db."""
+    ctx = in_transaction(sprout_db.schemas[0])
+    client = await ctx.__aenter__()
+    try:
+        yield client
+    finally:
+        await client.rollback()
+        await ctx.__aexit__(None, None, None)
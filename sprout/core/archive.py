@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Read and write table archives: PostgreSQL binary
+COPY streams, optionally gzip or zstd compressed, and
+a json manifest of the column names and types they
+were dumped with."""
+
+import gzip
+import json
+import asyncio
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+_suffix = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+_chunk = 1 << 20
+
+
+def archive_path(appname, schema, table, compression=None):
+    """Name of the data file of a table archive."""
+    if compression not in _suffix:
+        raise Exception(f"compression not understood: {compression}")
+    return f"{appname}.orm.{schema}.{table}.bin{_suffix[compression]}"
+
+
+def manifest_path(appname, schema, table):
+    """Name of the manifest file of a table archive."""
+    return f"{appname}.orm.{schema}.{table}.json"
+
+
+def open_archive(path, mode, compression=None):
+    """Open an archive data file for binary reading
+    or writing, (de)compressing it on the fly.
+
+    Args:
+        path (str): file path
+        mode (str): 'rb' or 'wb'
+        compression (str): None, 'gzip' or 'zstd'
+
+    Returns:
+        f (file): file-like object
+    """
+    if compression is None:
+        return open(path, mode)
+    if compression == 'gzip':
+        return gzip.open(path, mode, compresslevel=6)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise Exception("zstd compression requires zstandard")
+        return zstandard.open(path, mode)
+    raise Exception(f"compression not understood: {compression}")
+
+
+def write_manifest(path, schema, table, columns, compression, rows):
+    """Record what a table archive contains.
+
+    Args:
+        path (str): manifest file
+        schema (str): schema name
+        table (str): table name
+        columns (dict): column name to type
+        compression (str): compression of the data file
+        rows (int): number of rows in the data file
+    """
+    with open(path, 'w') as f:
+        json.dump({
+            'schema': schema,
+            'table': table,
+            'format': 'binary',
+            'compression': compression,
+            'rows': rows,
+            'columns': [{'name': name, 'type': typ}
+                        for name, typ in columns.items()],
+        }, f, indent=2)
+
+
+def read_manifest(path):
+    """Read a table archive manifest."""
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+async def table_columns(con, schema, table):
+    """Get the ordered columns of a table and
+    their fully qualified types.
+
+    Args:
+        con (asyncpg.Connection): db connection
+        schema (str): schema name
+        table (str): table name
+
+    Returns:
+        cols (dict): column name to type
+    """
+    q = """select a.attname,
+pg_catalog.format_type(a.atttypid, a.atttypmod) as type
+from pg_catalog.pg_attribute a
+join pg_catalog.pg_class c on c.oid = a.attrelid
+join pg_catalog.pg_namespace n on n.oid = c.relnamespace
+where n.nspname = $1 and c.relname = $2
+and a.attnum > 0 and not a.attisdropped
+order by a.attnum;"""
+    ret = await con.fetch(q, schema, table)
+    if not ret:
+        raise Exception(f"table {schema}.{table} not found")
+    return {r['attname']: r['type'] for r in ret}
+
+
+def file_sink(f, compression=None):
+    """Make a COPY output callback writing to f. Compressed
+    writes run in the default executor to keep the loop free."""
+    if compression is None:
+        async def sink(data):
+            f.write(data)
+        return sink
+    loop = asyncio.get_running_loop()
+    async def sink(data):
+        await loop.run_in_executor(None, f.write, data)
+    return sink
+
+
+async def file_source(f):
+    """Read f in chunks as a COPY input, off the loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        data = await loop.run_in_executor(None, f.read, _chunk)
+        if not data:
+            break
+        yield data
+
+
+def quote_ident(name):
+    """Quote an SQL identifier."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+async def primary_key(con, schema, table):
+    """Get the single column primary key of a table.
+
+    Args:
+        con (asyncpg.Connection): db connection
+        schema (str): schema name
+        table (str): table name
+
+    Returns:
+        name (str): primary key column
+    """
+    q = """select a.attname from pg_catalog.pg_index i
+join pg_catalog.pg_class c on c.oid = i.indrelid
+join pg_catalog.pg_namespace n on n.oid = c.relnamespace
+join pg_catalog.pg_attribute a
+on a.attrelid = c.oid and a.attnum = any(i.indkey)
+where n.nspname = $1 and c.relname = $2 and i.indisprimary;"""
+    ret = await con.fetch(q, schema, table)
+    if len(ret) != 1:
+        raise Exception(f"{schema}.{table} needs a single column primary key")
+    return ret[0]['attname']
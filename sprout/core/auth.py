@@ -2,11 +2,21 @@
 # Copyright 2019, Sprout Development Team
 # Distributed under the terms of the Apache License 2.0
 
+import os
+import abc
 import hashlib
 import secrets
 import string
 import base64
 import hmac
+import time
+import asyncio
+import itertools
+import functools
+import weakref
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 _allowed = (string.digits +
             string.ascii_lowercase +
@@ -30,9 +40,69 @@ def from_bytes(b):
 def salted_hmac(key, value, secret):
     key = to_bytes(key)
     sec = to_bytes(secret)
-    key = hashlib.sha1(key + secret).digest()
+    key = hashlib.sha1(key + sec).digest()
     return hmac.new(key, msg=to_bytes(value),
-                    digestmethod=hashlib.sha1)
+                    digestmod=hashlib.sha1)
+
+class Signer:
+    """HMAC-SHA256 signatures under keys derived from a
+    secret, e.g. one key per purpose like 'session'.
+
+    Deriving a key and keying an hmac object costs more
+    than signing a short value, and the same few keys are
+    used over and over, so keyed hmac objects are kept in
+    a bounded LRU cache and copied for each signature.
+    The cache is safe to share between threads.
+
+    Args:
+        secret (str,bytes): secret all keys derive from
+        maxsize (int): keyed hmac objects to keep
+    """
+
+    def __init__(self, secret, maxsize=128):
+        self.secret = to_bytes(secret)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _mac(self, key):
+        """A fresh hmac object keyed for key."""
+        key = to_bytes(key)
+        with self._lock:
+            mac = self._cache.get(key)
+            if mac is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return mac.copy()
+            self.misses += 1
+        derived = hmac.new(self.secret, key, hashlib.sha256).digest()
+        mac = hmac.new(derived, digestmod=hashlib.sha256)
+        with self._lock:
+            self._cache[key] = mac
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return mac.copy()
+
+    def sign(self, key, value):
+        """Hex HMAC-SHA256 of value under key."""
+        mac = self._mac(key)
+        mac.update(to_bytes(value))
+        return mac.hexdigest()
+
+    def verify(self, key, value, signature):
+        """Whether signature is the signature of value under key."""
+        return compare(self.sign(key, value), signature)
+
+    def metrics(self):
+        """Cache size, hits, misses and hit rate."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {'size': len(self._cache), 'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.0}
 
 def pbkdf2(password, salt, iterations):
     digest = hashlib.sha256
@@ -45,35 +115,313 @@ def compare(v1, v2):
     return secrets.compare_digest(to_bytes(v1),
                                   to_bytes(v2))
 
-def mask_hash(hash_):
+def mask_hash(hash_, show=6):
     return hash_[:show] + '*' * len(hash_[show:])
 
-class PassHash:
-    algorithm = 'pbkdf2_sha256'
+_executor = None
+_executor_lock = threading.Lock()
 
-    def encode(self, password, salt, iterations=None):
+def default_executor():
+    """A thread pool shared by every PassHash, one
+    thread per core. pbkdf2_hmac releases the GIL
+    so threads hash in parallel."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                thread_name_prefix='passhash')
+    return _executor
+
+def _encode_chunk(hasher, cost, chunk):
+    return [hasher.encode(password, salt, cost) for password, salt in chunk]
+
+def _verify_chunk(chunk):
+    return [hasher.verify(password, encoded)
+            for hasher, password, encoded in chunk]
+
+def _stream(fn, items, executor, workers, chunksize, window):
+    """Map fn over chunks of items on a process pool,
+    yielding results in order. Only window chunks are
+    in flight at a time so items are consumed lazily."""
+    own = executor is None
+    if own:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    window = window or 2 * (workers or os.cpu_count() or 1)
+    items = iter(items)
+    pending = collections.deque()
+    try:
+        while True:
+            while len(pending) < window:
+                chunk = list(itertools.islice(items, chunksize))
+                if not chunk:
+                    break
+                pending.append(executor.submit(fn, chunk))
+            if not pending:
+                return
+            yield from pending.popleft().result()
+    finally:
+        for fut in pending:
+            fut.cancel()
+        if own:
+            executor.shutdown()
+
+class Hasher(abc.ABC):
+    """A password hashing algorithm. Hashes are encoded
+    as f"{algorithm}${cost}${salt}${hash}" where cost is
+    whatever makes the algorithm slower, and an encoded
+    hash is verified by the hasher its prefix names (see
+    register and get_hasher). Subclasses implement derive
+    and calibrate.
+
+    Args:
+        cost (int): cost for new hashes (default the class cost)
+    """
+    algorithm = None
+    cost = None
+
+    def __init__(self, cost=None):
+        if cost is not None:
+            self.cost = cost
+
+    @abc.abstractmethod
+    def derive(self, password, salt, cost):
+        """Hash a password with a salt at a cost.
+
+        Returns:
+            hash (bytes): the derived key
+        """
+
+    @abc.abstractmethod
+    def calibrate(self, target=0.1):
+        """Set the cost for new hashes to take about
+        target seconds on this machine.
+
+        Args:
+            target (float): seconds per hash
+
+        Returns:
+            cost (int): the new cost
+        """
+
+    def _time(self, cost):
+        start = time.perf_counter()
+        self.derive('calibrate', 'calibrate', cost)
+        return time.perf_counter() - start
+
+    def encode(self, password, salt, cost=None):
         if password is None or salt is None or '$' in salt:
             raise Exception("malformed password or salt")
-        iterations = iterations or 20000
-        hash_ = pbkdf2(password, salt, iterations)
+        cost = cost or self.cost
+        hash_ = self.derive(password, salt, cost)
         hash_ = base64.b64encode(hash_).decode('ascii').strip()
-        return f"{self.algorithm}${iterations}${salt}${hash_}"
+        return f"{self.algorithm}${cost}${salt}${hash_}"
 
-    def verify(self, password, encoded):
-        algorithm, iterations, salt, hash_ = encoded.split('$', 3)
+    def split(self, encoded):
+        algorithm, cost, salt, hash_ = encoded.split('$', 3)
         if algorithm != self.algorithm:
             raise Exception("algorithm mismatch")
-        other = self.encode(password, salt, int(iterations))
-        return compare(encoded, other)
+        return int(cost), salt, hash_
+
+    def verify(self, password, encoded):
+        cost, salt, _ = self.split(encoded)
+        return compare(encoded, self.encode(password, salt, cost))
+
+    def needs_upgrade(self, encoded):
+        cost, _, _ = self.split(encoded)
+        return cost < self.cost
+
+class PBKDF2SHA256(Hasher):
+    """pbkdf2 hmac sha256, cost is the iteration count."""
+    algorithm = 'pbkdf2_sha256'
+    cost = 20000
+
+    def derive(self, password, salt, cost):
+        return pbkdf2(password, salt, cost)
+
+    def calibrate(self, target=0.1):
+        # time scales linearly with iterations
+        probe = 10000
+        elapsed = min(self._time(probe) for _ in range(3))
+        self.cost = max(1000, int(round(probe * target / elapsed, -3)))
+        return self.cost
+
+class Scrypt(Hasher):
+    """hashlib.scrypt, cost is the power of two n with
+    block size r and parallelism p fixed."""
+    algorithm = 'scrypt'
+    cost = 2 ** 14
+    r = 8
+    p = 1
+
+    def derive(self, password, salt, cost):
+        return hashlib.scrypt(to_bytes(password), salt=to_bytes(salt),
+                              n=cost, r=self.r, p=self.p,
+                              maxmem=256 * self.r * cost, dklen=32)
+
+    def calibrate(self, target=0.1):
+        # time and memory double with n
+        cost = 2 ** 10
+        while self._time(cost) * 2 <= target:
+            cost *= 2
+        self.cost = cost
+        return self.cost
+
+hashers = {}
+
+def register(hasher):
+    """Make a hasher available by its algorithm name."""
+    hashers[hasher.algorithm] = hasher
+    return hasher
+
+def get_hasher(encoded):
+    """Get the hasher of an algorithm or of an encoded hash."""
+    algorithm = encoded.split('$', 1)[0]
+    if algorithm not in hashers:
+        raise Exception(f"unknown algorithm {algorithm}")
+    return hashers[algorithm]
+
+register(PBKDF2SHA256())
+register(Scrypt())
+
+class PassHash:
+    """Password hashing. New hashes use algorithm and
+    existing ones are verified by the hasher their prefix
+    names, so hashes made with an older algorithm or cost
+    keep working. check reports whether a hash should be
+    replaced after a successful login.
+
+    encode and verify block while they hash; aencode and
+    averify hash on an executor so that an event loop keeps
+    serving other requests. At most concurrency hashes run
+    at once on each event loop and at most queue_size more
+    wait for a slot; further callers are turned away with
+    an exception rather than queued, so that a burst of
+    logins can't pile up unbounded work.
+
+    Args:
+        algorithm (str): algorithm for new hashes
+        executor (concurrent.futures.Executor): thread or process
+                                                pool (default shared
+                                                thread pool)
+        concurrency (int): max hashes in flight (default cpu count)
+        queue_size (int): max callers waiting for a slot (None for
+                          no bound)
+    """
+    algorithm = 'pbkdf2_sha256'
+
+    def __init__(self, algorithm=None, executor=None, concurrency=None,
+                 queue_size=None):
+        self.algorithm = algorithm or self.algorithm
+        self.executor = executor
+        self.concurrency = concurrency or os.cpu_count() or 1
+        self.queue_size = queue_size
+        # event loop to its semaphore
+        self._sems = weakref.WeakKeyDictionary()
+        self._pending = 0
+
+    @property
+    def hasher(self):
+        return get_hasher(self.algorithm)
+
+    def encode(self, password, salt, iterations=None):
+        return self.hasher.encode(password, salt, iterations)
+
+    def verify(self, password, encoded):
+        return get_hasher(encoded).verify(password, encoded)
+
+    def needs_upgrade(self, encoded):
+        """Whether a hash uses another algorithm or less
+        cost than new hashes get."""
+        hasher = get_hasher(encoded)
+        if hasher.algorithm != self.algorithm:
+            return True
+        return hasher.needs_upgrade(encoded)
+
+    def check(self, password, encoded):
+        """Verify a password and tell whether its hash
+        should be replaced with encode.
+
+        Returns:
+            matched, upgrade (bool, bool): upgrade only when matched
+        """
+        matched = self.verify(password, encoded)
+        return matched, matched and self.needs_upgrade(encoded)
+
+    def encode_many(self, pairs, iterations=None, executor=None,
+                    workers=None, chunksize=256, window=None):
+        """Encode (password, salt) pairs on every core.
+
+        Args:
+            pairs (iterable): (password, salt) tuples, consumed lazily
+            iterations (int): cost (default the hasher's)
+            executor (concurrent.futures.ProcessPoolExecutor): pool to
+                use (default a pool of workers for the call)
+            workers (int): processes (default cpu count)
+            chunksize (int): pairs sent to a process at a time
+            window (int): chunks in flight (default twice the workers)
+
+        Returns:
+            encoded (generator): encoded hashes in the order of pairs
+        """
+        fn = functools.partial(_encode_chunk, self.hasher, iterations)
+        return _stream(fn, pairs, executor, workers, chunksize, window)
+
+    def verify_many(self, pairs, executor=None, workers=None,
+                    chunksize=256, window=None):
+        """Verify (password, encoded) pairs on every core.
+
+        Args:
+            pairs (iterable): (password, encoded) tuples, consumed lazily
+            executor, workers, chunksize, window: see encode_many
+
+        Returns:
+            matches (generator): bools in the order of pairs
+        """
+        # workers get the hashers, their registry may not have them
+        items = ((get_hasher(encoded), password, encoded)
+                 for password, encoded in pairs)
+        return _stream(_verify_chunk, items, executor, workers,
+                       chunksize, window)
+
+    async def _hash(self, fn, *args):
+        """Run a hash on the executor within the
+        concurrency and queue bounds."""
+        if (self.queue_size is not None and
+                self._pending >= self.concurrency + self.queue_size):
+            raise Exception("password hash queue full")
+        loop = asyncio.get_running_loop()
+        # a semaphore is bound to the loop it first waits on
+        sem = self._sems.get(loop)
+        if sem is None:
+            sem = self._sems.setdefault(
+                loop, asyncio.Semaphore(self.concurrency))
+        self._pending += 1
+        try:
+            async with sem:
+                return await loop.run_in_executor(
+                    self.executor or default_executor(), fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def aencode(self, password, salt, iterations=None):
+        return await self._hash(self.hasher.encode, password, salt,
+                                iterations)
+
+    async def averify(self, password, encoded):
+        return await self._hash(get_hasher(encoded).verify, password,
+                                encoded)
+
+    async def acheck(self, password, encoded):
+        matched = await self.averify(password, encoded)
+        return matched, matched and self.needs_upgrade(encoded)
 
     def summary(self, encoded):
-        algorithm, iterations, salt, hash_ = encoded.split('$', 3)
-        if algorithm != self.algorithm:
-            raise Exception("algorithm mismatch")
+        hasher = get_hasher(encoded)
+        cost, salt, hash_ = hasher.split(encoded)
         return {
-            'algorithm': algorithm,
-            'iterations': iterations,
+            'algorithm': hasher.algorithm,
+            'iterations': str(cost),
             'salt': mask_hash(salt),
             'hash': mask_hash(hash_)
         }
-
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Introspect the tables of one or more schemas with a
+single parametrised query against pg_catalog.
+
+The catalog is a plain dict keyed by (schema, table)
+whose values are Table tuples, so it is cheap to keep
+around, compare and serialize."""
+
+import json
+from collections import namedtuple
+
+
+Column = namedtuple('Column', ['name', 'type', 'data_type',
+                               'nullable', 'default'])
+Index = namedtuple('Index', ['name', 'columns', 'unique',
+                             'primary', 'definition'])
+Constraint = namedtuple('Constraint', ['name', 'kind', 'columns',
+                                       'references', 'definition'])
+Table = namedtuple('Table', ['schema', 'name', 'columns',
+                             'indexes', 'constraints'])
+
+
+_query = """select n.nspname as schema, c.relname as name,
+coalesce((select json_agg(json_build_array(
+    a.attname,
+    pg_catalog.format_type(a.atttypid, a.atttypmod),
+    pg_catalog.format_type(a.atttypid, null),
+    not a.attnotnull,
+    pg_catalog.pg_get_expr(d.adbin, d.adrelid)) order by a.attnum)
+  from pg_catalog.pg_attribute a
+  left join pg_catalog.pg_attrdef d
+  on d.adrelid = a.attrelid and d.adnum = a.attnum
+  where a.attrelid = c.oid and a.attnum > 0 and not a.attisdropped
+), '[]') as columns,
+coalesce((select json_agg(json_build_array(
+    ic.relname,
+    (select json_agg(a.attname order by k.ord)
+     from unnest(i.indkey) with ordinality k(attnum, ord)
+     join pg_catalog.pg_attribute a
+     on a.attrelid = c.oid and a.attnum = k.attnum),
+    i.indisunique,
+    i.indisprimary,
+    pg_catalog.pg_get_indexdef(i.indexrelid)) order by ic.relname)
+  from pg_catalog.pg_index i
+  join pg_catalog.pg_class ic on ic.oid = i.indexrelid
+  where i.indrelid = c.oid
+), '[]') as indexes,
+coalesce((select json_agg(json_build_array(
+    k.conname,
+    k.contype,
+    (select json_agg(a.attname order by u.ord)
+     from unnest(k.conkey) with ordinality u(attnum, ord)
+     join pg_catalog.pg_attribute a
+     on a.attrelid = c.oid and a.attnum = u.attnum),
+    case when k.confrelid = 0 then null else json_build_array(
+      fn.nspname, fc.relname) end,
+    pg_catalog.pg_get_constraintdef(k.oid)) order by k.conname)
+  from pg_catalog.pg_constraint k
+  left join pg_catalog.pg_class fc on fc.oid = k.confrelid
+  left join pg_catalog.pg_namespace fn on fn.oid = fc.relnamespace
+  where k.conrelid = c.oid
+), '[]') as constraints
+from pg_catalog.pg_class c
+join pg_catalog.pg_namespace n on n.oid = c.relnamespace
+where n.nspname = any($1::text[]) and c.relkind in ('r', 'p')
+order by n.nspname, c.relname;"""
+
+
+def _table(row):
+    """Build a Table from a row of the catalog query."""
+    return Table(
+        schema=row['schema'],
+        name=row['name'],
+        columns={col[0]: Column(*col)
+                 for col in json.loads(row['columns'])},
+        indexes={idx[0]: Index(idx[0], tuple(idx[1] or ()), *idx[2:])
+                 for idx in json.loads(row['indexes'])},
+        constraints={con[0]: Constraint(con[0], con[1],
+                                        tuple(con[2] or ()),
+                                        tuple(con[3]) if con[3] else None,
+                                        con[4])
+                     for con in json.loads(row['constraints'])},
+    )
+
+
+async def introspect(con, schemas):
+    """Describe every table in the given schemas.
+
+    Args:
+        con (asyncpg.Connection,asyncpg.pool.Pool): db connection or pool
+        schemas (str,list): schema name(s)
+
+    Returns:
+        catalog (dict): (schema, table) to Table
+    """
+    if isinstance(schemas, str):
+        schemas = [schemas]
+    rows = await con.fetch(_query, list(schemas))
+    return {(row['schema'], row['name']): _table(row) for row in rows}
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Checkpoint files for resumable dumps and loads.
+
+A chunked dump writes a csv file in primary key order,
+one keyset-paginated chunk at a time, and records the
+byte range, key range, row count and sha256 of every
+chunk once it is flushed to disk. The dump checkpoint
+lives next to the data as f"{path}.ckpt.json" and the
+progress of loading it as f"{path}.load.json"."""
+
+import os
+import json
+import hashlib
+
+
+def dump_checkpoint_path(path):
+    """Name of the checkpoint of a chunked dump."""
+    return f"{path}.ckpt.json"
+
+
+def load_checkpoint_path(path):
+    """Name of the checkpoint of loading a chunked dump."""
+    return f"{path}.load.json"
+
+
+def read_checkpoint(path):
+    """Read a checkpoint file if it exists.
+
+    Args:
+        path (str): checkpoint file
+
+    Returns:
+        ckpt (dict): checkpoint or None
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(path, ckpt):
+    """Atomically replace a checkpoint file.
+
+    Args:
+        path (str): checkpoint file
+        ckpt (dict): checkpoint
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(ckpt, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_chunk(f, chunk):
+    """Read the bytes of a chunk and check them
+    against the recorded checksum.
+
+    Args:
+        f (file): data file opened 'rb'
+        chunk (dict): checkpoint chunk entry
+
+    Returns:
+        data (bytes): chunk contents
+    """
+    f.seek(chunk['begin'])
+    data = f.read(chunk['end'] - chunk['begin'])
+    if hashlib.sha256(data).hexdigest() != chunk['sha256']:
+        raise Exception(f"checksum mismatch in chunk "
+                        f"{chunk['start']}..{chunk['stop']}")
+    return data
+
+
+def verify_dump(path):
+    """Check every committed chunk of a chunked dump.
+
+    Args:
+        path (str): data file
+
+    Returns:
+        bad (list): chunk entries that fail their checksum
+    """
+    ckpt = read_checkpoint(dump_checkpoint_path(path))
+    if ckpt is None:
+        raise Exception(f"no checkpoint for {path}")
+    bad = []
+    with open(path, 'rb') as f:
+        for chunk in ckpt['chunks']:
+            try:
+                read_chunk(f, chunk)
+            except Exception:
+                bad.append(chunk)
+    return bad
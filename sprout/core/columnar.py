@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Read and write columnar table dumps: Parquet files
+with a row group per batch of rows, or Arrow IPC files
+with a record batch per batch of rows. Needs pyarrow,
+which is imported the first time it is used.
+
+Every column gets the Arrow type closest to its
+PostgreSQL type, so that the values read back are the
+Python objects asyncpg encodes that type from. Types
+with no exact Arrow match (unconstrained numeric, uuid,
+json) are kept as strings. The PostgreSQL types the
+dump was made with are kept in the schema metadata."""
+
+import re
+import json
+import importlib.util
+
+
+_suffix = {'parquet': '.parquet', 'arrow': '.arrow'}
+_metadata_key = b'sprout'
+
+
+def columnar_path(appname, schema, table, fmt='parquet'):
+    """Name of the data file of a columnar dump."""
+    if fmt not in _suffix:
+        raise Exception(f"columnar format not understood: {fmt}")
+    return f"{appname}.orm.{schema}.{table}{_suffix[fmt]}"
+
+
+def available():
+    """Whether pyarrow is installed."""
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def _require():
+    """Import pyarrow on first use, it is slow to import."""
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("columnar dumps require pyarrow")
+    return pyarrow
+
+
+def arrow_type(typ):
+    """The Arrow type a PostgreSQL column is stored as.
+
+    Args:
+        typ (str): type as given by pg_catalog.format_type
+
+    Returns:
+        type (pyarrow.DataType): arrow type
+    """
+    pa = _require()
+    base = re.sub(r'\(.*?\)', '', typ)
+    simple = {
+        'smallint': pa.int16(),
+        'integer': pa.int32(),
+        'bigint': pa.int64(),
+        'real': pa.float32(),
+        'double precision': pa.float64(),
+        'boolean': pa.bool_(),
+        'text': pa.string(),
+        'character varying': pa.string(),
+        'character': pa.string(),
+        'uuid': pa.string(),
+        'json': pa.string(),
+        'jsonb': pa.string(),
+        'bytea': pa.binary(),
+        'date': pa.date32(),
+        'time without time zone': pa.time64('us'),
+        'timestamp without time zone': pa.timestamp('us'),
+        'timestamp with time zone': pa.timestamp('us', tz='UTC'),
+        'interval': pa.duration('us'),
+    }
+    if base in simple:
+        return simple[base]
+    if base == 'numeric':
+        mods = re.findall(r'\d+', typ)
+        if len(mods) == 2 and int(mods[0]) <= 38:
+            return pa.decimal128(int(mods[0]), int(mods[1]))
+        return pa.string()
+    raise Exception(f"no columnar type for {typ}")
+
+
+def arrow_schema(schema, table, columns):
+    """The Arrow schema of a table dump.
+
+    Args:
+        schema (str): schema name
+        table (str): table name
+        columns (dict): column name to type
+
+    Returns:
+        schema (pyarrow.Schema): arrow schema with the
+                                 table and its types as metadata
+    """
+    pyarrow = _require()
+    meta = json.dumps({'schema': schema, 'table': table,
+                       'columns': [{'name': name, 'type': typ}
+                                   for name, typ in columns.items()]})
+    return pyarrow.schema([pyarrow.field(name, arrow_type(typ))
+                           for name, typ in columns.items()],
+                          metadata={_metadata_key: meta})
+
+
+def _column(values, typ):
+    """Build an Arrow array from the values asyncpg
+    decoded, stringifying those kept as strings."""
+    pyarrow = _require()
+    if pyarrow.types.is_string(typ):
+        values = [v if v is None or isinstance(v, str) else str(v)
+                  for v in values]
+    return pyarrow.array(values, type=typ)
+
+
+def record_batch(schema, rows):
+    """Turn fetched rows into a record batch.
+
+    Args:
+        schema (pyarrow.Schema): schema from arrow_schema
+        rows (list): asyncpg Records or tuples in schema order
+
+    Returns:
+        batch (pyarrow.RecordBatch): the rows column by column
+    """
+    pyarrow = _require()
+    cols = list(zip(*rows)) if rows else [()] * len(schema)
+    return pyarrow.record_batch([_column(list(vals), field.type)
+                                 for vals, field in zip(cols, schema)],
+                                schema=schema)
+
+
+def open_writer(path, schema, fmt='parquet', compression=None):
+    """Open a columnar file for writing batches.
+
+    Args:
+        path (str): file path
+        schema (pyarrow.Schema): schema from arrow_schema
+        fmt (str): 'parquet' or 'arrow'
+        compression (str): None, 'gzip' ('parquet' only) or 'zstd'
+
+    Returns:
+        writer: object with write_batch(batch) and close()
+    """
+    pyarrow = _require()
+    if compression not in (None, 'gzip', 'zstd'):
+        raise Exception(f"compression not understood: {compression}")
+    if fmt == 'parquet':
+        return pyarrow.parquet.ParquetWriter(
+            path, schema, compression=compression or 'none')
+    if fmt == 'arrow':
+        if compression == 'gzip':
+            raise Exception("arrow files can't be gzip compressed")
+        options = pyarrow.ipc.IpcWriteOptions(compression=compression)
+        return pyarrow.ipc.new_file(path, schema, options=options)
+    raise Exception(f"columnar format not understood: {fmt}")
+
+
+def write_batch(writer, schema, rows):
+    """Write fetched rows as one row group or record batch."""
+    pyarrow = _require()
+    batch = record_batch(schema, rows)
+    if isinstance(writer, pyarrow.parquet.ParquetWriter):
+        writer.write_batch(batch, row_group_size=max(len(rows), 1))
+    else:
+        writer.write_batch(batch)
+
+
+def read_schema(path):
+    """Read the Arrow schema of a columnar file."""
+    pyarrow = _require()
+    if path.endswith(_suffix['parquet']):
+        return pyarrow.parquet.read_schema(path)
+    with pyarrow.ipc.open_file(pyarrow.memory_map(path)) as reader:
+        return reader.schema
+
+
+def read_metadata(path):
+    """Read the table and column types a columnar
+    file was dumped with (see arrow_schema)."""
+    meta = read_schema(path).metadata or {}
+    if _metadata_key not in meta:
+        raise Exception(f"{path} is not a sprout dump")
+    return json.loads(meta[_metadata_key])
+
+
+def iter_batches(path, columns=None):
+    """Read a columnar file one row group or
+    record batch at a time.
+
+    Args:
+        path (str): file path
+        columns (list): columns to read (default all)
+
+    Yields:
+        batch (pyarrow.RecordBatch, pyarrow.Table): the next batch
+    """
+    pyarrow = _require()
+    if path.endswith(_suffix['parquet']):
+        pf = pyarrow.parquet.ParquetFile(path)
+        for i in range(pf.num_row_groups):
+            yield pf.read_row_group(i, columns=columns)
+        return
+    with pyarrow.ipc.open_file(pyarrow.memory_map(path)) as reader:
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            yield batch if columns is None else batch.select(columns)
+
+
+def batch_records(batch):
+    """Turn a batch back into row tuples for
+    asyncpg's copy_records_to_table."""
+    return list(zip(*(col.to_pylist() for col in batch.columns)))
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Process wide counters, gauges and latency histograms.
+
+Connections opened by the pool registry (sprout.core.pool)
+are instrumented on open: every statement they run is timed
+into sprout_query_seconds and statements slower than the
+slow query threshold are logged. The registry also records
+how long callers wait to acquire a connection, how many
+connections are opened and closed, and how many are in use
+or idle; COPY based dumps and loads count the rows and bytes
+they move and migrations time each step.
+
+Stats are read through an exporter, 'dict' for a snapshot
+in process and 'prometheus' for the text exposition format,
+and more can be added with register_exporter::
+
+    from sprout.core import metrics
+    metrics.configure(slow_query=0.5)
+    print(metrics.export('prometheus'))
+"""
+
+import math
+import threading
+
+import sprout
+
+
+_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+            0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_help = {
+    'sprout_query_seconds': ('histogram', "statement latency"),
+    'sprout_query_errors_total': ('counter', "statements that failed"),
+    'sprout_slow_queries_total': ('counter', "statements over the "
+                                             "slow query threshold"),
+    'sprout_pool_acquire_seconds': ('histogram', "wait to acquire a "
+                                                 "pooled connection"),
+    'sprout_pool_connections': ('gauge', "pooled connections by state"),
+    'sprout_pool_opened_total': ('counter', "pooled connections opened"),
+    'sprout_pool_closed_total': ('counter', "pooled connections closed"),
+    'sprout_copy_rows_total': ('counter', "rows moved by COPY"),
+    'sprout_copy_bytes_total': ('counter', "bytes moved by COPY"),
+    'sprout_migration_step_seconds': ('histogram', "migration step time"),
+    'sprout_migration_retries_total': ('counter', "migration retries "
+                                                  "after lock timeouts"),
+}
+
+_lock = threading.Lock()
+# (name, labels) to value
+_counters = {}
+# (name, labels) to [bucket counts, sum, count]
+_histograms = {}
+# callables returning [(name, labels, value)] gauges
+_collectors = []
+_exporters = {}
+_slow_query = 1.0
+
+
+def configure(slow_query=1.0):
+    """Set the slow query threshold.
+
+    Args:
+        slow_query (float): seconds after which a statement is
+                            logged as slow (None to never log)
+    """
+    global _slow_query
+    _slow_query = slow_query
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Add value to a counter."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """Record a value, usually seconds, in a histogram."""
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [[0] * len(_buckets), 0.0, 0]
+        for i, bound in enumerate(_buckets):
+            if value <= bound:
+                hist[0][i] += 1
+                break
+        hist[1] += value
+        hist[2] += 1
+
+
+def add_collector(fn):
+    """Register fn, called on every export to
+    report gauges as [(name, labels, value)]."""
+    _collectors.append(fn)
+    return fn
+
+
+def reset():
+    """Forget every counter and histogram."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def copied(direction, schema, table, rows, nbytes):
+    """Count the rows and bytes a COPY moved.
+
+    Args:
+        direction (str): 'dump' or 'load'
+        schema (str): schema name
+        table (str): table name
+        rows (int): rows copied
+        nbytes (int): bytes read or written
+    """
+    labels = {'direction': direction, 'table': f"{schema}.{table}"}
+    inc('sprout_copy_rows_total', rows, **labels)
+    inc('sprout_copy_bytes_total', nbytes, **labels)
+
+
+def _log_query(record):
+    """asyncpg query logger timing every statement."""
+    words = record.query.split(None, 1)
+    labels = {'command': words[0].lower() if words else '',
+              'database': record.conn_params.database}
+    observe('sprout_query_seconds', record.elapsed, **labels)
+    if record.exception is not None:
+        inc('sprout_query_errors_total', **labels)
+    if _slow_query is not None and record.elapsed >= _slow_query:
+        inc('sprout_slow_queries_total', **labels)
+        query = ' '.join(record.query.split())
+        sprout.cfg.log.warning(f"slow query {record.elapsed:.3f}s "
+                               f"({labels['database']}): {query[:1000]}")
+
+
+def instrument(con):
+    """Time every statement a connection runs."""
+    con.add_query_logger(_log_query)
+
+
+def snapshot():
+    """Current stats as plain data.
+
+    Returns:
+        stats (dict): 'counters', 'gauges' and 'histograms', each
+                      name to a list of dicts with 'labels' and
+                      'value', or 'buckets', 'sum' and 'count'
+    """
+    gauges = []
+    for fn in list(_collectors):
+        gauges.extend(fn())
+    stats = {'counters': {}, 'gauges': {}, 'histograms': {}}
+    with _lock:
+        for (name, labels), value in sorted(_counters.items()):
+            stats['counters'].setdefault(name, []).append(
+                {'labels': dict(labels), 'value': value})
+        for (name, labels), (counts, total, count) in sorted(
+                _histograms.items()):
+            cumulative, buckets = 0, {}
+            for bound, n in zip(_buckets, counts):
+                cumulative += n
+                buckets[bound] = cumulative
+            buckets[math.inf] = count
+            stats['histograms'].setdefault(name, []).append(
+                {'labels': dict(labels), 'buckets': buckets,
+                 'sum': total, 'count': count})
+    for name, labels, value in gauges:
+        stats['gauges'].setdefault(name, []).append(
+            {'labels': dict(labels), 'value': value})
+    return stats
+
+
+def _labels(labels, **extra):
+    """Prometheus label set."""
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    def esc(val):
+        return (str(val).replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n'))
+    return '{' + ','.join(f'{key}="{esc(val)}"'
+                          for key, val in labels.items()) + '}'
+
+
+def _num(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def prometheus(stats=None):
+    """Current stats in the Prometheus text format."""
+    stats = stats or snapshot()
+    lines = []
+    for kind in ('counters', 'gauges', 'histograms'):
+        for name, series in stats[kind].items():
+            typ, text = _help.get(name, (kind[:-1], name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {typ}")
+            for s in series:
+                if kind != 'histograms':
+                    lines.append(f"{name}{_labels(s['labels'])} "
+                                 f"{_num(s['value'])}")
+                    continue
+                for bound, n in s['buckets'].items():
+                    le = _labels(s['labels'], le=_num(bound))
+                    lines.append(f"{name}_bucket{le} {n}")
+                lines.append(f"{name}_sum{_labels(s['labels'])} "
+                             f"{_num(s['sum'])}")
+                lines.append(f"{name}_count{_labels(s['labels'])} "
+                             f"{s['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+def register_exporter(name, fn):
+    """Make fn(stats) available as export(name)."""
+    _exporters[name] = fn
+
+
+def export(fmt='dict'):
+    """Export the current stats.
+
+    Args:
+        fmt (str): 'dict', 'prometheus' or a registered exporter
+
+    Returns:
+        stats: whatever the exporter makes of the snapshot
+    """
+    if fmt not in _exporters:
+        raise Exception(f"no metrics exporter {fmt}")
+    return _exporters[fmt](snapshot())
+
+
+register_exporter('dict', lambda stats: stats)
+register_exporter('prometheus', prometheus)
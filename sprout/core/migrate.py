@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Execute a migration plan without stalling production.
+
+Every step that can run in a transaction runs in a
+single one, so a failure leaves the database as it
+was. Lock waits are capped by lock_timeout; a step
+that can't get its lock in time rolls the attempt
+back and the whole transaction is retried with
+exponential backoff rather than queueing writers
+behind an ACCESS EXCLUSIVE request. Concurrent index
+builds, unique constraints using those indexes and
+constraint validation, which can't run in or don't
+need the transaction, follow it, as do
+the steps setting backfilled columns NOT NULL, so that
+one failing on remaining NULLs keeps the rest."""
+
+import time
+import random
+import asyncio
+from collections import namedtuple
+
+import asyncpg
+
+import sprout
+from sprout.core import metrics
+from sprout.core.plan import Step
+from sprout.core.archive import quote_ident
+
+
+# steps that must or should run outside the migration transaction
+_online = ('create_index', 'add_unique', 'validate_constraint',
+           'set_not_null')
+
+Timing = namedtuple('Timing', ['step', 'seconds', 'attempts'])
+
+
+def _ms(seconds):
+    """Format seconds as a postgres time setting."""
+    return '0' if seconds is None else f"{int(seconds * 1000)}ms"
+
+
+async def _retry(fn, name, retries, backoff):
+    """Await fn() again while it fails to get a lock."""
+    for attempt in range(1, retries + 2):
+        try:
+            return await fn(), attempt
+        except asyncpg.exceptions.LockNotAvailableError as e:
+            if attempt > retries:
+                raise
+            wait = backoff * 2 ** (attempt - 1) * (1 + random.random())
+            sprout.cfg.log.warning(f"{name}: {e}; retry in {wait:.2f}s")
+            await asyncio.sleep(wait)
+
+
+async def _timed(con, sql):
+    """Execute sql and return how long it took."""
+    start = time.perf_counter()
+    await con.execute(sql)
+    return time.perf_counter() - start
+
+
+async def run_plan(con, steps, lock_timeout=5.0, statement_timeout=None,
+                   retries=5, backoff=0.5):
+    """Run the steps of a migration plan.
+
+    Args:
+        con (asyncpg.Connection): db connection
+        steps (list): sprout.core.plan.Step tuples
+        lock_timeout (float): seconds a statement may wait for a lock
+        statement_timeout (float): seconds a statement may run (no limit)
+        retries (int): retries after a lock timeout
+        backoff (float): seconds before the first retry, doubling
+
+    Returns:
+        timings (list): Timing per step
+    """
+    tx = [step for step in steps if step.kind not in _online]
+    online = [step for step in steps if step.kind in _online]
+    timings = []
+
+    async def migrate():
+        timings.clear()
+        async with con.transaction():
+            await con.execute(
+                "select set_config('lock_timeout', $1, true),"
+                " set_config('statement_timeout', $2, true);",
+                _ms(lock_timeout), _ms(statement_timeout))
+            for step in tx:
+                timings.append([step, await _timed(con, step.sql)])
+
+    if tx:
+        _, attempts = await _retry(migrate, 'migration', retries, backoff)
+        metrics.inc('sprout_migration_retries_total', attempts - 1,
+                    kind='transaction')
+        timings = [Timing(step, sec, attempts) for step, sec in timings]
+    await con.execute(
+        "select set_config('lock_timeout', $1, false),"
+        " set_config('statement_timeout', $2, false);",
+        _ms(lock_timeout), _ms(statement_timeout))
+    try:
+        for step in online:
+            async def run():
+                try:
+                    return await _timed(con, step.sql)
+                except Exception:
+                    if step.kind == 'create_index':
+                        # a failed concurrent build leaves an invalid index
+                        words = step.sql.split()
+                        name = words[words.index('concurrently') + 1]
+                        try:
+                            await con.execute(
+                                f"drop index concurrently if exists"
+                                f" {quote_ident(step.schema)}.{name};")
+                        except Exception as e:
+                            # keep the error of the build, not the cleanup
+                            sprout.cfg.log.error(
+                                f"dropping invalid index {name} failed: {e}")
+                    raise
+            sec, attempts = await _retry(run, step.sql, retries, backoff)
+            metrics.inc('sprout_migration_retries_total', attempts - 1,
+                        kind=step.kind)
+            timings.append(Timing(step, sec, attempts))
+    finally:
+        await con.execute("reset lock_timeout; reset statement_timeout;")
+    for timing in timings:
+        sprout.cfg.log.info(f"{timing.seconds:.3f}s "
+                            f"({timing.attempts}): {timing.step.sql}")
+        metrics.observe('sprout_migration_step_seconds', timing.seconds,
+                        kind=timing.step.kind)
+    return timings
+
+
+def sql_steps(diff):
+    """Wrap a raw sql diff as a single plan step."""
+    return [Step('sql', None, None, diff)]
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Locate the Tortoise ORM models of an application
+organized like f"{appname}.orm.{schema}.{table}".
+
+The orm package of an application is walked once and
+indexed by schema and table module, with the database
+table, columns, fields and foreign keys of every model
+worked out up front.
+The index is kept per application and is rebuilt, with
+changed modules reloaded, only when a module under the
+orm package is added, removed or modified."""
+
+import os
+import pkgutil
+import importlib
+import importlib.util
+import threading
+from collections import namedtuple
+
+from tortoise.models import Model
+
+
+ModelField = namedtuple('ModelField', ['name', 'column', 'field',
+                                       'references'])
+ModelInfo = namedtuple('ModelInfo', ['schema', 'table', 'module', 'model',
+                                     'fields', 'deps', 'db_table'])
+
+# appname to (file stamps, index)
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _orm_files(appname, schema=None):
+    """Stat the modules of an application's orm package,
+    or of one schema in it, without importing anything."""
+    spec = importlib.util.find_spec(f"{appname}.orm")
+    if spec is None or not spec.submodule_search_locations:
+        raise Exception(f"{appname}.orm not found")
+    stamps = {}
+    for root in spec.submodule_search_locations:
+        if schema is not None:
+            root = os.path.join(root, schema)
+        for path, dirs, files in os.walk(root):
+            dirs[:] = [d for d in dirs if d != '__pycache__']
+            for name in files:
+                if name.endswith('.py'):
+                    full = os.path.join(path, name)
+                    st = os.stat(full)
+                    stamps[full] = (st.st_mtime_ns, st.st_size)
+    if schema is not None and not stamps:
+        raise Exception(f"{appname}.orm.{schema} not found")
+    return stamps
+
+
+def model_fields(model):
+    """The columns of a model in declaration order,
+    foreign keys as their f"{name}_id" column and
+    without the reverse side of relations.
+
+    Args:
+        model (tortoise.models.Model): ORM model
+
+    Returns:
+        fields (list): ModelField tuples, references is the
+                       referenced model name for foreign keys
+    """
+    meta = model._meta
+    fks = meta.fk_fields | meta.o2o_fields
+    reverse = (meta.backward_fk_fields | meta.backward_o2o_fields
+               | meta.m2m_fields)
+    sources = {meta.fields_map[name].source_field or f"{name}_id"
+               for name in fks}
+    fields = []
+    for name, field in meta.fields_map.items():
+        if name in reverse or name in sources:
+            continue
+        if name in fks:
+            fields.append(ModelField(name, field.source_field or
+                                     f"{name}_id", field, field.model_name))
+        elif not hasattr(field, 'model_name'):
+            fields.append(ModelField(name, field.source_field or name,
+                                     field, None))
+    return fields
+
+
+def db_table(model):
+    """The table Tortoise creates for a model: Meta.table
+    or the lowercased class name, e.g. orderitem for
+    OrderItem whatever its module is called."""
+    return model._meta.db_table or model.__name__.lower()
+
+
+def _find_model(mod):
+    for obj in vars(mod).values():
+        if (isinstance(obj, type) and issubclass(obj, Model)
+                and obj.__module__ == mod.__name__):
+            return obj
+    return None
+
+
+def _import(name, path, stale):
+    """Import a module, reloading it if its file changed."""
+    mod = importlib.import_module(name)
+    if path in stale:
+        mod = importlib.reload(mod)
+    return mod
+
+
+def _index(appname, stamps, old):
+    """Import the orm package of an application and
+    index its models."""
+    importlib.invalidate_caches()
+    stale = {path for path, stamp in stamps.items()
+             if path in old and old[path] != stamp}
+    orm = importlib.import_module(f"{appname}.orm")
+    index = {}
+    for pkg in pkgutil.iter_modules(orm.__path__):
+        if not pkg.ispkg:
+            continue
+        schema = pkg.name
+        spkg = _import(f"{orm.__name__}.{schema}",
+                       os.path.join(pkg.module_finder.path, schema,
+                                    '__init__.py'), stale)
+        models = {}
+        for info in pkgutil.iter_modules(spkg.__path__):
+            if info.ispkg:
+                continue
+            name = f"{spkg.__name__}.{info.name}"
+            path = os.path.join(info.module_finder.path, f"{info.name}.py")
+            model = _find_model(_import(name, path, stale))
+            if model is not None:
+                models[info.name] = (name, model)
+        tables = {model.__name__: table
+                  for table, (_, model) in models.items()}
+        index[schema] = {}
+        for table, (name, model) in models.items():
+            fields = model_fields(model)
+            deps = {tables[fld.references.split('.')[-1]]
+                    for fld in fields if fld.references
+                    and fld.references.split('.')[-1] in tables}
+            deps.discard(table)
+            index[schema][table] = ModelInfo(schema, table, name, model,
+                                             fields, deps, db_table(model))
+    return index
+
+
+def model_registry(appname):
+    """Get the index of an application's models,
+    building it on first use and again whenever a
+    module under its orm package changes.
+
+    Args:
+        appname (str): application name
+
+    Returns:
+        registry (dict): schema to table to ModelInfo
+    """
+    stamps = _orm_files(appname)
+    with _registry_lock:
+        hit = _registry.get(appname)
+        if hit is not None and hit[0] == stamps:
+            return hit[1]
+        index = _index(appname, stamps, hit[0] if hit else {})
+        _registry[appname] = (stamps, index)
+        return index
+
+
+def schema_models(appname, schema):
+    """Get the registered models of a schema.
+
+    Args:
+        appname (str): application name
+        schema (str): schema name
+
+    Returns:
+        tables (dict): table (module) name to ModelInfo
+    """
+    tables = model_registry(appname).get(schema)
+    if tables is None:
+        raise Exception(f"{appname}.orm.{schema} not found")
+    return tables
+
+
+def get_model(appname, schema, table):
+    """Get the registered model of a table.
+
+    Args:
+        appname (str): application name
+        schema (str): schema name
+        table (str): table module or database table name
+
+    Returns:
+        info (ModelInfo): the model and what is known about it
+    """
+    tables = schema_models(appname, schema)
+    info = tables.get(table)
+    if info is None:
+        info = next((info for info in tables.values()
+                     if info.db_table == table), None)
+    if info is None:
+        raise Exception(f"no model for {appname}.orm.{schema}.{table}")
+    return info
+
+
+def discover_models(appname, schema):
+    """Collect the ORM model defined in every table
+    module of an application schema.
+
+    Args:
+        appname (str): application name
+        schema (str): schema name
+
+    Returns:
+        models (dict): database table name to Model class
+    """
+    return {info.db_table: info.model
+            for info in schema_models(appname, schema).values()}
+
+
+def dependency_order(deps):
+    """Sort tables so that every table comes after
+    those it references.
+
+    Args:
+        deps (dict): table name to the set of tables it references
+
+    Returns:
+        order (list): table names
+    """
+    order, left = [], {key: set(val) for key, val in deps.items()}
+    while left:
+        ready = sorted(key for key, val in left.items()
+                       if not val & left.keys())
+        if not ready:
+            raise Exception(f"foreign key cycle among {sorted(left)}")
+        order.extend(ready)
+        for key in ready:
+            left.pop(key)
+    return order
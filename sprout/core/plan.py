@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Plan schema migrations by diffing two catalogs.
+
+The ORM models of an application are described with
+the same structure sprout.core.catalog.introspect
+returns for the database, so a plan from one state
+to the other is a matter of dict lookups. All column
+changes to a table are merged into a single
+``ALTER TABLE`` to keep table rewrites and lock
+windows to a minimum. Foreign keys are added NOT VALID
+and validated in a separate step, and indexes are built
+CONCURRENTLY, unique constraints included, which are then
+attached to their index, so that neither holds a lock
+that blocks writes while it scans the table (see
+sprout.core.migrate).
+New columns are added with their default or as NULL and
+only tightened to NOT NULL in a last step, after the
+data has been backfilled."""
+
+import decimal
+from collections import namedtuple
+
+from tortoise import fields
+
+from sprout.core.catalog import Column, Index, Constraint, Table
+from sprout.core.archive import quote_ident
+from sprout.core.models import schema_models, dependency_order
+
+
+pg_type_map = {
+    fields.IntField: 'integer',
+    fields.BigIntField: 'bigint',
+    fields.SmallIntField: 'smallint',
+    fields.CharField: 'character varying',
+    fields.TextField: 'text',
+    fields.BooleanField: 'boolean',
+    fields.DecimalField: 'numeric',
+    fields.DatetimeField: 'timestamp with time zone',
+    fields.DateField: 'date',
+    fields.TimeField: 'time with time zone',
+    fields.BinaryField: 'bytea',
+    fields.TimeDeltaField: 'bigint',
+    fields.FloatField: 'double precision',
+    fields.JSONField: 'jsonb',
+    fields.UUIDField: 'uuid',
+}
+
+_identity = ('integer', 'bigint', 'smallint')
+
+
+Step = namedtuple('Step', ['kind', 'schema', 'table', 'sql'])
+
+
+def pg_type(field):
+    """Get the postgres type of an ORM field.
+
+    Args:
+        field (tortoise.fields.Field): data field
+
+    Returns:
+        type, data_type (str, str): type with and without modifiers
+    """
+    for cls in type(field).__mro__:
+        if cls in pg_type_map:
+            base = pg_type_map[cls]
+            break
+    else:
+        raise Exception(f"no postgres type for {type(field).__name__}")
+    if cls is fields.CharField:
+        return f"{base}({field.max_length})", base
+    if cls is fields.DecimalField:
+        return f"{base}({field.max_digits},{field.decimal_places})", base
+    return base, base
+
+
+def _default(field):
+    """The SQL literal of a constant field default, None
+    if the field has no default or a callable one."""
+    value = field.default
+    if value is None or callable(value):
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return None
+
+
+def _on_delete(field):
+    """The ON DELETE clause of a foreign key field,
+    as Tortoise creates it (CASCADE by default)."""
+    action = getattr(field.on_delete, 'value', field.on_delete)
+    if not action or action.upper() == 'NO ACTION':
+        return ''
+    return f" ON DELETE {action.upper()}"
+
+
+def _qualified(schema, table):
+    """Quoted schema qualified table name."""
+    return f"{quote_ident(schema)}.{quote_ident(table)}"
+
+
+def _columns(cols):
+    """Quoted comma separated column list."""
+    return ', '.join(quote_ident(col) for col in cols)
+
+
+def model_catalog(appname, schemas):
+    """Describe the tables defined by the ORM models of
+    an application like introspect describes the db.
+
+    Args:
+        appname (str): application name
+        schemas (str,list): schema name(s)
+
+    Returns:
+        catalog (dict): (schema, table) to sprout.core.catalog.Table
+    """
+    if isinstance(schemas, str):
+        schemas = [schemas]
+    models = {schema: schema_models(appname, schema) for schema in schemas}
+    owners = {info.model.__name__: (schema, info.db_table)
+              for schema, tables in models.items()
+              for info in tables.values()}
+    pks = {}
+    for schema, tables in models.items():
+        for info in tables.values():
+            for fld in info.fields:
+                if fld.field.pk:
+                    pks[(schema, info.db_table)] = (fld.column,
+                                                    pg_type(fld.field))
+    catalog = {}
+    for schema, tables in models.items():
+        for info in tables.values():
+            # tables are named as Tortoise names them, not by module
+            table = info.db_table
+            o2o = info.model._meta.o2o_fields
+            cols, idxs, cons = {}, {}, {}
+            for name, col, field, references in info.fields:
+                if references is not None:
+                    ref = owners.get(references.split('.')[-1])
+                    if ref is None or ref not in pks:
+                        raise Exception(f"{schema}.{table}.{name} references"
+                                        f" unknown model {references}")
+                    refpk, (typ, base) = pks[ref]
+                    cons[f"{table}_{col}_fkey"] = Constraint(
+                        f"{table}_{col}_fkey", 'f', (col,), ref,
+                        f"FOREIGN KEY ({quote_ident(col)}) REFERENCES "
+                        f"{_qualified(*ref)}({quote_ident(refpk)})"
+                        f"{_on_delete(field)}")
+                    if name in o2o:
+                        cons[f"{table}_{col}_key"] = Constraint(
+                            f"{table}_{col}_key", 'u', (col,), None,
+                            f"UNIQUE ({quote_ident(col)})")
+                else:
+                    typ, base = pg_type(field)
+                    if field.pk:
+                        cons[f"{table}_pkey"] = Constraint(
+                            f"{table}_pkey", 'p', (col,), None,
+                            f"PRIMARY KEY ({quote_ident(col)})")
+                    elif field.unique:
+                        cons[f"{table}_{col}_key"] = Constraint(
+                            f"{table}_{col}_key", 'u', (col,), None,
+                            f"UNIQUE ({quote_ident(col)})")
+                    elif getattr(field, 'index', False):
+                        idx = f"{table}_{col}_idx"
+                        idxs[idx] = Index(
+                            idx, (col,), False, False,
+                            f"CREATE INDEX {quote_ident(idx)} ON "
+                            f"{_qualified(schema, table)} ({quote_ident(col)})")
+                cols[col] = Column(col, typ, base,
+                                   bool(field.null) and not field.pk,
+                                   None if references else _default(field))
+            catalog[(schema, table)] = Table(schema, table, cols, idxs, cons)
+    return catalog
+
+
+def _fks(tbl):
+    """Foreign keys keyed by their columns."""
+    return {con.columns: con for con in tbl.constraints.values()
+            if con.kind == 'f'}
+
+
+def _uniques(tbl):
+    """Unique constraints keyed by their columns."""
+    return {con.columns: con for con in tbl.constraints.values()
+            if con.kind == 'u'}
+
+
+def _indexes(tbl):
+    """Plain indexes, i.e. those not backing a constraint."""
+    backed = {con.name for con in tbl.constraints.values()}
+    return {idx.columns: idx for idx in tbl.indexes.values()
+            if not idx.primary and not idx.unique
+            and idx.name not in backed}
+
+
+def _create_table(tbl):
+    """Create a table with its columns and primary key."""
+    pk = [con for con in tbl.constraints.values() if con.kind == 'p']
+    pkcols = pk[0].columns if pk else ()
+    lines = []
+    for col in tbl.columns.values():
+        line = f"{quote_ident(col.name)} {col.type}"
+        if pkcols == (col.name,) and col.type in _identity:
+            line += " generated by default as identity"
+        if not col.nullable:
+            line += " not null"
+        lines.append(line)
+    if pkcols:
+        lines.append(f"primary key ({_columns(pkcols)})")
+    body = ',\n  '.join(lines)
+    return f"create table {_qualified(tbl.schema, tbl.name)} (\n  {body}\n);"
+
+
+def _alter_table(cur, tgt, drop):
+    """Merge all column changes to a table into one clause list.
+
+    A new column without a default is added nullable, since
+    a NOT NULL one fails on a table with rows. Columns that
+    become NOT NULL are returned separately, to be set once
+    the data is backfilled.
+
+    Returns:
+        clauses, not_null (list, list): alter table clauses
+                                        and columns to set not null
+    """
+    clauses, not_null = [], []
+    if drop:
+        for name in cur.columns:
+            if name not in tgt.columns:
+                clauses.append(f"drop column {quote_ident(name)}")
+    for name, col in tgt.columns.items():
+        have = cur.columns.get(name)
+        ident = quote_ident(name)
+        if have is None:
+            line = f"add column {ident} {col.type}"
+            if col.default is not None:
+                line += f" default {col.default}"
+                if not col.nullable:
+                    line += " not null"
+            elif not col.nullable:
+                not_null.append(name)
+            clauses.append(line)
+            continue
+        if have.type != col.type:
+            clauses.append(f"alter column {ident} type {col.type}"
+                           f" using {ident}::{col.type}")
+        if have.nullable and not col.nullable:
+            not_null.append(name)
+        elif not have.nullable and col.nullable:
+            clauses.append(f"alter column {ident} drop not null")
+    return clauses, not_null
+
+
+def plan(current, target, drop=False):
+    """Plan the statements that take a database from
+    the current catalog to the target catalog.
+
+    The plan creates missing tables in foreign key
+    order, then issues at most one ``ALTER TABLE`` per
+    existing table for its column changes, then adds
+    constraints, builds indexes, turns the unique ones
+    into constraints and validates foreign keys. Columns
+    that become NOT NULL without a default are set so in
+    separate steps at the very end, which fail until their
+    NULLs are backfilled. Nothing is dropped unless drop
+    is True, in which case stale constraints, indexes,
+    columns and tables are dropped as well.
+
+    Args:
+        current (dict): catalog of the database as it is
+        target (dict): catalog of the database as it should be
+        drop (bool): also drop what the target lacks
+
+    Returns:
+        steps (list): ordered Step tuples
+    """
+    creates, alters, adds, indexes, drops = [], [], [], [], []
+    uniques, validates, not_nulls = [], [], []
+    deps = {key: {con.references for con in _fks(tbl).values()
+                  if con.references != key
+                  and con.references in target
+                  and con.references not in current}
+            for key, tbl in target.items() if key not in current}
+    for key in dependency_order(deps):
+        tbl = target[key]
+        creates.append(Step('create_table', *key, _create_table(tbl)))
+    for key, tgt in target.items():
+        cur = current.get(key)
+        name = _qualified(*key)
+        if cur is None:
+            cur = Table(*key, dict(tgt.columns), {},
+                        {con.name: con for con in tgt.constraints.values()
+                         if con.kind == 'p'})
+        else:
+            clauses, not_null = _alter_table(cur, tgt, drop)
+            if clauses:
+                body = ',\n  '.join(clauses)
+                alters.append(Step('alter_table', *key,
+                                   f"alter table {name}\n  {body};"))
+            for col in not_null:
+                not_nulls.append(Step('set_not_null', *key,
+                                      f"alter table {name} alter column "
+                                      f"{quote_ident(col)} set not null;"))
+        for kind, have, want in [('f', _fks(cur), _fks(tgt)),
+                                 ('u', _uniques(cur), _uniques(tgt))]:
+            for cols, con in want.items():
+                if cols in have:
+                    continue
+                ident = quote_ident(con.name)
+                if kind == 'f':
+                    adds.append(Step('add_constraint', *key,
+                                     f"alter table {name} add constraint "
+                                     f"{ident} {con.definition} not valid;"))
+                    validates.append(Step('validate_constraint', *key,
+                                          f"alter table {name} validate "
+                                          f"constraint {ident};"))
+                else:
+                    indexes.append(Step('create_index', *key,
+                                        f"create unique index concurrently "
+                                        f"{ident} on {name} "
+                                        f"({_columns(cols)});"))
+                    uniques.append(Step('add_unique', *key,
+                                        f"alter table {name} add constraint "
+                                        f"{ident} unique using index "
+                                        f"{ident};"))
+            if drop:
+                for cols, con in have.items():
+                    if cols not in want:
+                        drops.append(Step('drop_constraint', *key,
+                                          f"alter table {name} drop "
+                                          f"constraint {quote_ident(con.name)};"))
+        have, want = _indexes(cur), _indexes(tgt)
+        for cols, idx in want.items():
+            if cols not in have:
+                indexes.append(Step('create_index', *key,
+                                    f"create index concurrently "
+                                    f"{quote_ident(idx.name)} "
+                                    f"on {name} ({_columns(cols)});"))
+        if drop:
+            for cols, idx in have.items():
+                if cols not in want:
+                    drops.append(Step('drop_index', *key,
+                                      f"drop index {quote_ident(key[0])}."
+                                      f"{quote_ident(idx.name)};"))
+    tables = []
+    if drop:
+        stale = {key: {con.references for con in _fks(tbl).values()
+                       if con.references != key}
+                 for key, tbl in current.items() if key not in target}
+        stale = {key: refs & stale.keys() for key, refs in stale.items()}
+        for key in reversed(dependency_order(stale)):
+            tables.append(Step('drop_table', *key,
+                               f"drop table {_qualified(*key)};"))
+    # constraints and indexes go before the columns they cover
+    return (drops + creates + alters + adds + tables + indexes + uniques
+            + validates + not_nulls)
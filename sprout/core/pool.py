@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""A process wide registry of asyncpg connection pools.
+
+Pools are keyed by (dsn, database) and created lazily
+on first use, opening min_size connections up front so
+that the first callers don't pay for connection setup,
+TLS and auth. Every sprout entry point borrows from the
+registry rather than opening its own connections.
+
+Registered pools report to sprout.core.metrics: their
+connections time every statement, and the registry counts
+connections opened and closed, times acquire waits and
+reports in use and idle connections."""
+
+import os
+import time
+import asyncio
+import functools
+import contextlib
+import urllib.parse
+from collections import namedtuple
+
+import asyncpg
+
+import sprout
+from sprout.core import metrics
+
+
+_Entry = namedtuple('_Entry', ['loop', 'task', 'max_lifetime'])
+
+_pools = {}
+# (pool key, server pid) to the time the connection was opened
+_born = {}
+
+_pool_keys = ('min_size', 'max_size', 'max_queries',
+              'max_inactive_connection_lifetime',
+              'statement_cache_size')
+
+
+def pool_opts(cfg):
+    """Pick the pool sizing options out of a db config.
+
+    Args:
+        cfg (dict): db config as in conf/db.yml
+
+    Returns:
+        opts (dict): keyword arguments for get_pool
+    """
+    return {key: cfg[key] for key in _pool_keys + ('max_lifetime',)
+            if key in cfg}
+
+
+def dsn_from_opts(opts):
+    """Build a connection string from db options.
+
+    Args:
+        opts (dict): host, port, username or user, password, database
+
+    Returns:
+        dsn (str): postgres connection string
+    """
+    user = urllib.parse.quote(opts.get('username', opts.get('user')), safe='')
+    auth = user
+    if opts.get('password'):
+        auth += f":{urllib.parse.quote(str(opts['password']), safe='')}"
+    return (f"postgres://{auth}@{opts['host']}:{opts['port']}"
+            f"/{opts['database']}")
+
+
+def app_dsn(appname, config=None, env='local'):
+    """Build the connection string of an application
+    database from a db config.
+
+    Args:
+        appname (str): application (database) name
+        config (str,dict): db config or path to it
+                           (default sprout/conf/db.yml)
+        env (str): key in config if it's nested
+
+    Returns:
+        dsn (str): postgres connection string
+    """
+    if config is None:
+        config = os.path.join(sprout._root, 'conf', 'db.yml')
+    if isinstance(config, str):
+        config = sprout.load_yml(config, cache=True)
+    if env is not None and env in config:
+        config = config[env]
+    if not config:
+        raise Exception("db config not understood")
+    return dsn_from_opts(dict(config, database=appname))
+
+
+def _label(dsn, database):
+    """Name a pool's database for metrics, without credentials."""
+    return database or urllib.parse.urlparse(dsn).path.lstrip('/')
+
+
+def _closed(key, pid, con):
+    """Forget a pooled connection once it is closed."""
+    _born.pop((key, pid), None)
+    metrics.inc('sprout_pool_closed_total', database=_label(*key))
+
+
+async def _init(key, con):
+    """Note when a pooled connection was opened
+    and instrument it."""
+    pid = con.get_server_pid()
+    _born[(key, pid)] = time.monotonic()
+    metrics.inc('sprout_pool_opened_total', database=_label(*key))
+    metrics.instrument(con)
+    # the pid is taken now, the pool may have released con by then
+    con.add_termination_listener(functools.partial(_closed, key, pid))
+
+
+async def _create(dsn, database, min_size, max_size, **opts):
+    """Open a pool and its first min_size connections."""
+    if database is not None:
+        opts['database'] = database
+    sprout.cfg.log.debug(f"pool init {database or ''} "
+                         f"({min_size}..{max_size})")
+    init = functools.partial(_init, (dsn, database))
+    return await asyncpg.create_pool(dsn, min_size=min_size,
+                                     max_size=max_size,
+                                     init=init, **opts)
+
+
+@metrics.add_collector
+def _collect():
+    """In use and idle connections of the ready pools."""
+    gauges = []
+    for (dsn, database), entry in list(_pools.items()):
+        task = entry.task
+        if not task.done() or task.cancelled() or task.exception():
+            continue
+        pool = task.result()
+        label = _label(dsn, database)
+        idle = pool.get_idle_size()
+        gauges.append(('sprout_pool_connections',
+                       {'database': label, 'state': 'in_use'},
+                       pool.get_size() - idle))
+        gauges.append(('sprout_pool_connections',
+                       {'database': label, 'state': 'idle'}, idle))
+    return gauges
+
+
+async def get_pool(dsn, database=None, min_size=1, max_size=10,
+                   max_queries=50000, max_inactive_connection_lifetime=300.0,
+                   statement_cache_size=100, max_lifetime=3600.0):
+    """Get the registered pool for a database, creating
+    it on first use. Options only apply to the call that
+    creates the pool. Pools are bound to the event loop
+    they were created on; a pool from a loop that is no
+    longer current is replaced.
+
+    Args:
+        dsn (str): connection string
+        database (str): database to use instead of the one in dsn
+        min_size (int): connections opened up front and kept
+        max_size (int): max connections
+        max_queries (int): queries before a connection is replaced
+        max_inactive_connection_lifetime (float): seconds before an idle
+                                                  connection is closed
+        statement_cache_size (int): prepared statements kept per connection
+        max_lifetime (float): seconds before a connection is replaced
+                              on release through acquire (None to keep)
+
+    Returns:
+        pool (asyncpg.pool.Pool): connection pool
+    """
+    loop = asyncio.get_running_loop()
+    key = (dsn, database)
+    entry = _pools.get(key)
+    if entry is not None and entry.loop is not loop:
+        entry = None
+    if entry is None:
+        task = loop.create_task(_create(
+            dsn, database, min_size, max_size, max_queries=max_queries,
+            max_inactive_connection_lifetime=max_inactive_connection_lifetime,
+            statement_cache_size=statement_cache_size))
+        entry = _Entry(loop, task, max_lifetime)
+        _pools[key] = entry
+    try:
+        return await asyncio.shield(entry.task)
+    except Exception:
+        if _pools.get(key) is entry:
+            _pools.pop(key)
+        raise
+
+
+@contextlib.asynccontextmanager
+async def acquire(dsn, database=None, **opts):
+    """Borrow a connection from the registered pool,
+    replacing it on release once it is older than the
+    pool's max_lifetime.
+
+    Args:
+        dsn (str): connection string
+        database (str): database to use instead of the one in dsn
+        opts (dict): see get_pool
+    """
+    pool = await get_pool(dsn, database, **opts)
+    lifetime = _pools[(dsn, database)].max_lifetime
+    start = time.monotonic()
+    async with pool.acquire() as con:
+        metrics.observe('sprout_pool_acquire_seconds',
+                        time.monotonic() - start,
+                        database=_label(dsn, database))
+        yield con
+        born = ((dsn, database), con.get_server_pid())
+        now = time.monotonic()
+        if lifetime and now - _born.setdefault(born, now) > lifetime:
+            _born.pop(born, None)
+            await con.close()
+
+
+async def close_pool(dsn, database=None):
+    """Close and unregister the pool for a database."""
+    entry = _pools.pop((dsn, database), None)
+    if entry is None:
+        return
+    try:
+        pool = await entry.task
+    except Exception:
+        return
+    await pool.close()
+
+
+async def close_pools():
+    """Close every pool registered on the running loop."""
+    loop = asyncio.get_running_loop()
+    for key, entry in list(_pools.items()):
+        if entry.loop is not loop:
+            continue
+        _pools.pop(key)
+        try:
+            pool = await entry.task
+        except Exception:
+            continue
+        await pool.close()
+
+
+async def closing(aw):
+    """Await aw then close the registered pools, e.g.
+    asyncio.run(closing(main())) in a command line tool."""
+    try:
+        return await aw
+    finally:
+        await close_pools()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Cache the introspected catalog and the model state
+of an application on local disk.
+
+Each half of the snapshot is keyed by a fingerprint
+that is much cheaper to compute than the state itself:
+a hash of the xmin of the catalog rows describing the
+schemas (any DDL rewrites them) on the database side,
+and the paths, mtimes and sizes of the model modules on
+the ORM side. Only the half whose fingerprint changed
+is recomputed."""
+
+import os
+import pickle
+import hashlib
+
+from sprout.core.catalog import introspect
+from sprout.core.models import _orm_files
+from sprout.core.plan import model_catalog
+
+
+_query = """select md5(coalesce(string_agg(x, ',' order by x), '')) from (
+select 'n' || n.oid || ':' || n.xmin as x from pg_catalog.pg_namespace n
+where n.nspname = any($1::text[])
+union all
+select 'c' || c.oid || ':' || c.xmin from pg_catalog.pg_class c
+join pg_catalog.pg_namespace n on n.oid = c.relnamespace
+where n.nspname = any($1::text[])
+union all
+select 'a' || a.attrelid || '.' || a.attnum || ':' || a.xmin
+from pg_catalog.pg_attribute a
+join pg_catalog.pg_class c on c.oid = a.attrelid
+join pg_catalog.pg_namespace n on n.oid = c.relnamespace
+where n.nspname = any($1::text[]) and a.attnum > 0
+union all
+select 'k' || k.oid || ':' || k.xmin from pg_catalog.pg_constraint k
+join pg_catalog.pg_namespace n on n.oid = k.connamespace
+where n.nspname = any($1::text[])
+union all
+select 'd' || d.oid || ':' || d.xmin from pg_catalog.pg_attrdef d
+join pg_catalog.pg_class c on c.oid = d.adrelid
+join pg_catalog.pg_namespace n on n.oid = c.relnamespace
+where n.nspname = any($1::text[])
+) s;"""
+
+
+def cache_dir():
+    """Where snapshots live, $SPROUT_CACHE or ~/.cache/sprout."""
+    return os.environ.get('SPROUT_CACHE', os.path.join(
+        os.path.expanduser('~'), '.cache', 'sprout'))
+
+
+async def catalog_fingerprint(con, schemas):
+    """Fingerprint the catalog rows of some schemas.
+
+    Args:
+        con (asyncpg.Connection,asyncpg.pool.Pool): db connection or pool
+        schemas (list): schema names
+
+    Returns:
+        fingerprint (str): changes whenever DDL touches the schemas
+    """
+    return await con.fetchval(_query, list(schemas))
+
+
+def model_fingerprint(appname, schemas, content=False):
+    """Fingerprint the model modules of some schemas.
+
+    Args:
+        appname (str): application name
+        schemas (list): schema names
+        content (bool): hash what the files say rather than where
+                        they are and when they were written, so that
+                        fresh checkouts of the same models agree
+
+    Returns:
+        fingerprint (str): changes whenever a model file changes
+    """
+    digest = hashlib.md5()
+    for schema in schemas:
+        # the same stamps the model registry is invalidated by
+        stamps = _orm_files(appname, schema)
+        for path in sorted(stamps):
+            if content:
+                digest.update(f"{schema}/{os.path.basename(path)}:".encode())
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+                continue
+            mtime, size = stamps[path]
+            digest.update(f"{path}:{mtime}:{size};".encode())
+    return digest.hexdigest()
+
+
+def _path(appname, schemas):
+    """Snapshot file of an application's schemas."""
+    return os.path.join(cache_dir(), f"{appname}.{'.'.join(schemas)}.pickle")
+
+
+def _read(path):
+    """Read a snapshot, empty if missing or unreadable."""
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return {}
+
+
+def _write(path, snap):
+    """Atomically replace a snapshot."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        pickle.dump(snap, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+async def states(con, appname, schemas):
+    """Get the database and model states of some schemas,
+    from the snapshot when their fingerprints still match.
+
+    Args:
+        con (asyncpg.Connection,asyncpg.pool.Pool): db connection or pool
+        appname (str): application name
+        schemas (str,list): schema name(s)
+
+    Returns:
+        dbstate, modstate (dict, dict): catalogs of the db and the models
+    """
+    if isinstance(schemas, str):
+        schemas = [schemas]
+    schemas = sorted(schemas)
+    path = _path(appname, schemas)
+    snap = _read(path)
+    dbfp = await catalog_fingerprint(con, schemas)
+    modfp = model_fingerprint(appname, schemas)
+    dirty = False
+    if snap.get('dbfp') != dbfp:
+        snap['dbstate'] = await introspect(con, schemas)
+        snap['dbfp'] = dbfp
+        dirty = True
+    if snap.get('modfp') != modfp:
+        snap['modstate'] = model_catalog(appname, schemas)
+        snap['modfp'] = modfp
+        dirty = True
+    if dirty:
+        _write(path, snap)
+    return snap['dbstate'], snap['modstate']
@@ -2,29 +2,46 @@
 # Copyright 2019, Sprout Development Team
 # Distributed under the terms of the Apache License 2.0
 
-import os
 import asyncio
 
 import asyncpg
-from tortoise import Tortoise
 
 import sprout
+from sprout.core import pool
+from sprout.cli.init_db import (bring_up, create_from_template,
+                                _create_schema)
 
 class Runner(sprout.Log):
     """An object-oriented interface
     to the sprout utilities.
-    
+
+    The public methods run on the caller's event loop:
+    inside a running loop they return a coroutine to
+    await, otherwise they run to completion on a loop
+    private to the Runner, which close shuts down. The
+    Runner is also an async context manager that closes
+    its pool on exit::
+
+        async with Runner(cfg, app='app', schemas=['a']) as r:
+            pool = await r.easy_up('app')
+
+    With template=True the app database is created as a
+    copy of a golden template database holding its schemas
+    and tables, built on first use and rebuilt whenever the
+    models change (see sprout.cli.init_db).
+
     Args:
         cfg (str,dict): config or path to it
         env (str): key in cfg if it's nested
         rc (str): path to secrets yaml file
         app (str): app name
+        schemas (list): schema names
+        template (bool): create the app db from its template
     """
-    _loop = asyncio.get_event_loop()
 
     def _init_cfg(self, cfg):
         if isinstance(cfg, str):
-            cfg = sprout.load_yml(cfg)
+            cfg = sprout.load_yml(cfg, cache=True)
         if not isinstance(cfg, dict) or not cfg:
             raise Exception("cfg not understood")
         if self.env is not None:
@@ -35,11 +52,11 @@ class Runner(sprout.Log):
         if 'username' not in cfg:
             raise Exception("'username' not found in cfg")
         if self.rc is not None:
-            cfg.update(sprout.load_yml(self.rc))
+            cfg.update(sprout.load_yml(self.rc, cache=True))
         return cfg
 
     def __init__(self, cfg, env=None, rc=None,
-                 app=None, schemas=None):
+                 app=None, schemas=None, template=False):
         self.env = env
         self.rc = rc
         self._cfg = self._init_cfg(cfg)
@@ -47,6 +64,40 @@ class Runner(sprout.Log):
         if schemas is None:
             schemas = []
         self.schemas = schemas
+        self.template = template
+        self.pool = None
+        self._loop = None
+
+    def _run(self, coro):
+        """Hand coro back to be awaited when called from
+        a running loop, else run it on the Runner's loop."""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+            return self._loop.run_until_complete(coro)
+        return coro
+
+    def _shutdown(self):
+        """Close the pools opened on the Runner's loop,
+        then the loop itself."""
+        loop, self._loop = self._loop, None
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.run_until_complete(self._close())
+            # nothing but the Runner uses its loop, nor the pools on it
+            loop.run_until_complete(pool.close_pools())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._close()
 
     def db_str(self, dbname=None, schema=None):
         """Construct a 'jdbc' string"""
@@ -63,80 +114,98 @@ class Runner(sprout.Log):
         if self.app is None:
             self.log.error("has no app")
             return
-        con = await asyncpg.connect(self.db_str(dbname='postgres'))
-        try:
-            await con.execute(f"create database {self.app};")
-        except asyncpg.exceptions.DuplicateDatabaseError:
-            sprout.cfg.log.info(f"database {self.app} exists")
-        finally:
-            await con.close()
+        if self.template:
+            if not self.schemas:
+                self.log.error("template has no schemas")
+                return
+            await create_from_template(
+                self.db_str(dbname='postgres'), self.app, self.schemas,
+                lambda dbname, schema: self.db_str(dbname=dbname,
+                                                   schema=schema))
+            return
+        async with pool.acquire(self.db_str(dbname='postgres')) as con:
+            try:
+                await con.execute(f"create database {self.app};")
+            except asyncpg.exceptions.DuplicateDatabaseError:
+                sprout.cfg.log.info(f"database {self.app} exists")
 
     async def _create_schemas(self):
         if not self.app or not self.schemas:
             self.log.error("either has no app or schemas")
             return
-        con = await asyncpg.connect(self.db_str())
-        for name in self.schemas:
-            try:
-                await con.execute(f"create schema {name};")
-            except asyncpg.exceptions.DuplicateSchemaError:
-                sprout.cfg.log.info(f"schema {name} exists")
-        await con.close()
+        base = self.db_str(dbname=self.app)
+        await asyncio.gather(*(_create_schema(base, name)
+                               for name in self.schemas))
 
-    async def _init_schemas(self):
-        await self._create_database()
-        for schema in self.schemas:
-            await self._create_schemas()
-            await Tortoise.init(
-                db_url=self.db_str(schema=schema),
-                modules={'models': [f'{self.app}.orm.{schema}']}
-            )
-            await Tortoise.generate_schemas()
-            self.log.info(f"'{schema}' ready")
+    async def _init_schemas(self, create=True):
+        if not self.app or not self.schemas:
+            self.log.error("either has no app or schemas")
+            return
+        if create:
+            await self._create_database()
+        await bring_up(self.app, self.schemas, self.db_str(dbname=self.app),
+                       lambda schema: self.db_str(dbname=self.app,
+                                                  schema=schema))
 
     async def _init_db_pool(self):
-        c = self._cfg.copy()
-        c['user'] = c.pop('username')
-        c.pop('driver')
         if self.app is None:
             self.log.error("no app name provided")
             return
-        c['database'] = self.app
-        pw = c.pop('password')
-        self.log.info(f"db_pool: {c}")
-        c['password'] = pw
-        pool = await asyncpg.create_pool(**c)
-        return pool
+        opts = pool.pool_opts(self._cfg)
+        self.log.info(f"db_pool: {self.app} {opts}")
+        self.pool = await pool.get_pool(self.db_str(dbname=self.app), **opts)
+        return self.pool
+
+    async def _easy_up(self):
+        await self._create_database()
+        if self.template:
+            # the tables came with the template
+            return await self._init_db_pool()
+        # tables and the pool only need the database
+        _, db_pool = await asyncio.gather(self._init_schemas(create=False),
+                                          self._init_db_pool())
+        return db_pool
+
+    async def _close(self):
+        if self.pool is not None:
+            await pool.close_pool(self.db_str(dbname=self.app))
+            self.pool = None
 
     def create_database(self, app=None):
         """Initialize db"""
         self.app = app or self.app
-        self._loop.run_until_complete(self._create_database())
+        return self._run(self._create_database())
 
     def create_schemas(self, app=None, schemas=None):
         """Initialize db schemas"""
         self.app = app or self.app
         self.schemas = schemas or self.schemas
-        self._loop.run_until_complete(self._create_schemas())
+        return self._run(self._create_schemas())
 
     def init_schemas(self, app=None, schemas=None):
         """Initialize db tables"""
         self.app = app or self.app
         self.schemas = schemas or self.schemas
-        self._loop.run_until_complete(self._init_schemas())
+        return self._run(self._init_schemas())
 
     def init_db_pool(self, app=None):
         """Initialize db connection pool"""
         self.app = app or self.app
-        pool = self._loop.run_until_complete(self._init_db_pool())
-        return pool
+        return self._run(self._init_db_pool())
 
-    def easy_up(self, app):
+    def easy_up(self, app, schemas=None):
         """Initialize everything and return a db
         connection pool."""
-        self.create_database(app=app)
-        schemas = []
-        self.create_schemas(app=app, schemas=schemas)
-        self.init_schemas(app=app, schemas=schemas)
-        return self.init_db_pool(app=app)
+        self.app = app or self.app
+        self.schemas = schemas or self.schemas
+        return self._run(self._easy_up())
+
+    def close(self):
+        """Close the db connection pool, and the Runner's
+        loop when called outside a running loop"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self._shutdown()
+        return self._close()
 
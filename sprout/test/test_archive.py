@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test the table archive file helpers"""
+
+import pytest
+
+from sprout.core.archive import (archive_path, open_archive,
+                                 write_manifest, read_manifest)
+
+
+def test_archive_path():
+    assert archive_path('app', 'food', 'item') == 'app.orm.food.item.bin'
+    assert archive_path('app', 'food', 'item', 'gzip').endswith('.bin.gz')
+    with pytest.raises(Exception):
+        archive_path('app', 'food', 'item', 'lzma')
+
+
+def test_gzip_round_trip(tmp_path):
+    path = str(tmp_path / archive_path('app', 'food', 'item', 'gzip'))
+    data = b'PGCOPY\n\xff\r\n\x00' * 1000
+    with open_archive(path, 'wb', 'gzip') as f:
+        f.write(data)
+    with open_archive(path, 'rb', 'gzip') as f:
+        assert f.read() == data
+
+
+def test_manifest_round_trip(tmp_path):
+    path = str(tmp_path / 'manifest.json')
+    cols = {'name': 'text', 'price': 'numeric(10,2)'}
+    write_manifest(path, 'food', 'item', cols, 'gzip', 3)
+    manifest = read_manifest(path)
+    assert manifest['rows'] == 3
+    assert [c['name'] for c in manifest['columns']] == list(cols)
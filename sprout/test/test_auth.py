@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test password hashing"""
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from sprout.core import auth
+from sprout.core.auth import (PassHash, Signer, Hasher, PBKDF2SHA256,
+                              get_hasher, salted_hmac)
+
+
+class _Light(PBKDF2SHA256):
+    algorithm = 'light'
+
+
+def test_aencode_matches_encode():
+    ph = PassHash()
+    encoded = ph.encode('secret', 'salt', 1000)
+
+    async def main():
+        assert await ph.aencode('secret', 'salt', 1000) == encoded
+        assert await ph.averify('secret', encoded)
+        assert not await ph.averify('wrong', encoded)
+    asyncio.run(main())
+
+
+def test_process_pool():
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        ph = PassHash(executor=pool)
+        encoded = asyncio.run(ph.aencode('secret', 'salt', 1000))
+    assert ph.verify('secret', encoded)
+
+
+def test_queue_full():
+    ph = PassHash(concurrency=1, queue_size=1)
+
+    async def main():
+        return await asyncio.gather(
+            *(ph.aencode('secret', 'salt', 1000) for _ in range(3)),
+            return_exceptions=True)
+    results = asyncio.run(main())
+    assert sum(isinstance(r, Exception) for r in results) == 1
+    assert ph._pending == 0
+
+
+def test_loops():
+    ph = PassHash(concurrency=1)
+
+    async def main():
+        return await asyncio.gather(
+            *(ph.aencode('secret', 'salt', 1000) for _ in range(3)))
+    assert asyncio.run(main()) == asyncio.run(main())
+
+
+def test_verify_many_late_hasher(monkeypatch):
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        # the worker starts before the hasher is registered
+        pool.submit(abs, 0).result()
+        monkeypatch.setitem(auth.hashers, 'light', _Light())
+        encoded = PassHash(algorithm='light').encode('secret', 'salt', 1000)
+        ph = PassHash()
+        assert list(ph.verify_many([('secret', encoded),
+                                    ('wrong', encoded)],
+                                   executor=pool)) == [True, False]
+
+
+def test_encode_many():
+    ph = PassHash()
+    pairs = [(f"pw{i}", f"salt{i}") for i in range(10)]
+    encoded = list(ph.encode_many(iter(pairs), iterations=1000,
+                                  workers=2, chunksize=3, window=2))
+    assert encoded == [ph.encode(pw, salt, 1000) for pw, salt in pairs]
+    checks = [(pw if i % 2 else 'wrong', enc)
+              for i, ((pw, _), enc) in enumerate(zip(pairs, encoded))]
+    assert list(ph.verify_many(checks, workers=2)) == [i % 2 == 1
+                                                      for i in range(10)]
+
+
+def test_registry_and_upgrade():
+    old = PassHash().encode('secret', 'salt', 1000)
+    ph = PassHash(algorithm='scrypt')
+    new = ph.encode('secret', 'salt', 2 ** 10)
+    assert new.startswith('scrypt$1024$salt$')
+    assert ph.verify('secret', old) and ph.verify('secret', new)
+    assert ph.check('secret', old) == (True, True)
+    assert ph.check('wrong', old) == (False, False)
+    assert ph.check('secret', ph.encode('secret', 'salt')) == (True, False)
+    assert ph.summary(new)['salt'] == 'salt'
+
+
+def test_calibrate():
+    hasher = get_hasher('pbkdf2_sha256').__class__()
+    assert hasher.calibrate(0.005) >= 1000
+    assert get_hasher('pbkdf2_sha256').cost == 20000
+
+
+def test_salted_hmac():
+    mac = salted_hmac('key', 'value', 'secret')
+    assert mac.digest_size == 20
+
+
+def test_signer():
+    signer = Signer('secret', maxsize=2)
+    sig = signer.sign('session', 'user:1')
+    assert signer.verify('session', 'user:1', sig)
+    assert not signer.verify('token', 'user:1', sig)
+    assert not signer.verify('session', 'user:2', sig)
+    signer.sign('other', 'x')
+    assert signer.metrics() == {'size': 2, 'hits': 2, 'misses': 3,
+                                'hit_rate': 0.4}
+    assert sig == Signer('secret').sign('session', 'user:1')
+
+
+def test_hasher_abstract():
+    with pytest.raises(TypeError):
+        Hasher()
+
+    class Half(Hasher):
+        algorithm = 'half'
+
+        def derive(self, password, salt, cost):
+            return b''
+    with pytest.raises(TypeError):
+        Half()
+    assert PBKDF2SHA256(1000).cost == 1000
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test the benchmark helpers"""
+
+import sys
+
+from sprout.cli import bench
+from sprout.core.plan import model_catalog
+
+
+def test_write_models(tmp_path, monkeypatch):
+    bench.write_models(str(tmp_path), 3, 8)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    catalog = model_catalog(bench._appname, bench._schema)
+    assert sorted(catalog) == [('bench', 't0'), ('bench', 't1'),
+                               ('bench', 't2')]
+    assert len(catalog[('bench', 't2')].columns) == 9
+    for name in list(sys.modules):
+        if name.startswith(bench._appname):
+            monkeypatch.delitem(sys.modules, name)
+
+
+def test_compare():
+    old = {'results': [bench.result('load', 1.0, rows=10),
+                       bench.result('dump', 1.0, rows=10)]}
+    new = {'results': [bench.result('load', 1.05, rows=10),
+                       bench.result('dump', 1.5, rows=10),
+                       bench.result('dump', 9.0, rows=99)]}
+    assert bench.compare(old, new) == [('dump', {'rows': 10}, 1.0, 1.5)]
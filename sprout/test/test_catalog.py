@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test building the catalog from pg_catalog rows"""
+
+import json
+import asyncio
+
+from sprout.core.catalog import introspect
+
+
+class _Con:
+    async def fetch(self, query, schemas):
+        self.schemas = schemas
+        return [{
+            'schema': 'food', 'name': 'item',
+            'columns': json.dumps([
+                ['id', 'integer', 'integer', False, None],
+                ['name', 'character varying(20)', 'character varying',
+                 True, None]]),
+            'indexes': json.dumps([
+                ['item_pkey', ['id'], True, True, 'CREATE UNIQUE INDEX']]),
+            'constraints': json.dumps([
+                ['item_pkey', 'p', ['id'], None, 'PRIMARY KEY (id)'],
+                ['item_kind_id_fkey', 'f', ['kind_id'], ['food', 'kind'],
+                 'FOREIGN KEY (kind_id) REFERENCES food.kind(id)']]),
+        }]
+
+
+def test_introspect():
+    con = _Con()
+    catalog = asyncio.run(introspect(con, 'food'))
+    assert con.schemas == ['food']
+    tbl = catalog[('food', 'item')]
+    assert list(tbl.columns) == ['id', 'name']
+    assert tbl.columns['name'].type == 'character varying(20)'
+    assert tbl.columns['name'].data_type == 'character varying'
+    assert tbl.indexes['item_pkey'].columns == ('id',)
+    assert tbl.constraints['item_pkey'].kind == 'p'
+    assert tbl.constraints['item_kind_id_fkey'].references == ('food', 'kind')
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test chunked dump checkpoints"""
+
+import hashlib
+
+import pytest
+
+from sprout.core.checkpoint import (dump_checkpoint_path, read_checkpoint,
+                                    write_checkpoint, verify_dump)
+from sprout.core import pool
+from sprout.cli.dump_db import copy_table_chunked
+
+
+def _chunk(begin, data):
+    return {'start': 1, 'stop': 2, 'rows': data.count(b'\n'),
+            'begin': begin, 'end': begin + len(data),
+            'sha256': hashlib.sha256(data).hexdigest()}
+
+
+def test_verify_dump(tmp_path):
+    path = str(tmp_path / 'app.orm.food.item.csv')
+    header, one, two = b'name\n', b'a\nb\n', b'c\n'
+    with open(path, 'wb') as f:
+        f.write(header + one + two)
+    ckpt = {'chunks': [_chunk(len(header), one),
+                       _chunk(len(header + one), two)]}
+    write_checkpoint(dump_checkpoint_path(path), ckpt)
+    assert read_checkpoint(dump_checkpoint_path(path)) == ckpt
+    assert verify_dump(path) == []
+    with open(path, 'r+b') as f:
+        f.seek(len(header + one))
+        f.write(b'x')
+    assert verify_dump(path) == ckpt['chunks'][1:]
+
+
+def test_missing_checkpoint(tmp_path):
+    assert read_checkpoint(str(tmp_path / 'nope.json')) is None
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_chunked_date_key(sprout_db, tmp_path, monkeypatch):
+    if sprout_db.backend != 'postgres':
+        pytest.skip("needs --sprout-dsn")
+    monkeypatch.chdir(tmp_path)
+    async with pool.acquire(sprout_db.dsn) as con:
+        await con.execute(
+            'create table "user".daily (day date primary key, n integer);'
+            ' insert into "user".daily select d, 1 from generate_series('
+            "'2019-01-01'::date, '2019-01-07', '1 day') d;")
+        try:
+            path = await copy_table_chunked(con, 'sprout', 'user', 'daily',
+                                            chunk_size=3)
+            ckpt = read_checkpoint(dump_checkpoint_path(path))
+            assert [c['stop'] for c in ckpt['chunks']] == [
+                '2019-01-03', '2019-01-06', '2019-01-07']
+            with open(path, 'rb') as f:
+                data = f.read()
+            ckpt['chunks'] = ckpt['chunks'][:1]
+            ckpt['complete'] = False
+            write_checkpoint(dump_checkpoint_path(path), ckpt)
+            await copy_table_chunked(con, 'sprout', 'user', 'daily',
+                                     chunk_size=3)
+            with open(path, 'rb') as f:
+                assert f.read() == data
+            assert data.count(b'\n') == 8
+        finally:
+            await con.execute('drop table "user".daily;')
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test columnar dumps and loads"""
+
+import time
+import asyncio
+import decimal
+import datetime
+
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+
+from sprout.core.columnar import (columnar_path, arrow_type, arrow_schema,
+                                  open_writer, write_batch, read_metadata,
+                                  iter_batches, batch_records)
+from sprout.cli.dump_db import copy_table_columnar
+from sprout.cli.load_db import copy_columnar
+
+
+def test_arrow_type():
+    assert arrow_type('integer') == pa.int32()
+    assert arrow_type('character varying(20)') == pa.string()
+    assert arrow_type('numeric(10,2)') == pa.decimal128(10, 2)
+    assert arrow_type('numeric') == pa.string()
+    assert (arrow_type('timestamp(3) with time zone')
+            == pa.timestamp('us', 'UTC'))
+    with pytest.raises(Exception):
+        arrow_type('integer[]')
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'arrow'])
+def test_round_trip(tmp_path, fmt):
+    cols = {'name': 'text', 'price': 'numeric(10,2)', 'at': 'date',
+            'key': 'uuid'}
+    schema = arrow_schema('food', 'item', cols)
+    rows = [(f"item{i}", decimal.Decimal(f"{i}.50"),
+             datetime.date(2019, 1, 1 + i % 28), None) for i in range(25)]
+    path = str(tmp_path / columnar_path('app', 'food', 'item', fmt))
+    writer = open_writer(path, schema, fmt, 'zstd')
+    for start in range(0, len(rows), 10):
+        write_batch(writer, schema, rows[start:start + 10])
+    writer.close()
+    assert read_metadata(path)['columns'][1]['type'] == 'numeric(10,2)'
+    batches = list(iter_batches(path))
+    assert [b.num_rows for b in batches] == [10, 10, 5]
+    assert [r for b in batches for r in batch_records(b)] == rows
+
+
+@pytest.mark.asyncio(loop_scope='session')
+@pytest.mark.parametrize('fmt', ['parquet', 'arrow'])
+async def test_dump_load(sprout_con, tmp_path, monkeypatch, fmt):
+    monkeypatch.chdir(tmp_path)
+    await sprout_con.execute("insert into \"user\".salt (salt) select 's' || g"
+                             " from generate_series(1, 50) g;")
+    await copy_table_columnar(sprout_con, 'sprout', 'user', 'salt', fmt=fmt,
+                              where='id % 5 <> $1', params=(0,),
+                              chunk_size=16)
+    await sprout_con.execute('delete from "user".salt;')
+    await copy_columnar(sprout_con, 'sprout', 'user', 'salt', fmt=fmt)
+    assert await sprout_con.fetchval('select count(*) from "user".salt;') == 40
+
+
+def test_failed_fetch_settles_write(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    log = []
+
+    class Cursor:
+        calls = 0
+
+        async def fetch(self, n):
+            self.calls += 1
+            if self.calls > 1:
+                raise Exception('connection lost')
+            return [('a',)]
+
+    class Con:
+        async def cursor(self, query, *args):
+            return Cursor()
+
+        def is_in_transaction(self):
+            return True
+
+    class Writer:
+        def close(self):
+            log.append('close')
+
+    async def columns(con, schema, table, keys):
+        return {'name': 'text'}
+
+    def write(writer, schema, rows):
+        time.sleep(0.05)
+        log.append('write')
+
+    monkeypatch.setattr('sprout.cli.dump_db._table_columns', columns)
+    monkeypatch.setattr('sprout.cli.dump_db.open_writer',
+                        lambda *args: Writer())
+    monkeypatch.setattr('sprout.cli.dump_db.write_columnar', write)
+    with pytest.raises(Exception, match='connection lost'):
+        asyncio.run(copy_table_columnar(Con(), 'app', 'food', 'item'))
+    assert log == ['write', 'close']
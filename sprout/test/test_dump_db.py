@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test dumping tables to files"""
+
+import pytest
+
+from sprout.core import pool as registry
+from sprout.cli.dump_db import dump_table
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_dump_table_on_con(sprout_con, tmp_path, monkeypatch):
+    def app_dsn(*args, **kws):
+        raise Exception("no db config needed with a connection")
+    monkeypatch.setattr(registry, 'app_dsn', app_dsn)
+    monkeypatch.chdir(tmp_path)
+    await sprout_con.execute(
+        'insert into "user".salt (id, salt) values (1, $1);', 'pepper')
+    path = await dump_table('sprout', 'user', 'salt', mode='copy',
+                            con=sprout_con)
+    assert path == 'sprout.orm.user.salt.csv'
+    with open(tmp_path / path) as f:
+        assert f.read().splitlines() == ['salt', 'pepper']
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test the database fixtures roll back every test"""
+
+import pytest
+
+from sprout.orm.user.salt import Salt
+
+
+@pytest.mark.asyncio(loop_scope='session')
+@pytest.mark.parametrize('run', [1, 2])
+async def test_orm_rollback(sprout_orm, run):
+    assert await Salt.all().using_db(sprout_orm).count() == 0
+    await Salt.create(salt=f"salt{run}", using_db=sprout_orm)
+    assert await Salt.all().using_db(sprout_orm).count() == 1
+
+
+@pytest.mark.asyncio(loop_scope='session')
+@pytest.mark.parametrize('run', [1, 2])
+async def test_con_rollback(sprout_con, run):
+    count = 'select count(*) from "user".salt;'
+    insert = 'insert into "user".salt (salt) values ($1);'
+    assert await sprout_con.fetchval(count) == 0
+    await sprout_con.execute(insert, f"salt{run}")
+    async with sprout_con.transaction():
+        await sprout_con.execute(insert, 'nested')
+    assert await sprout_con.fetchval(count) == 2
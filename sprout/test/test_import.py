@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test importing sprout stays cheap"""
+
+import os
+import sys
+import subprocess
+
+# microseconds, cumulative as reported by python -X importtime
+_budget = int(os.environ.get('SPROUT_IMPORT_BUDGET_US', 100000))
+
+
+def _import(code):
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          capture_output=True, text=True, check=True)
+
+
+def test_import_budget():
+    out = _import("import sprout").stderr
+    line = [line for line in out.splitlines()
+            if line.rstrip().endswith('| sprout')][-1]
+    cumulative = int(line.split('|')[1])
+    assert cumulative < _budget, line
+
+
+def test_import_is_lazy():
+    code = ("import sys, sprout, sprout.cli; print(sorted(mod for mod in "
+            "('asyncpg', 'tortoise', 'pandas', 'yaml', 'logging.config') "
+            "if mod in sys.modules))")
+    assert _import(code).stdout.strip() == '[]'
@@ -3,4 +3,92 @@
 # Distributed under the terms of the Apache License 2.0
 """Do the things"""
 
+import os
+import asyncio
+
+import pytest
+from tortoise.context import TortoiseContext
+
 import sprout
+from sprout.core.models import get_model
+from sprout.cli.init_db import tortoise_config, template_name, bring_up
+
+
+def test_tortoise_config():
+    url = lambda schema: f"postgres://u@h/sprout?schema={schema}"
+    cfg = tortoise_config('sprout', ['user'], url)
+    assert cfg['apps'] == {'models': {
+        'models': ['sprout.orm.user.salt', 'sprout.orm.user.user'],
+        'default_connection': 'user'}}
+    assert cfg['connections']['user'].endswith('schema=user')
+
+
+def test_template_name():
+    name = template_name('sprout', ['user'])
+    assert name.startswith('golden_') and len(name) == 23
+    assert name == template_name('sprout', ['user'])
+
+
+def _app(root, name, schemas):
+    for schema, modules in schemas.items():
+        pkg = root / name / 'orm' / schema
+        pkg.mkdir(parents=True)
+        for path in [pkg.parent.parent, pkg.parent, pkg]:
+            (path / '__init__.py').write_text('')
+        for module, body in modules.items():
+            (pkg / f"{module}.py").write_text(
+                "from tortoise import fields\n"
+                "from tortoise.models import Model\n\n\n" + body)
+
+
+def test_tortoise_config_references(tmp_path, monkeypatch):
+    _app(tmp_path, 'labelapp', {'menu': {'dish': (
+        "class Dish(Model):\n"
+        "    id = fields.IntField(primary_key=True)\n"
+        "    salt = fields.ForeignKeyField('user.Salt')\n")}})
+    user = tmp_path / 'labelapp' / 'orm' / 'user'
+    user.symlink_to(os.path.join(sprout._root, 'orm', 'user'))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    url = lambda schema: 'sqlite://:memory:'
+    with pytest.raises(Exception, match="another schema"):
+        tortoise_config('labelapp', ['menu', 'user'], url)
+    assert list(tortoise_config('labelapp', ['user'], url)['apps']) == [
+        'models']
+    with pytest.raises(Exception, match="must be 'user.Salt'"):
+        tortoise_config('labelapp', ['user', 'menu'], url)
+    User = get_model('labelapp', 'user', 'user').model
+    assert User._meta.fields_map['salt'].model_name == 'models.Salt'
+    assert User._meta.app is None
+
+
+def test_bring_up(tmp_path, monkeypatch):
+    _app(tmp_path, 'upapp', {
+        'menu': {'kind': ("class Kind(Model):\n"
+                          "    id = fields.IntField(primary_key=True)\n"
+                          "    name = fields.TextField()\n"),
+                 'dish': ("class Dish(Model):\n"
+                          "    id = fields.IntField(primary_key=True)\n"
+                          "    kind = fields.ForeignKeyField('menu.Kind')\n")},
+        'bar': {'drink': ("class Drink(Model):\n"
+                          "    id = fields.IntField(primary_key=True)\n"
+                          "    name = fields.TextField()\n")}})
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    async def create_schema(base, name):
+        pass
+    monkeypatch.setattr('sprout.cli.init_db._create_schema', create_schema)
+
+    async def main():
+        # keep off the Tortoise context of the session's test database
+        async with TortoiseContext():
+            await bring_up('upapp', ['menu', 'bar'], 'sqlite://:memory:',
+                           lambda schema: 'sqlite://:memory:')
+            Kind = get_model('upapp', 'menu', 'kind').model
+            Dish = get_model('upapp', 'menu', 'dish').model
+            Drink = get_model('upapp', 'bar', 'drink').model
+            kind = await Kind.create(name='soup')
+            await Dish.create(kind=kind)
+            await Drink.create(name='tea')
+            return (await Dish.filter(kind__name='soup').count(),
+                    await Drink.all().count())
+    assert asyncio.run(main()) == (1, 1)
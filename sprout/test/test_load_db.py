@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test loading dumps into a database"""
+
+import io
+import csv
+import asyncio
+
+import pytest
+
+from sprout.cli.load_db import (_iter_csv_batches, _reset_sequences,
+                                load_schema)
+
+
+_rows = [['1', 'plain'],
+         ['2', 'two\nlines'],
+         ['3', 'say "hi"'],
+         ['4', 'quote "\nthen, a newline'],
+         ['5', '']]
+
+
+def _write_csv(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['id', 'note'])
+        writer.writerows(rows)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _records(chunk):
+    return list(csv.reader(io.StringIO(chunk.decode('utf-8'))))
+
+
+def test_iter_csv_batches(tmp_path):
+    path = str(tmp_path / 'app.orm.food.item.csv')
+    data = _write_csv(path, _rows)
+    assert b'"say ""hi"""' in data
+    batches = list(_iter_csv_batches(path, 2))
+    assert batches[0] == (b'id,note\n', 0)
+    assert [nrows for _, nrows in batches[1:]] == [2, 2, 1]
+    assert b''.join(chunk for chunk, _ in batches) == data
+    for chunk, nrows in batches[1:]:
+        assert len(_records(chunk)) == nrows
+    assert [r for chunk, _ in batches[1:] for r in _records(chunk)] == _rows
+
+
+def test_iter_csv_batches_boundary(tmp_path):
+    path = str(tmp_path / 'app.orm.food.item.csv')
+    _write_csv(path, _rows[:4])
+    assert [n for _, n in _iter_csv_batches(path, 2)] == [0, 2, 2]
+    assert [n for _, n in _iter_csv_batches(path, 4)] == [0, 4]
+    assert [n for _, n in _iter_csv_batches(path, 10)] == [0, 4]
+
+
+def test_iter_csv_batches_header_only(tmp_path):
+    path = str(tmp_path / 'app.orm.food.item.csv')
+    _write_csv(path, [])
+    assert list(_iter_csv_batches(path, 2)) == [(b'id,note\n', 0)]
+
+
+@pytest.mark.asyncio(loop_scope='session')
+async def test_reset_sequences(sprout_con):
+    await sprout_con.execute(
+        'insert into "user".salt (id, salt) values (100, $1);', 'kept')
+    await _reset_sequences(sprout_con, 'user')
+    new = await sprout_con.fetchval(
+        'insert into "user".salt (salt) values ($1) returning id;', 'new')
+    assert new == 101
+
+
+def test_load_schema_rejects_chunked():
+    with pytest.raises(Exception, match='chunked'):
+        asyncio.run(load_schema('sprout', 'user', mode='chunked'))
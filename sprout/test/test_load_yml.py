@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test the yml config cache"""
+
+import os
+
+import sprout
+
+
+def test_load_yml_cache(tmp_path):
+    path = str(tmp_path / 'cfg.yml')
+    with open(path, 'w') as f:
+        f.write("a: {b: 1}\n")
+    first = sprout.load_yml(path, cache=True)
+    first['a']['b'] = 2
+    assert sprout.load_yml(path, cache=True) == {'a': {'b': 1}}
+    with open(path, 'w') as f:
+        f.write("a: {b: 10}\n")
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert sprout.load_yml(path, cache=True) == {'a': {'b': 10}}
+    assert sprout.load_yml(str(tmp_path / 'missing.yml'), cache=True) == {}
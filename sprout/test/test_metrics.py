@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test the metrics registry and exporters"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from sprout.core import metrics
+
+
+@pytest.fixture(autouse=True)
+def clean():
+    metrics.reset()
+    yield
+    metrics.reset()
+    metrics.configure()
+
+
+def test_export():
+    metrics.copied('load', 'store', 'item', 10, 1024)
+    metrics.observe('sprout_query_seconds', 0.003, command='select')
+    metrics.observe('sprout_query_seconds', 2.0, command='select')
+    stats = metrics.export()
+    rows = stats['counters']['sprout_copy_rows_total'][0]
+    assert rows == {'labels': {'direction': 'load', 'table': 'store.item'},
+                    'value': 10}
+    hist = stats['histograms']['sprout_query_seconds'][0]
+    assert hist['count'] == 2 and hist['buckets'][0.005] == 1
+    text = metrics.export('prometheus')
+    assert '# TYPE sprout_query_seconds histogram' in text
+    assert ('sprout_query_seconds_bucket{command="select",le="+Inf"} 2'
+            in text)
+    assert 'sprout_copy_bytes_total{direction="load",table="store.item"} 1024' \
+        in text
+
+
+def test_slow_query():
+    metrics.configure(slow_query=0.5)
+    record = SimpleNamespace(query='  update t set a = 1', elapsed=0.75,
+                             exception=None,
+                             conn_params=SimpleNamespace(database='app'))
+    metrics._log_query(record)
+    counters = metrics.snapshot()['counters']
+    assert counters['sprout_slow_queries_total'][0]['labels'] == \
+        {'command': 'update', 'database': 'app'}
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test the lock aware migration executor"""
+
+import asyncio
+import contextlib
+
+import asyncpg
+
+from sprout.core.plan import Step
+from sprout.core.migrate import run_plan
+
+
+class _Con:
+    def __init__(self, locked=0):
+        self.locked = locked
+        self.log = []
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        self.log.append('begin')
+        try:
+            yield
+        except Exception:
+            self.log.append('rollback')
+            raise
+        self.log.append('commit')
+
+    async def execute(self, sql, *args):
+        if sql.startswith('alter') and self.locked:
+            self.locked -= 1
+            raise asyncpg.exceptions.LockNotAvailableError('locked')
+        self.log.append(sql.split()[0])
+
+
+def test_retry_on_lock_timeout():
+    con = _Con(locked=2)
+    steps = [Step('alter_table', 's', 't', 'alter table t ...'),
+             Step('create_index', 's', 't', 'create index concurrently i')]
+    timings = asyncio.run(run_plan(con, steps, backoff=0))
+    assert con.log.count('rollback') == 2
+    assert con.log.count('commit') == 1
+    assert con.log.index('commit') < con.log.index('create')
+    assert [t.attempts for t in timings] == [3, 1]
+
+
+class _BrokenCleanup(_Con):
+    async def execute(self, sql, *args):
+        if sql.startswith('create') and self.locked:
+            self.locked -= 1
+            raise asyncpg.exceptions.LockNotAvailableError('locked')
+        if sql.startswith('drop'):
+            raise asyncpg.exceptions.QueryCanceledError('cancelled')
+        self.log.append(sql.split()[0])
+
+
+def test_failed_cleanup_keeps_build_error():
+    con = _BrokenCleanup(locked=1)
+    steps = [Step('create_index', 's', 't', 'create index concurrently i')]
+    timings = asyncio.run(run_plan(con, steps, backoff=0))
+    assert con.log.count('create') == 1
+    assert [t.attempts for t in timings] == [2]
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test discovery of the ORM models bundled with sprout"""
+
+import pytest
+
+from sprout.core.models import (discover_models, schema_models,
+                                dependency_order, get_model,
+                                model_registry)
+
+
+def test_discover_models():
+    models = discover_models('sprout', 'user')
+    assert sorted(models) == ['salt', 'user']
+    assert models['user'].__name__ == 'User'
+
+
+def test_dependency_order():
+    deps = {table: info.deps
+            for table, info in schema_models('sprout', 'user').items()}
+    assert deps == {'salt': set(), 'user': {'salt'}}
+    assert dependency_order(deps) == ['salt', 'user']
+
+
+def test_dependency_cycle():
+    with pytest.raises(Exception):
+        dependency_order({'a': {'b'}, 'b': {'a'}})
+
+
+def test_model_registry():
+    info = get_model('sprout', 'user', 'user')
+    assert info.module == 'sprout.orm.user.user'
+    assert info.deps == {'salt'}
+    refs = {fld.column: fld.references for fld in info.fields}
+    assert refs['salt_id'].endswith('Salt')
+    assert model_registry('sprout') is model_registry('sprout')
+
+
+def test_model_registry_reloads(tmp_path, monkeypatch):
+    pkg = tmp_path / 'regapp' / 'orm' / 'main'
+    pkg.mkdir(parents=True)
+    for path in [pkg.parent.parent, pkg.parent, pkg]:
+        (path / '__init__.py').write_text('')
+    mod = pkg / 'thing.py'
+    body = ("from tortoise import fields\n"
+            "from tortoise.models import Model\n\n\n"
+            "class Thing(Model):\n"
+            "    id = fields.IntField(primary_key=True)\n")
+    mod.write_text(body)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    first = model_registry('regapp')
+    assert [f.column for f in first['main']['thing'].fields] == ['id']
+    mod.write_text(body + "    name = fields.TextField()\n")
+    second = model_registry('regapp')
+    assert second is not first
+    assert [f.column for f in second['main']['thing'].fields] == ['id', 'name']
+
+
+def test_discover_models_db_table(tmp_path, monkeypatch):
+    pkg = tmp_path / 'dumpapp' / 'orm' / 'shop'
+    pkg.mkdir(parents=True)
+    for path in [pkg.parent.parent, pkg.parent, pkg]:
+        (path / '__init__.py').write_text('')
+    head = ("from tortoise import fields\n"
+            "from tortoise.models import Model\n\n\n")
+    (pkg / 'order_item.py').write_text(
+        head + "class OrderItem(Model):\n"
+        "    id = fields.IntField(primary_key=True)\n")
+    (pkg / 'kind.py').write_text(
+        head + "class Kind(Model):\n"
+        "    id = fields.IntField(primary_key=True)\n\n"
+        "    class Meta:\n"
+        "        table = 'kinds'\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    assert sorted(discover_models('dumpapp', 'shop')) == ['kinds', 'orderitem']
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test migration planning against sprout's own models"""
+
+from tortoise import fields
+
+from sprout.core.catalog import Column, Constraint
+from sprout.core.models import get_model
+from sprout.core.plan import model_catalog, plan, pg_type
+
+
+def _copy(catalog):
+    return {key: tbl._replace(columns=dict(tbl.columns),
+                              constraints=dict(tbl.constraints))
+            for key, tbl in catalog.items()}
+
+
+def test_model_catalog():
+    catalog = model_catalog('sprout', 'user')
+    user = catalog[('user', 'user')]
+    assert user.columns['salt_id'].type == 'integer'
+    fk, = [con for con in user.constraints.values() if con.kind == 'f']
+    assert fk.references == ('user', 'salt')
+    assert fk.definition.endswith('("id") ON DELETE CASCADE')
+
+
+def test_pg_type():
+    assert pg_type(fields.TimeField()) == ('time with time zone',) * 2
+    assert pg_type(fields.BinaryField()) == ('bytea', 'bytea')
+    assert pg_type(fields.CharField(20)) == ('character varying(20)',
+                                             'character varying')
+
+
+def test_create_in_dependency_order():
+    steps = plan({}, model_catalog('sprout', 'user'))
+    kinds = [(step.kind, step.table) for step in steps]
+    assert kinds == [('create_table', 'salt'), ('create_table', 'user'),
+                     ('add_constraint', 'user'),
+                     ('validate_constraint', 'user')]
+    assert steps[2].sql.endswith('not valid;')
+
+
+def test_no_changes():
+    target = model_catalog('sprout', 'user')
+    assert plan(_copy(target), target, drop=True) == []
+
+
+def test_merged_alter():
+    target = model_catalog('sprout', 'user')
+    current = _copy(target)
+    cols = current[('user', 'user')].columns
+    cols.pop('contact')
+    cols.pop('profile')
+    cols['name'] = cols['name']._replace(type='character varying(20)')
+    cols['old'] = Column('old', 'text', 'text', True, None)
+    steps = plan(current, target)
+    assert [step.kind for step in steps] == ['alter_table', 'set_not_null',
+                                             'set_not_null']
+    assert 'add column "contact" text,' in steps[0].sql
+    assert 'add column "profile" text;' in steps[0].sql
+    assert 'alter column "name" type text' in steps[0].sql
+    assert 'not null' not in steps[0].sql
+    assert 'drop column' not in steps[0].sql
+    assert steps[1].sql.endswith('alter column "contact" set not null;')
+    steps = plan(current, target, drop=True)
+    assert 'drop column "old"' in steps[0].sql
+
+
+def test_not_null_after_backfill():
+    target = model_catalog('sprout', 'user')
+    current = _copy(target)
+    cols = target[('user', 'user')].columns
+    cols['name'] = cols['name']._replace(nullable=False)
+    cols['flag'] = Column('flag', 'boolean', 'boolean', False, 'false')
+    cols['note'] = Column('note', 'text', 'text', True, "'it''s'")
+    cols = current[('user', 'user')].columns
+    cols['name'] = cols['name']._replace(nullable=True)
+    steps = plan(current, target)
+    assert [step.kind for step in steps] == ['alter_table', 'set_not_null']
+    assert 'add column "flag" boolean default false not null' in steps[0].sql
+    assert 'add column "note" text default \'it\'\'s\';' in steps[0].sql
+    assert 'set not null' not in steps[0].sql
+    assert steps[1].sql.endswith('alter column "name" set not null;')
+
+
+def test_unique_online():
+    target = model_catalog('sprout', 'user')
+    current = _copy(target)
+    target[('user', 'user')].constraints['user_name_key'] = Constraint(
+        'user_name_key', 'u', ('name',), None, 'UNIQUE ("name")')
+    steps = plan(current, target)
+    assert [step.kind for step in steps] == ['create_index', 'add_unique']
+    assert steps[0].sql == ('create unique index concurrently "user_name_key"'
+                            ' on "user"."user" ("name");')
+    assert steps[1].sql.endswith('add constraint "user_name_key"'
+                                 ' unique using index "user_name_key";')
+
+
+def test_db_table_names(tmp_path, monkeypatch):
+    pkg = tmp_path / 'tableapp' / 'orm' / 'shop'
+    pkg.mkdir(parents=True)
+    for path in [pkg.parent.parent, pkg.parent, pkg]:
+        (path / '__init__.py').write_text('')
+    head = ("from tortoise import fields\n"
+            "from tortoise.models import Model\n\n\n")
+    (pkg / 'kind.py').write_text(
+        head + "class Kind(Model):\n"
+        "    id = fields.IntField(primary_key=True)\n\n"
+        "    class Meta:\n"
+        "        table = 'kinds'\n")
+    (pkg / 'order_item.py').write_text(
+        head + "class OrderItem(Model):\n"
+        "    id = fields.IntField(primary_key=True)\n"
+        "    kind = fields.ForeignKeyField('models.Kind',"
+        " on_delete=fields.SET_NULL, null=True)\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    assert get_model('tableapp', 'shop', 'order_item').db_table == 'orderitem'
+    assert get_model('tableapp', 'shop', 'kinds').table == 'kind'
+    catalog = model_catalog('tableapp', 'shop')
+    assert sorted(catalog) == [('shop', 'kinds'), ('shop', 'orderitem')]
+    fk, = [con for con in catalog[('shop', 'orderitem')].constraints.values()
+           if con.kind == 'f']
+    assert fk.references == ('shop', 'kinds')
+    assert fk.definition.endswith(' ON DELETE SET NULL')
+    assert plan(_copy(catalog), catalog, drop=True) == []
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test the Runner runs on the caller's loop"""
+
+import asyncio
+import inspect
+
+import sprout
+
+_cfg = {'host': 'localhost', 'port': 5432, 'database': 'postgres',
+        'username': 'postgres', 'password': '', 'driver': 'postgres'}
+
+
+def test_sync_outside_loop():
+    runner = sprout.Runner(_cfg, app='app')
+    assert runner.close() is None
+
+
+def test_awaitable_inside_loop():
+    async def main():
+        async with sprout.Runner(_cfg, app='app') as runner:
+            coro = runner.close()
+            assert inspect.iscoroutine(coro)
+            await coro
+            return runner
+    runner = asyncio.run(main())
+    assert runner.pool is None
+
+
+def test_init_schemas_in_app_database(monkeypatch):
+    calls = []
+
+    async def bring_up(app, schemas, base, url):
+        calls.append((base, url(schemas[0])))
+    monkeypatch.setattr('sprout.runner.bring_up', bring_up)
+
+    async def main():
+        async with sprout.Runner(_cfg, app='app', schemas=['user']) as runner:
+            await runner._init_schemas(create=False)
+    asyncio.run(main())
+    assert calls == [('postgres://postgres:@localhost:5432/app',
+                      'postgres://postgres:@localhost:5432/app?schema=user')]
+
+
+def test_sync_close_closes_loop():
+    runner = sprout.Runner(_cfg, app='app')
+    assert runner._run(asyncio.sleep(0, 'ran')) == 'ran'
+    loop = runner._loop
+    assert not loop.is_closed()
+    runner.close()
+    assert loop.is_closed()
+    assert runner._loop is None
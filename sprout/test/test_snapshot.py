@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019, Sprout Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Test the local catalog snapshot"""
+
+import asyncio
+
+import pytest
+
+from sprout.core import snapshot
+
+
+class _Con:
+    def __init__(self):
+        self.fingerprint = 'a'
+        self.fetches = 0
+
+    async def fetchval(self, query, schemas):
+        return self.fingerprint
+
+    async def fetch(self, query, schemas):
+        self.fetches += 1
+        return []
+
+
+def test_states(tmp_path, monkeypatch):
+    monkeypatch.setenv('SPROUT_CACHE', str(tmp_path))
+    con = _Con()
+    dbstate, modstate = asyncio.run(snapshot.states(con, 'sprout', 'user'))
+    assert dbstate == {}
+    assert ('user', 'user') in modstate
+    asyncio.run(snapshot.states(con, 'sprout', 'user'))
+    assert con.fetches == 1
+    con.fingerprint = 'b'
+    asyncio.run(snapshot.states(con, 'sprout', 'user'))
+    assert con.fetches == 2
+
+
+def test_model_fingerprint(tmp_path, monkeypatch):
+    pkg = tmp_path / 'fpapp' / 'orm' / 'main'
+    pkg.mkdir(parents=True)
+    for path in [pkg.parent.parent, pkg.parent, pkg]:
+        (path / '__init__.py').write_text('')
+    mod = pkg / 'thing.py'
+    mod.write_text("# v1\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    first = snapshot.model_fingerprint('fpapp', ['main'])
+    content = snapshot.model_fingerprint('fpapp', ['main'], content=True)
+    assert first == snapshot.model_fingerprint('fpapp', ['main'])
+    mod.write_text("# v2, longer\n")
+    assert snapshot.model_fingerprint('fpapp', ['main']) != first
+    assert snapshot.model_fingerprint('fpapp', ['main'],
+                                      content=True) != content
+    with pytest.raises(Exception, match='fpapp.orm.other not found'):
+        snapshot.model_fingerprint('fpapp', ['other'])